@@ -0,0 +1,214 @@
+# artifacts.py
+"""
+Local, content-addressed cache of the files every cluster build downloads.
+
+Versions are pinned in ARTIFACTS. Each download is checked against the
+upstream checksum file where the project publishes one; artifacts without
+one are pinned to the digest of their first download in the cache's lock
+file. Blobs live under <cache>/blobs/sha256/<digest>, so once the cache is
+warm (or copied over) everything works offline.
+
+push() sends artifacts to a VM over a single SFTP session and skips any
+whose remote copy already has the right checksum.
+"""
+import hashlib
+import json
+import os
+import shlex
+import tempfile
+import threading
+import urllib.request
+import uuid
+from pathlib import Path
+
+from cloud_init import CHART_DIR, K3S_INSTALLER
+from remote import run_command
+
+CACHE_DIR = Path(os.environ.get("ARTIFACT_CACHE_DIR", Path.home() / ".cache" / "k3s-api" / "artifacts"))
+REMOTE_STAGING = "/tmp/artifacts"
+
+K3S_VERSION = "v1.31.2+k3s1"
+HELM_VERSION = "v3.16.3"
+_K3S_RELEASE = f"https://github.com/k3s-io/k3s/releases/download/{K3S_VERSION.replace('+', '%2B')}"
+_HELM_TARBALL = f"https://get.helm.sh/helm-{HELM_VERSION}-linux-amd64.tar.gz"
+
+ARTIFACTS = {
+    "k3s": {
+        "version": K3S_VERSION,
+        "url": f"{_K3S_RELEASE}/k3s",
+        "checksum_url": f"{_K3S_RELEASE}/sha256sum-amd64.txt",
+        "checksum_name": "k3s",
+        "remote_path": "/usr/local/bin/k3s",
+        "mode": "755",
+    },
+    "k3s-install": {
+        "version": K3S_VERSION,
+        "url": f"https://raw.githubusercontent.com/k3s-io/k3s/{K3S_VERSION.replace('+', '%2B')}/install.sh",
+        "remote_path": K3S_INSTALLER,
+        "mode": "755",
+    },
+    "helm": {
+        "version": HELM_VERSION,
+        "url": _HELM_TARBALL,
+        "checksum_url": f"{_HELM_TARBALL}.sha256sum",
+        "remote_path": f"/opt/helm/helm-{HELM_VERSION}-linux-amd64.tar.gz",
+        "mode": "644",
+        # The tarball is what we cache and checksum, the binary is unpacked from it
+        "post_install": f"tar -xzf /opt/helm/helm-{HELM_VERSION}-linux-amd64.tar.gz -C /opt/helm && install -m 755 /opt/helm/linux-amd64/helm /usr/local/bin/helm",
+    },
+    "postgres-chart": {
+        "version": "0.1.0",
+        "url": "https://raw.githubusercontent.com/vamsimalle1790/outpostplsql/HEAD/postgres-chart-0.1.0.tgz",
+        "remote_path": f"{CHART_DIR}/postgres-chart-0.1.0.tgz",
+        "mode": "644",
+    },
+}
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+class ArtifactCache:
+    def __init__(self, root=CACHE_DIR, artifacts=ARTIFACTS):
+        self.root = Path(root)
+        self.artifacts = artifacts
+        self._lock = threading.Lock()
+        self._fetch_locks = {name: threading.Lock() for name in artifacts}
+
+    # index.json maps "name@version" to the digest of the cached blob, lock.json
+    # keeps first-seen digests for artifacts without an upstream checksum
+    def _read_json(self, name):
+        path = self.root / name
+        if not path.exists():
+            return {}
+        return json.loads(path.read_text())
+
+    def _write_json(self, name, data):
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self.root / name
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data, indent=2, sort_keys=True))
+        tmp.replace(path)
+
+    def blob_path(self, digest):
+        return self.root / "blobs" / "sha256" / digest
+
+    def _key(self, name):
+        return f"{name}@{self.artifacts[name]['version']}"
+
+    def cached_digest(self, name):
+        with self._lock:
+            digest = self._read_json("index.json").get(self._key(name))
+        if digest and self.blob_path(digest).exists():
+            return digest
+        return None
+
+    def _expected_digest(self, name):
+        spec = self.artifacts[name]
+        if spec.get("sha256"):
+            return spec["sha256"]
+        if spec.get("checksum_url"):
+            with urllib.request.urlopen(spec["checksum_url"], timeout=30) as response:
+                lines = response.read().decode().splitlines()
+            wanted = spec.get("checksum_name")
+            for line in lines:
+                parts = line.split()
+                if parts and (wanted is None or parts[-1].lstrip("*") == wanted):
+                    return parts[0]
+            raise ChecksumMismatch(f"No checksum for {name} in {spec['checksum_url']}")
+        with self._lock:
+            return self._read_json("lock.json").get(self._key(name))
+
+    def fetch(self, name):
+        """Return the local path of `name`, downloading and verifying it if it isn't cached."""
+        with self._fetch_locks[name]:
+            digest = self.cached_digest(name)
+            if digest:
+                return self.blob_path(digest)
+
+            expected = self._expected_digest(name)
+            self.root.mkdir(parents=True, exist_ok=True)
+            sha = hashlib.sha256()
+            with tempfile.NamedTemporaryFile(dir=self.root, delete=False) as tmp:
+                try:
+                    with urllib.request.urlopen(self.artifacts[name]["url"], timeout=60) as response:
+                        for chunk in iter(lambda: response.read(1024 * 1024), b""):
+                            sha.update(chunk)
+                            tmp.write(chunk)
+                except Exception:
+                    os.unlink(tmp.name)
+                    raise
+            digest = sha.hexdigest()
+            if expected and digest != expected:
+                os.unlink(tmp.name)
+                raise ChecksumMismatch(f"{name}: expected sha256 {expected}, downloaded {digest}")
+
+            blob = self.blob_path(digest)
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp.name, blob)
+            with self._lock:
+                index = self._read_json("index.json")
+                index[self._key(name)] = digest
+                self._write_json("index.json", index)
+                if not expected:
+                    lock = self._read_json("lock.json")
+                    lock[self._key(name)] = digest
+                    self._write_json("lock.json", lock)
+            return blob
+
+    def status(self):
+        return {
+            name: {
+                "version": spec["version"],
+                "sha256": self.cached_digest(name),
+                "cached": self.cached_digest(name) is not None,
+                "remote_path": spec["remote_path"],
+            }
+            for name, spec in self.artifacts.items()
+        }
+
+    def push(self, client, names):
+        """
+        Copy artifacts to the host behind `client` over one SFTP session.
+
+        Remote checksums are read with a single sha256sum call; matching files
+        are skipped. Uploads land in REMOTE_STAGING and are moved into place
+        with one sudo command. Returns {name: "skipped" | "uploaded"}.
+        """
+        local = {name: self.fetch(name) for name in names}
+        digests = {name: path.name for name, path in local.items()}
+
+        paths = " ".join(shlex.quote(self.artifacts[name]["remote_path"]) for name in names)
+        remote = {}
+        for line in run_command(client, f"sha256sum {paths} 2>/dev/null || true").stdout.splitlines():
+            parts = line.split()
+            if len(parts) == 2:
+                remote[parts[1]] = parts[0]
+
+        missing = [name for name in names if remote.get(self.artifacts[name]["remote_path"]) != digests[name]]
+        if missing:
+            # Per-push staging dir so concurrent pushes to one host don't clean up each other's files
+            staging = f"{REMOTE_STAGING}-{uuid.uuid4().hex[:8]}"
+            install = []
+            run_command(client, f"mkdir -p {staging}")
+            sftp = client.open_sftp()
+            try:
+                for name in missing:
+                    staged = f"{staging}/{digests[name]}"
+                    sftp.put(str(local[name]), staged)
+                    spec = self.artifacts[name]
+                    target = shlex.quote(spec["remote_path"])
+                    install.append(f"sudo install -D -m {spec['mode']} {staged} {target}")
+                    if spec.get("post_install"):
+                        install.append(f"sudo sh -c {shlex.quote(spec['post_install'])}")
+            finally:
+                sftp.close()
+            result = run_command(client, " && ".join(install) + f" && rm -rf {staging}")
+            if not result.ok:
+                raise Exception(f"Installing artifacts failed: {result.stderr.strip()}")
+
+        return {name: "uploaded" if name in missing else "skipped" for name in names}
+
+
+artifact_cache = ArtifactCache()
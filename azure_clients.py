@@ -0,0 +1,174 @@
+# azure_clients.py
+"""
+Azure management clients, built on first use instead of at import.
+
+Importing main used to build the credential and all three SDK clients
+(and sometimes fetch a token) before / could answer, and needed real
+credentials just to import the app. Now main gets stand-ins that build
+the clients the first time an ARM call is made, once, whichever thread
+gets there first.
+
+Where the clients come from is picked with AZURE_BACKEND:
+
+    config  the resource_client/network_client/compute_client/subscription_id
+            of a local azure_config.py, as before. Default when one exists.
+    azure   built here from AZURE_SUBSCRIPTION_ID and azure-identity
+            (service principal from AZURE_CLIENT_ID/AZURE_TENANT_ID/
+            AZURE_CLIENT_SECRET, otherwise DefaultAzureCredential).
+    fake    fakes.fake_clients(), in memory, for local runs without Azure.
+
+The three clients share one credential and one token, so a cold start does
+one credential handshake instead of three. With a service principal the
+token is also kept in a persistent MSAL cache (AZURE_TOKEN_CACHE), which
+every uvicorn worker on the host reads before asking Entra ID for its own.
+"""
+import importlib
+import importlib.util
+import os
+import threading
+import time
+
+AZURE_BACKEND = os.environ.get("AZURE_BACKEND") or ("config" if importlib.util.find_spec("azure_config") else "azure")
+# Name of the shared on-disk token cache, empty turns it off
+AZURE_TOKEN_CACHE = os.environ.get("AZURE_TOKEN_CACHE", "k3s-api")
+AZURE_FAKE_LATENCY = float(os.environ.get("AZURE_FAKE_LATENCY", 0))
+# Get a new token this long before the current one expires
+TOKEN_REFRESH_MARGIN = 300
+
+
+class LazyProxy:
+    """Stands in for factory() and calls it on first attribute access, exactly once."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+
+class SharedTokenCredential:
+    """
+    Hands every client the same token until it's about to expire. Each SDK
+    client otherwise asks the credential on its own first call.
+    """
+
+    def __init__(self, credential, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self._credential = credential
+        self._refresh_margin = refresh_margin
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes, **kwargs):
+        if kwargs.get("claims") or kwargs.get("tenant_id"):
+            # Claims challenges and other tenants always go to the credential
+            return self._credential.get_token(*scopes, **kwargs)
+        with self._lock:
+            token = self._tokens.get(scopes)
+            if token is None or token.expires_on - self._refresh_margin <= time.time():
+                token = self._credential.get_token(*scopes, **kwargs)
+                self._tokens[scopes] = token
+            return token
+
+    def close(self):
+        self._credential.close()
+
+
+def _credential():
+    from azure.identity import ClientSecretCredential, DefaultAzureCredential, TokenCachePersistenceOptions
+
+    client_id = os.environ.get("AZURE_CLIENT_ID")
+    tenant_id = os.environ.get("AZURE_TENANT_ID")
+    secret = os.environ.get("AZURE_CLIENT_SECRET")
+    if client_id and tenant_id and secret:
+        options = {}
+        if AZURE_TOKEN_CACHE:
+            # Falls back to a plain (mode 600) file where there's no keyring, e.g. on a server
+            options["cache_persistence_options"] = TokenCachePersistenceOptions(name=AZURE_TOKEN_CACHE, allow_unencrypted_storage=True)
+        return ClientSecretCredential(tenant_id, client_id, secret, **options)
+    # Managed identity, az login, ... each keep their own in-memory cache
+    return DefaultAzureCredential()
+
+
+def _azure_backend():
+    from azure.mgmt.compute import ComputeManagementClient
+    from azure.mgmt.network import NetworkManagementClient
+    from azure.mgmt.resource import ResourceManagementClient
+
+    subscription_id = os.environ.get("AZURE_SUBSCRIPTION_ID")
+    if not subscription_id:
+        raise RuntimeError("AZURE_SUBSCRIPTION_ID is not set (or set AZURE_BACKEND=config/fake)")
+    credential = SharedTokenCredential(_credential())
+    return (
+        ResourceManagementClient(credential, subscription_id),
+        NetworkManagementClient(credential, subscription_id),
+        ComputeManagementClient(credential, subscription_id),
+        subscription_id,
+    )
+
+
+def _config_backend():
+    config = importlib.import_module("azure_config")
+    return config.resource_client, config.network_client, config.compute_client, config.subscription_id
+
+
+def _fake_backend():
+    from fakes import fake_clients
+
+    resource_client, network_client, compute_client = fake_clients(latency=AZURE_FAKE_LATENCY)
+    return resource_client, network_client, compute_client, resource_client.resource_groups._azure.subscription_id
+
+
+BACKENDS = {"azure": _azure_backend, "config": _config_backend, "fake": _fake_backend}
+
+
+class AzureClients:
+    def __init__(self, backend=AZURE_BACKEND):
+        self._lock = threading.Lock()
+        self._clients = None
+        self.use(backend)
+        # Safe to hand out at import, nothing is built until they're used
+        self.resource_client = LazyProxy(lambda: self._get()[0])
+        self.network_client = LazyProxy(lambda: self._get()[1])
+        self.compute_client = LazyProxy(lambda: self._get()[2])
+
+    def use(self, backend):
+        """
+        Switch to a backend name from BACKENDS, or a function returning
+        (resource_client, network_client, compute_client, subscription_id).
+        Only affects clients nobody has used yet.
+        """
+        if not callable(backend) and backend not in BACKENDS:
+            raise ValueError(f"Unknown AZURE_BACKEND {backend!r}, expected one of {sorted(BACKENDS)}")
+        with self._lock:
+            self.backend = backend if callable(backend) else BACKENDS[backend]
+            self.backend_name = getattr(backend, "__name__", "custom") if callable(backend) else backend
+            self._clients = None
+
+    def _get(self):
+        if self._clients is None:
+            with self._lock:
+                if self._clients is None:
+                    start = time.perf_counter()
+                    self._clients = self.backend()
+                    print(f"Azure clients ({self.backend_name}) ready in {time.perf_counter() - start:.2f}s")
+        return self._clients
+
+    @property
+    def subscription_id(self):
+        return self._get()[3]
+
+    @property
+    def ready(self):
+        return self._clients is not None
+
+
+azure_clients = AzureClients()
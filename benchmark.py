@@ -0,0 +1,206 @@
+# benchmark.py
+"""
+Wall-clock benchmarks against the fake Azure and SSH backends in fakes.py.
+
+    python benchmark.py provisioning --vm-count 10 --latency 0.5 --max-concurrency 5
+    python benchmark.py load --requests 50 --concurrency 10 --throttle-rate 0.05
+
+`load` drives the FastAPI app in-process and prints throughput, p50/p99
+latency and peak traced memory per endpoint. Nothing talks to Azure or a
+real VM: main gets fake Azure clients through azure_clients.use().
+"""
+import argparse
+import contextlib
+import importlib
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from fakes import FakeSSHServer, fake_clients
+from models import vmcreation
+from provisioning import DEFAULT_MAX_CONCURRENCY, provision_vms
+
+
+def bench_provisioning(vm_count, latency, max_concurrency):
+    """Time provision_vms sequentially (concurrency 1) and with the given cap."""
+    results = {}
+    for label, cap in (("sequential", 1), ("parallel", max_concurrency)):
+        resource_client, network_client, compute_client = fake_clients(latency=latency)
+        vm = vmcreation(vm_count=vm_count, rg="bench-rg", max_concurrency=cap)
+        start = time.perf_counter()
+        vm_ips = provision_vms(vm, resource_client, network_client, compute_client, max_concurrency=cap)
+        results[label] = {"seconds": time.perf_counter() - start, "vms": len(vm_ips)}
+
+    results["speedup"] = results["sequential"]["seconds"] / results["parallel"]["seconds"]
+    return results
+
+
+# name -> (method, path, request kwargs for request number i, runs as a job)
+def _scenarios(vm_count):
+    node = lambda i: f"10.0.{i // 250}.{i % 250 + 4}"
+    return {
+        "create-vms": ("POST", "/create-vms", lambda i: {"params": {"vm_count": vm_count, "rg": f"bench-rg-{i}"}}, False),
+        "setup-k3s-primary": ("POST", "/setup-k3s-primary", lambda i: {"params": {"ip_address": node(i)}}, False),
+        "join-k3s-node": ("POST", "/join-k3s-node", lambda i: {"params": {"ip_address": node(i), "token": "K10fake", "server_ip": "10.0.0.4"}}, False),
+        "install-helm": ("POST", "/install-helm", lambda i: {"params": {"ip_address": node(i)}}, False),
+        "deploy-postgres": ("POST", "/deploy-postgres/", lambda i: {"params": {"ip_address": node(i)}}, False),
+        "clusters": ("POST", "/clusters", lambda i: {"json": {"vm_count": vm_count, "rg": f"bench-cluster-{i}"}}, True),
+        "metrics": ("GET", "/metrics", lambda i: {}, False),
+    }
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def load_app(arm_latency=0.05, throttle_rate=0.0, arm_failure_rate=0.0, ssh_handshake=0.05,
+             ssh_latency=0.02, ssh_failure_rate=0.0, seed=None):
+    """
+    Import main against fake backends. Returns (app module, fake Azure store,
+    fake SSH server). Call once per process: main binds its clients at import.
+    """
+    resource_client, network_client, compute_client = fake_clients(
+        latency=arm_latency, throttle_rate=throttle_rate, failure_rate=arm_failure_rate, seed=seed)
+    from azure_clients import azure_clients
+    azure_clients.use(lambda: (resource_client, network_client, compute_client,
+                               resource_client.resource_groups._azure.subscription_id))
+    # Keep benchmark clusters and commands out of the real registry and execution journal
+    state = tempfile.mkdtemp(prefix="bench-")
+    os.environ.setdefault("CLUSTER_REGISTRY_DB", os.path.join(state, "registry.db"))
+    os.environ.setdefault("EXECUTION_JOURNAL_DIR", os.path.join(state, "executions"))
+
+    # Installs "download" for a bit longer than other commands
+    server = FakeSSHServer(handshake_latency=ssh_handshake, command_latency=ssh_latency,
+                           slow={"curl": ssh_latency * 5, "helm": ssh_latency * 3},
+                           failure_rate=ssh_failure_rate, seed=seed)
+    from readiness import prober
+    from ssh_pool import ssh_pool
+    ssh_pool.client_factory = server.client_factory
+    prober.open_connection = server.open_connection
+
+    return importlib.import_module("main"), resource_client.resource_groups._azure, server
+
+
+def _wait_for_job(client, job_id, poll=0.02):
+    while True:
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] in ("succeeded", "failed"):
+            return job
+        time.sleep(poll)
+
+
+def bench_endpoint(client, scenario, requests, concurrency):
+    method, path, make_request, is_job = scenario
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        start = time.perf_counter()
+        response = client.request(method, path, **make_request(i))
+        ok = response.status_code < 400
+        if ok and is_job:
+            ok = _wait_for_job(client, response.json()["job_id"])["status"] == "succeeded"
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            errors += 0 if ok else 1
+
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - before
+
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput": requests / wall if wall else 0.0,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "peak_mb": max(peak, 0) / (1024 * 1024),
+    }
+
+
+def bench_load(endpoints, requests, concurrency, vm_count, **backend):
+    from fastapi.testclient import TestClient
+
+    app_module, azure, server = load_app(**backend)
+    scenarios = _scenarios(vm_count)
+    results = {}
+    tracemalloc.start()
+    try:
+        # The endpoints print every command's output, keep that out of the report
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), TestClient(app_module.app) as client:
+            for name in endpoints:
+                results[name] = bench_endpoint(client, scenarios[name], requests, concurrency)
+    finally:
+        tracemalloc.stop()
+
+    from retry import failures
+    backend_stats = {
+        "arm_throttled": azure.throttled,
+        "arm_failed": azure.failed,
+        "retries": sum(op["retries"] for op in failures.stats().values()),
+        "ssh_handshakes": server.handshakes,
+        "ssh_commands": len(server.commands),
+    }
+    return results, backend_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    prov = sub.add_parser("provisioning", help="sequential vs parallel /create-vms provisioning")
+    prov.add_argument("--vm-count", type=int, default=10)
+    prov.add_argument("--latency", type=float, default=0.2, help="seconds per fake ARM operation")
+    prov.add_argument("--max-concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY)
+
+    load = sub.add_parser("load", help="throughput, p50/p99 and peak memory per endpoint")
+    load.add_argument("--endpoint", action="append", choices=sorted(_scenarios(1)),
+                      help="repeat to pick several, default: all")
+    load.add_argument("--requests", type=int, default=20, help="requests per endpoint")
+    load.add_argument("--concurrency", type=int, default=5)
+    load.add_argument("--vm-count", type=int, default=3)
+    load.add_argument("--arm-latency", type=float, default=0.05, help="seconds per fake ARM operation")
+    load.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of ARM calls answered with 429")
+    load.add_argument("--arm-failure-rate", type=float, default=0.0, help="fraction of ARM calls answered with 500")
+    load.add_argument("--ssh-handshake", type=float, default=0.05, help="seconds per fake SSH connect")
+    load.add_argument("--ssh-latency", type=float, default=0.02, help="seconds per fake remote command")
+    load.add_argument("--ssh-failure-rate", type=float, default=0.0, help="fraction of commands exiting 1")
+    load.add_argument("--seed", type=int, default=None)
+
+    args = parser.parse_args()
+    if args.bench == "provisioning":
+        results = bench_provisioning(args.vm_count, args.latency, args.max_concurrency)
+        for label in ("sequential", "parallel"):
+            print(f"{label:<11} {results[label]['vms']} VMs in {results[label]['seconds']:.2f}s")
+        print(f"speedup     {results['speedup']:.1f}x")
+    elif args.bench == "load":
+        endpoints = args.endpoint or list(_scenarios(1))
+        results, backend = bench_load(
+            endpoints, args.requests, args.concurrency, args.vm_count,
+            arm_latency=args.arm_latency, throttle_rate=args.throttle_rate, arm_failure_rate=args.arm_failure_rate,
+            ssh_handshake=args.ssh_handshake, ssh_latency=args.ssh_latency,
+            ssh_failure_rate=args.ssh_failure_rate, seed=args.seed,
+        )
+        print(f"{'endpoint':<18} {'reqs':>5} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'peak MB':>8}")
+        for name, r in results.items():
+            print(f"{name:<18} {r['requests']:>5} {r['errors']:>6} {r['throughput']:>8.1f} "
+                  f"{r['p50'] * 1000:>8.1f} {r['p99'] * 1000:>8.1f} {r['peak_mb']:>8.2f}")
+        print(", ".join(f"{key}={value}" for key, value in backend.items()))
+
+
+if __name__ == "__main__":
+    main()
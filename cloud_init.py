@@ -0,0 +1,94 @@
+# cloud_init.py
+"""
+Boot-time k3s setup passed to the VMs as cloud-init custom_data.
+
+With bootstrap="cloud-init" node 1 comes up as the k3s server and every
+other node as an agent pointed at node 1's static private IP, using a
+token chosen before the VMs exist. Nodes join as they boot, with no SSH
+round trips. The server also gets Helm and the Postgres chart.
+
+The script skips every download that a pre-baked image already has:
+
+    /usr/local/bin/k3s       k3s binary (INSTALL_K3S_SKIP_DOWNLOAD)
+    /opt/k3s/install.sh      k3s install script
+    /usr/local/bin/helm      Helm
+    /opt/outpostplsql        Postgres chart repo, linked into the admin's home
+"""
+import base64
+import ipaddress
+import secrets
+
+K3S_INSTALLER = "/opt/k3s/install.sh"
+CHART_DIR = "/opt/outpostplsql"
+CHART_REPO = "https://github.com/vamsimalle1790/outpostplsql"
+
+# Azure reserves the first four addresses and the last one of every subnet. Dynamic
+# allocation hands out the lowest free address, so node 1 takes the highest usable
+# one: NICs and scale set instances created at the same time never get there first.
+PRIMARY_HOST_OFFSET = -2
+
+_COMMON = """#!/bin/bash
+# No -x: the trace would write K3S_TOKEN to /var/log/cloud-init-output.log
+set -eu
+mkdir -p /opt/k3s
+[ -f {installer} ] || curl -sfL https://get.k3s.io -o {installer}
+if [ -x /usr/local/bin/k3s ]; then export INSTALL_K3S_SKIP_DOWNLOAD=true; fi
+"""
+
+_SERVER = """export K3S_TOKEN='{token}'
+sh {installer} server --cluster-init --write-kubeconfig-mode 644 --node-ip {private_ip}{tls_san}
+command -v helm || curl -fsSL https://raw.githubusercontent.com/helm/helm/main/scripts/get-helm-3 | bash
+[ -d {chart_dir} ] || git clone --depth 1 {chart_repo} {chart_dir}
+ln -sfn {chart_dir} /home/{username}/outpostplsql
+"""
+
+_AGENT = """export K3S_URL='https://{server_ip}:6443' K3S_TOKEN='{token}'
+sh {installer} agent
+"""
+
+
+def new_k3s_token():
+    return secrets.token_hex(32)
+
+
+def primary_private_ip(subnet_prefix):
+    """Static private IP given to node 1 so agents know the server address before it boots, e.g. 10.0.0.254 in a /24."""
+    return str(ipaddress.ip_network(subnet_prefix)[PRIMARY_HOST_OFFSET])
+
+
+def server_script(token, private_ip, username, public_ip=None):
+    tls_san = f" --tls-san {public_ip}" if public_ip else ""
+    return _COMMON.format(installer=K3S_INSTALLER) + _SERVER.format(
+        token=token,
+        installer=K3S_INSTALLER,
+        private_ip=private_ip,
+        tls_san=tls_san,
+        chart_dir=CHART_DIR,
+        chart_repo=CHART_REPO,
+        username=username,
+    )
+
+
+def agent_script(token, server_ip):
+    return _COMMON.format(installer=K3S_INSTALLER) + _AGENT.format(
+        token=token,
+        installer=K3S_INSTALLER,
+        server_ip=server_ip,
+    )
+
+
+def encode(script):
+    """Azure expects custom_data base64 encoded."""
+    return base64.b64encode(script.encode()).decode()
+
+
+def image_reference(vm):
+    """Custom (pre-baked) image when image_id is set, the stock Ubuntu image otherwise."""
+    if vm.image_id:
+        return {"id": vm.image_id}
+    return {
+        "publisher": "Canonical",
+        "offer": "UbuntuServer",
+        "sku": "18.04-LTS",
+        "version": "latest"
+    }
@@ -0,0 +1,262 @@
+# cluster_status.py
+"""
+Health and capacity snapshot of a running cluster, for GET /clusters/{id}/status.
+
+One pass per cluster collects nodes, pods, workloads, HPAs and (when
+metrics-server answers) node usage: five list calls over the cluster's
+pooled KubeClient, or a single kubectl command over a pooled SSH
+connection. The summary is cached for STATUS_TTL seconds and concurrent
+requests for the same cluster wait for the one collection in flight, so
+polling it often costs almost nothing.
+
+    snapshot = cluster_status.get(cluster_id, vm, postgres_releases=[("default", "postgres-chart")])
+
+CPU is in cores and memory in bytes. "requested" adds up the requests of
+pods that are still running, "used" comes from metrics-server and is None
+without it.
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+from kube_api import KubeApiError, kube_clients
+from readiness import KUBECTL
+from registry import TTLCache
+from remote import run_command
+from ssh_pool import ssh_pool
+
+STATUS_TTL = float(os.environ.get("CLUSTER_STATUS_TTL", 15))
+_METRICS_MARKER = "---node-metrics---"
+_SUFFIXES = {
+    "n": 1e-9, "u": 1e-6, "m": 1e-3, "k": 1e3, "M": 1e6, "G": 1e9, "T": 1e12, "P": 1e15, "E": 1e18,
+    "Ki": 2 ** 10, "Mi": 2 ** 20, "Gi": 2 ** 30, "Ti": 2 ** 40, "Pi": 2 ** 50, "Ei": 2 ** 60,
+}
+_FINISHED_PHASES = {"Succeeded", "Failed"}
+
+
+def parse_quantity(value):
+    """Kubernetes quantity ("250m", "1Gi", "123456n", "2") as a float in base units."""
+    if value is None:
+        return 0.0
+    value = str(value)
+    for suffix in ("Ki", "Mi", "Gi", "Ti", "Pi", "Ei"):
+        if value.endswith(suffix):
+            return float(value[:-2]) * _SUFFIXES[suffix]
+    if value[-1:] in _SUFFIXES:
+        return float(value[:-1]) * _SUFFIXES[value[-1]]
+    return float(value)
+
+
+def collect_with_kube_api(client):
+    def items(path):
+        return client.get(path)["items"]
+
+    raw = {
+        "nodes": items("/api/v1/nodes"),
+        "pods": items("/api/v1/pods"),
+        "statefulsets": items("/apis/apps/v1/statefulsets"),
+        "deployments": items("/apis/apps/v1/deployments"),
+        "hpas": items("/apis/autoscaling/v2/horizontalpodautoscalers"),
+    }
+    try:
+        raw["node_metrics"] = items("/apis/metrics.k8s.io/v1beta1/nodes")
+    except (requests.RequestException, KubeApiError):
+        # No metrics-server, or it isn't up yet
+        raw["node_metrics"] = None
+    return raw
+
+
+def collect_with_ssh(client):
+    """Everything in one kubectl call, then the metrics after a marker line."""
+    command = (
+        f"{KUBECTL} get nodes,pods,statefulsets,deployments,hpa -A -o json"
+        f" && echo '{_METRICS_MARKER}'"
+        f" && ({KUBECTL} get --raw /apis/metrics.k8s.io/v1beta1/nodes 2>/dev/null || echo null)"
+    )
+    result = run_command(client, command, timeout=60)
+    if not result.ok:
+        raise Exception(f"kubectl failed: {result.stderr.strip()[-500:]}")
+    objects, _, metrics = result.stdout.partition(_METRICS_MARKER)
+    kinds = {"Node": "nodes", "Pod": "pods", "StatefulSet": "statefulsets", "Deployment": "deployments", "HorizontalPodAutoscaler": "hpas"}
+    raw = {key: [] for key in kinds.values()}
+    for item in json.loads(objects)["items"]:
+        if item.get("kind") in kinds:
+            raw[kinds[item["kind"]]].append(item)
+    metrics = json.loads(metrics) if metrics.strip() else None
+    raw["node_metrics"] = metrics["items"] if metrics else None
+    return raw
+
+
+def _pod_requests(pod):
+    cpu = memory = 0.0
+    for container in pod.get("spec", {}).get("containers", []):
+        requested = container.get("resources", {}).get("requests", {})
+        cpu += parse_quantity(requested.get("cpu"))
+        memory += parse_quantity(requested.get("memory"))
+    return cpu, memory
+
+
+def _percent(part, whole):
+    return round(100 * part / whole, 1) if part is not None and whole else None
+
+
+def _resource(allocatable, requested, used):
+    return {
+        "allocatable": round(allocatable, 3),
+        "requested": round(requested, 3),
+        "requested_percent": _percent(requested, allocatable),
+        "used": round(used, 3) if used is not None else None,
+        "used_percent": _percent(used, allocatable),
+    }
+
+
+def _release_of(obj):
+    metadata = obj["metadata"]
+    return (metadata.get("annotations") or {}).get("meta.helm.sh/release-name") or \
+        (metadata.get("labels") or {}).get("app.kubernetes.io/instance")
+
+
+def _hpa_summary(hpa):
+    spec, status = hpa.get("spec", {}), hpa.get("status", {})
+    target = spec.get("targetCPUUtilizationPercentage")
+    current = status.get("currentCPUUtilizationPercentage")
+    # autoscaling/v2 keeps them in the metrics lists
+    for metric in spec.get("metrics") or []:
+        if metric.get("type") == "Resource" and metric["resource"]["name"] == "cpu":
+            target = metric["resource"].get("target", {}).get("averageUtilization", target)
+    for metric in status.get("currentMetrics") or []:
+        if metric.get("type") == "Resource" and metric["resource"]["name"] == "cpu":
+            current = metric["resource"].get("current", {}).get("averageUtilization", current)
+    return {
+        "name": hpa["metadata"]["name"],
+        "min_replicas": spec.get("minReplicas", 1),
+        "max_replicas": spec.get("maxReplicas"),
+        "current_replicas": status.get("currentReplicas"),
+        "desired_replicas": status.get("desiredReplicas"),
+        "target_cpu_utilization": target,
+        "current_cpu_utilization": current,
+    }
+
+
+def summarize(raw, postgres_releases=()):
+    used = None
+    if raw["node_metrics"] is not None:
+        used = {item["metadata"]["name"]: item["usage"] for item in raw["node_metrics"]}
+
+    pods_by_node = defaultdict(list)
+    phases = defaultdict(int)
+    for pod in raw["pods"]:
+        phase = pod.get("status", {}).get("phase", "Unknown")
+        phases[phase] += 1
+        if phase not in _FINISHED_PHASES:
+            pods_by_node[pod.get("spec", {}).get("nodeName")].append(pod)
+
+    nodes = []
+    totals = defaultdict(float)
+    for node in raw["nodes"]:
+        name = node["metadata"]["name"]
+        status = node.get("status", {})
+        allocatable = status.get("allocatable", {})
+        pod_requests = [_pod_requests(pod) for pod in pods_by_node.get(name, [])]
+        usage = used.get(name) if used is not None else None
+        node_used = (parse_quantity(usage["cpu"]), parse_quantity(usage["memory"])) if usage else (None, None)
+        cpu = _resource(parse_quantity(allocatable.get("cpu")), sum(r[0] for r in pod_requests), node_used[0])
+        memory = _resource(parse_quantity(allocatable.get("memory")), sum(r[1] for r in pod_requests), node_used[1])
+        ready = any(c["type"] == "Ready" and c["status"] == "True" for c in status.get("conditions", []))
+        labels = node["metadata"].get("labels") or {}
+        nodes.append({
+            "name": name,
+            "ready": ready,
+            "roles": sorted(label.split("/", 1)[1] for label in labels if label.startswith("node-role.kubernetes.io/")),
+            "unschedulable": node.get("spec", {}).get("unschedulable", False),
+            "cpu_cores": cpu,
+            "memory_bytes": memory,
+            "pods": len(pod_requests),
+            "max_pods": int(parse_quantity(allocatable.get("pods"))),
+        })
+        for key, resource in (("cpu", cpu), ("memory", memory)):
+            totals[f"{key}_allocatable"] += resource["allocatable"]
+            totals[f"{key}_requested"] += resource["requested"]
+            if resource["used"] is not None:
+                totals[f"{key}_used"] += resource["used"]
+
+    postgres = []
+    for namespace, name in postgres_releases:
+        workloads = [
+            {
+                "kind": kind,
+                "name": obj["metadata"]["name"],
+                "replicas": obj.get("spec", {}).get("replicas", 1),
+                "ready_replicas": obj.get("status", {}).get("readyReplicas", 0),
+            }
+            for kind, key in (("StatefulSet", "statefulsets"), ("Deployment", "deployments"))
+            for obj in raw[key]
+            if obj["metadata"].get("namespace") == namespace and _release_of(obj) == name
+        ]
+        targets = {workload["name"] for workload in workloads}
+        hpas = [
+            _hpa_summary(hpa) for hpa in raw["hpas"]
+            if hpa["metadata"].get("namespace") == namespace
+            and (hpa.get("spec", {}).get("scaleTargetRef", {}).get("name") in targets or _release_of(hpa) == name)
+        ]
+        postgres.append({
+            "name": name,
+            "namespace": namespace,
+            "replicas": sum(workload["replicas"] for workload in workloads),
+            "ready_replicas": sum(workload["ready_replicas"] for workload in workloads),
+            "healthy": bool(workloads) and all(w["ready_replicas"] >= w["replicas"] for w in workloads),
+            "workloads": workloads,
+            "hpa": hpas[0] if hpas else None,
+        })
+
+    has_usage = used is not None
+    return {
+        "nodes_total": len(nodes),
+        "nodes_ready": sum(node["ready"] for node in nodes),
+        "cpu_cores": _resource(totals["cpu_allocatable"], totals["cpu_requested"], totals["cpu_used"] if has_usage else None),
+        "memory_bytes": _resource(totals["memory_allocatable"], totals["memory_requested"], totals["memory_used"] if has_usage else None),
+        "pods": {"total": len(raw["pods"]), **dict(sorted(phases.items()))},
+        "metrics_available": has_usage,
+        "nodes": nodes,
+        "postgres": postgres,
+    }
+
+
+class ClusterStatus:
+    def __init__(self, ttl=STATUS_TTL):
+        self.cache = TTLCache(ttl)
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def collect(self, vm, use_kube_api=True):
+        if use_kube_api:
+            return kube_clients.call(vm, collect_with_kube_api)
+        with ssh_pool.connection(vm.ip_address, vm.username, vm.password) as client:
+            return collect_with_ssh(client)
+
+    def get(self, cluster_id, vm, postgres_releases=(), use_kube_api=True, refresh=False):
+        """Cached snapshot of the cluster whose k3s server is `vm`, collected at most once per TTL."""
+        def load():
+            start = time.perf_counter()
+            raw = self.collect(vm, use_kube_api)
+            snapshot = summarize(raw, postgres_releases)
+            snapshot["collected_at"] = time.time()
+            snapshot["collect_seconds"] = round(time.perf_counter() - start, 3)
+            print(f"Collected status of {cluster_id} in {snapshot['collect_seconds']}s")
+            return snapshot
+
+        with self._lock:
+            cluster_lock = self._locks[cluster_id]
+        # Whoever waited here gets the snapshot the first caller just collected
+        with cluster_lock:
+            if refresh:
+                self.cache.invalidate(cluster_id)
+            snapshot = self.cache.get((cluster_id, tuple(postgres_releases), use_kube_api), load)
+        return {"cluster_id": cluster_id, "age_seconds": round(time.time() - snapshot["collected_at"], 1), **snapshot}
+
+
+cluster_status = ClusterStatus()
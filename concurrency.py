@@ -0,0 +1,44 @@
+# concurrency.py
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from jobs import report_progress
+
+
+def _timed_call(fn, item):
+    start = time.perf_counter()
+    outcome = {"ok": True, "result": None, "error": None, "started_at": time.time()}
+    try:
+        outcome["result"] = fn(item)
+    except Exception as e:
+        outcome["ok"] = False
+        outcome["error"] = getattr(e, "detail", None) or str(e)
+    outcome["duration_seconds"] = round(time.perf_counter() - start, 3)
+    return outcome
+
+
+def fan_out(fn, items, max_concurrency, label=None):
+    """
+    Call fn(item) for every item with at most max_concurrency calls in flight.
+
+    A failing item never aborts the others: each outcome is a dict with ok,
+    result, error, started_at and duration_seconds, in the order of `items`.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    outcomes = [None] * len(items)
+    workers = min(max_concurrency, len(items))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fan-out") as executor:
+        # Each call gets its own copy of the caller's context (job, trace id, ...)
+        futures = {
+            executor.submit(contextvars.copy_context().run, _timed_call, fn, item): index
+            for index, item in enumerate(items)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            outcomes[futures[future]] = future.result()
+            if label:
+                report_progress(100 * done // len(items), f"{done}/{len(items)} {label}")
+    return outcomes
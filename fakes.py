@@ -0,0 +1,512 @@
+# fakes.py
+"""
+In-process stand-ins for the Azure management clients and for SSH.
+
+Every begin_create_or_update returns a poller whose result() blocks until
+`latency` seconds after the operation was started, like a real ARM
+long-running operation. Calls can be made to fail with a 429 (with a
+Retry-After header) or a 500 at a configurable rate.
+
+FakeSSHServer plays the VMs: clients from its client_factory() plug into
+the SSH pool and answer commands after a per-program delay, and its
+open_connection() stands in for asyncio's in the readiness prober. Hosts
+that ran the k3s installer show up as Ready nodes in kubectl. Used by
+benchmark.py to measure the API without spending Azure money.
+"""
+import asyncio
+import io
+import ipaddress
+import json
+import random
+import shlex
+import threading
+import time
+from types import SimpleNamespace
+
+import paramiko
+
+
+def _namespace(value):
+    """Turn request dicts into attribute objects shaped like the SDK models."""
+    if isinstance(value, dict):
+        return SimpleNamespace(**{key: _namespace(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [_namespace(item) for item in value]
+    return value
+
+
+def _merge(base, patch):
+    merged = dict(base)
+    for key, item in patch.items():
+        merged[key] = _merge(merged[key], item) if isinstance(item, dict) and isinstance(merged.get(key), dict) else item
+    return merged
+
+
+class FakeHttpResponseError(Exception):
+    """Same shape as azure.core.exceptions.HttpResponseError: status_code and response.headers."""
+
+    def __init__(self, status_code, message, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        headers = {"Retry-After": str(retry_after)} if retry_after is not None else {}
+        self.response = SimpleNamespace(status_code=status_code, headers=headers)
+
+
+class FakePoller:
+    def __init__(self, value, latency):
+        self._value = value
+        self._ready_at = time.monotonic() + latency
+
+    def result(self):
+        remaining = self._ready_at - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        return self._value
+
+    def done(self):
+        return time.monotonic() >= self._ready_at
+
+
+class FakeAzure:
+    """Shared resource store for all fake clients of one subscription."""
+
+    def __init__(self, latency=0.0, subscription_id="00000000-0000-0000-0000-000000000000",
+                 throttle_rate=0.0, failure_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.subscription_id = subscription_id
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self.retry_after = retry_after
+        self.resources = {}
+        self.calls = []
+        self.throttled = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._next_ip = 1
+        # (subnet id, private IP) -> NIC holding it
+        self._private_ips = {}
+
+    def maybe_fail(self, operation):
+        """Raise an injected 429 or 500 for this call, if the dice say so."""
+        with self._lock:
+            roll = self._random.random()
+            if roll < self.throttle_rate:
+                self.throttled += 1
+                error = FakeHttpResponseError(429, f"Too many requests: {operation}", self.retry_after)
+            elif roll < self.throttle_rate + self.failure_rate:
+                self.failed += 1
+                error = FakeHttpResponseError(500, f"Internal server error: {operation}")
+            else:
+                return
+        raise error
+
+    def resource_id(self, rg, provider, *names):
+        path = "/".join(names)
+        return f"/subscriptions/{self.subscription_id}/resourceGroups/{rg}/providers/{provider}/{path}"
+
+    def put(self, kind, rg, name, value):
+        with self._lock:
+            self.calls.append((kind, rg, name))
+            self.resources[(kind, rg, name)] = value
+        return value
+
+    def list(self, kind, rg):
+        with self._lock:
+            self.calls.append((f"list:{kind}", rg, None))
+            return [value for (k, r, _), value in self.resources.items() if k == kind and r == rg]
+
+    def allocate_private_ip(self, subnet_id, nic_id, address=None):
+        """
+        Like Azure: a static `address` fails when another NIC has it, a dynamic
+        one gets the lowest free address after the 4 the subnet reserves.
+        """
+        with self._lock:
+            subnet = next(value for (kind, _, _), value in self.resources.items() if kind == "subnet" and value.id == subnet_id)
+            network = ipaddress.ip_network(subnet.address_prefix)
+            for key, holder in list(self._private_ips.items()):
+                if holder == nic_id and key[0] == subnet_id:
+                    if address is None or key[1] == address:
+                        return key[1]
+                    del self._private_ips[key]
+            if address is None:
+                address = next(str(ip) for ip in list(network)[4:-1] if (subnet_id, str(ip)) not in self._private_ips)
+            elif (subnet_id, address) in self._private_ips:
+                raise FakeHttpResponseError(400, f"PrivateIPAddressInUse: {address} is used by {self._private_ips[subnet_id, address]}")
+            self._private_ips[subnet_id, address] = nic_id
+            return address
+
+    def allocate_ip(self):
+        with self._lock:
+            ip = f"20.0.{self._next_ip // 250}.{self._next_ip % 250 + 1}"
+            self._next_ip += 1
+        return ip
+
+
+class _ResourceGroups:
+    def __init__(self, azure):
+        self._azure = azure
+
+    def create_or_update(self, rg, params):
+        self._azure.maybe_fail("resource_groups.create_or_update")
+        value = SimpleNamespace(name=rg, location=params.get("location"), id=f"/subscriptions/{self._azure.subscription_id}/resourceGroups/{rg}")
+        return self._azure.put("resource_group", rg, rg, value)
+
+    def check_existence(self, rg):
+        return ("resource_group", rg, rg) in self._azure.resources
+
+
+class _Operations:
+    kind = None
+    provider = None
+
+    def __init__(self, azure):
+        self._azure = azure
+
+    def build(self, rg, name, params):
+        value = _namespace(params)
+        value.name = name
+        value.id = self._azure.resource_id(rg, self.provider, name)
+        value.params = params
+        return value
+
+    def begin_create_or_update(self, rg, name, params):
+        self._azure.maybe_fail(f"{self.kind}.begin_create_or_update")
+        value = self._azure.put(self.kind, rg, name, self.build(rg, name, params))
+        return FakePoller(value, self._azure.latency)
+
+    def begin_update(self, rg, name, params):
+        self._azure.maybe_fail(f"{self.kind}.begin_update")
+        # PATCH semantics: nested objects are merged, not replaced
+        current = self._azure.resources[(self.kind, rg, name)]
+        value = self.build(rg, name, _merge(current.params, params))
+        return FakePoller(self._azure.put(self.kind, rg, name, value), self._azure.latency)
+
+    def list(self, rg):
+        return self._azure.list(self.kind, rg)
+
+
+class _NetworkSecurityGroups(_Operations):
+    kind = "nsg"
+    provider = "Microsoft.Network/networkSecurityGroups"
+
+
+class _VirtualNetworks(_Operations):
+    kind = "vnet"
+    provider = "Microsoft.Network/virtualNetworks"
+
+    def list(self, rg):
+        vnets = super().list(rg)
+        subnets = self._azure.list("subnet", rg)
+        for vnet in vnets:
+            vnet.subnets = [subnet for subnet in subnets if subnet.id.startswith(vnet.id + "/")]
+        return vnets
+
+
+class _Subnets(_Operations):
+    kind = "subnet"
+    provider = "Microsoft.Network/virtualNetworks"
+
+    def begin_create_or_update(self, rg, vnet_name, name, params):
+        self._azure.maybe_fail("subnet.begin_create_or_update")
+        value = _namespace(params)
+        value.name = name
+        value.id = self._azure.resource_id(rg, self.provider, vnet_name, "subnets", name)
+        value.params = params
+        self._azure.put(self.kind, rg, f"{vnet_name}/{name}", value)
+        return FakePoller(value, self._azure.latency)
+
+
+class _PublicIPAddresses(_Operations):
+    kind = "public_ip"
+    provider = "Microsoft.Network/publicIPAddresses"
+
+    def build(self, rg, name, params):
+        value = super().build(rg, name, params)
+        label = params.get("dns_settings", {}).get("domain_name_label")
+        existing = self._azure.resources.get((self.kind, rg, name))
+        # A static IP keeps its address across updates
+        value.ip_address = existing.ip_address if existing else self._azure.allocate_ip()
+        value.dns_settings = SimpleNamespace(
+            domain_name_label=label,
+            fqdn=f"{label}.{params.get('location')}.cloudapp.azure.com" if label else None,
+        )
+        return value
+
+
+class _NetworkInterfaces(_Operations):
+    kind = "nic"
+    provider = "Microsoft.Network/networkInterfaces"
+
+    def build(self, rg, name, params):
+        value = super().build(rg, name, params)
+        for config in value.ip_configurations:
+            # Dynamic private IPs get the lowest free address of the subnet, static ones keep theirs
+            config.private_ip_address = self._azure.allocate_private_ip(config.subnet.id, value.id, getattr(config, "private_ip_address", None))
+        return value
+
+
+class _VirtualMachines(_Operations):
+    kind = "vm"
+    provider = "Microsoft.Compute/virtualMachines"
+
+
+class _VirtualMachineScaleSets(_Operations):
+    kind = "vmss"
+    provider = "Microsoft.Compute/virtualMachineScaleSets"
+
+
+class FakeNetworkClient:
+    def __init__(self, azure):
+        self.network_security_groups = _NetworkSecurityGroups(azure)
+        self.virtual_networks = _VirtualNetworks(azure)
+        self.subnets = _Subnets(azure)
+        self.public_ip_addresses = _PublicIPAddresses(azure)
+        self.network_interfaces = _NetworkInterfaces(azure)
+
+
+class FakeComputeClient:
+    def __init__(self, azure):
+        self.virtual_machines = _VirtualMachines(azure)
+        self.virtual_machine_scale_sets = _VirtualMachineScaleSets(azure)
+
+
+class FakeResourceClient:
+    def __init__(self, azure):
+        self.resource_groups = _ResourceGroups(azure)
+
+
+def fake_clients(latency=0.0, **options):
+    """Return (resource_client, network_client, compute_client) sharing one fake subscription."""
+    azure = FakeAzure(latency=latency, **options)
+    return FakeResourceClient(azure), FakeNetworkClient(azure), FakeComputeClient(azure)
+
+
+# SSH
+
+class _FakeChannel:
+    """The subset of paramiko.Channel that remote.run_command reads from."""
+
+    def __init__(self, stdout, stderr, exit_status, duration):
+        self._stdout = io.BytesIO(stdout)
+        self._stderr = io.BytesIO(stderr)
+        self._exit_status = exit_status
+        self._done_at = time.monotonic() + duration
+
+    def _finished(self):
+        return time.monotonic() >= self._done_at
+
+    def recv_ready(self):
+        return self._finished() and self._stdout.tell() < len(self._stdout.getbuffer())
+
+    def recv(self, size):
+        return self._stdout.read(size)
+
+    def recv_stderr_ready(self):
+        return self._finished() and self._stderr.tell() < len(self._stderr.getbuffer())
+
+    def recv_stderr(self, size):
+        return self._stderr.read(size)
+
+    def exit_status_ready(self):
+        return self._finished()
+
+    def recv_exit_status(self):
+        remaining = self._done_at - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        return self._exit_status
+
+    def close(self):
+        pass
+
+
+class _FakeTransport:
+    def __init__(self, host):
+        self.active = True
+        self.host = host
+
+    def getpeername(self):
+        return (self.host, 22)
+
+    def is_active(self):
+        return self.active
+
+    def send_ignore(self):
+        if not self.active:
+            raise EOFError("transport closed")
+
+    def set_keepalive(self, interval):
+        pass
+
+
+class _FakeSFTP:
+    def __init__(self, server, host):
+        self._server = server
+        self._host = host
+
+    def put(self, local_path, remote_path):
+        with open(local_path, "rb") as f:
+            data = f.read()
+        self._server.files[self._host, remote_path] = data
+        time.sleep(self._server.command_latency)
+
+    def putfo(self, fileobj, remote_path):
+        self._server.files[self._host, remote_path] = fileobj.read()
+
+    def close(self):
+        pass
+
+
+class _FakeStreamWriter:
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+class FakeSSHClient:
+    def __init__(self, server):
+        self._server = server
+        self._transport = None
+        self.host = None
+
+    def set_missing_host_key_policy(self, policy):
+        pass
+
+    def connect(self, host, username=None, password=None, **kwargs):
+        self._server.connect(host, password)
+        self.host = host
+        self._transport = _FakeTransport(host)
+
+    def get_transport(self):
+        return self._transport
+
+    def exec_command(self, command, **kwargs):
+        stdout, stderr, exit_status, duration = self._server.run(self.host, command)
+        channel = _FakeChannel(stdout, stderr, exit_status, duration)
+        out = SimpleNamespace(channel=channel, read=lambda size=-1: channel.recv(size))
+        err = SimpleNamespace(channel=channel, read=lambda size=-1: channel.recv_stderr(size))
+        return None, out, err
+
+    def open_sftp(self):
+        return _FakeSFTP(self._server, self.host)
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.active = False
+
+
+class FakeSSHServer:
+    """
+    Stand-in for every VM's sshd. Commands take `command_latency` seconds
+    unless a rule matches: slow={"curl": 2.0} makes anything containing
+    "curl" take 2s. Hosts in `unreachable` refuse connections and commands
+    fail (exit 1) at `failure_rate`. With `password` set (one for every host,
+    or a dict per host), logins with any other password are rejected. Every host that runs the k3s installer
+    joins one fake cluster that answers kubectl get nodes and /readyz, and
+    helm status knows the releases installed with helm upgrade --install.
+    """
+
+    def __init__(self, handshake_latency=0.0, command_latency=0.0, slow=None, output_bytes=256,
+                 failure_rate=0.0, unreachable=(), seed=None, password=None):
+        self.handshake_latency = handshake_latency
+        self.command_latency = command_latency
+        self.slow = dict(slow or {})
+        self.output_bytes = output_bytes
+        self.failure_rate = failure_rate
+        self.unreachable = set(unreachable)
+        self.password = password
+        self.handshakes = 0
+        self.commands = []
+        self.files = {}
+        self.k3s_nodes = {}
+        # (host, namespace, release) installed with helm upgrade --install
+        self.helm_releases = set()
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+    def client_factory(self):
+        return FakeSSHClient(self)
+
+    async def open_connection(self, host, port):
+        await asyncio.sleep(self.handshake_latency / 2)
+        if host in self.unreachable:
+            raise ConnectionRefusedError(f"[Errno 111] Connection refused: {host}:{port}")
+        reader = asyncio.StreamReader()
+        if port == 22:
+            reader.feed_data(b"SSH-2.0-OpenSSH_8.9p1 Ubuntu-3ubuntu0.10\r\n")
+        reader.feed_eof()
+        return reader, _FakeStreamWriter()
+
+    @staticmethod
+    def hostname(host):
+        return "vm-" + host.replace(".", "-")
+
+    def _k3s_output(self, host, command):
+        if "get.k3s.io" in command or "INSTALL_K3S_SKIP_DOWNLOAD" in command:
+            with self._lock:
+                self.k3s_nodes[host] = self.hostname(host)
+            return None
+        if command.strip() == "hostname":
+            return self.hostname(host) + "\n"
+        if "/readyz" in command:
+            return "ok\n"
+        if "helm upgrade --install" in command or "helm status" in command:
+            args = shlex.split(command.split("helm ", 1)[1].split(";")[0])
+            name = args[args.index("--install") + 1] if "--install" in args else args[1]
+            release = (host, args[args.index("--namespace") + 1], name)
+            with self._lock:
+                if args[0] == "upgrade":
+                    self.helm_releases.add(release)
+                    return None
+                return json.dumps({"info": {"status": "deployed"}} if release in self.helm_releases else {}) + "\n"
+        if "get nodes,pods" in command:
+            return self._k3s_status()
+        if "get nodes" in command:
+            with self._lock:
+                return "".join(f"{name}\tTrue\n" for name in self.k3s_nodes.values())
+        return None
+
+    def _k3s_status(self):
+        """What cluster_status.collect_with_ssh reads: nodes and their pods as JSON, then node metrics."""
+        with self._lock:
+            names = list(self.k3s_nodes.values())
+        nodes, pods, usage = [], [], []
+        for name in names:
+            nodes.append({"kind": "Node", "metadata": {"name": name, "labels": {}},
+                          "status": {"allocatable": {"cpu": "2", "memory": "8Gi", "pods": "110"},
+                                     "conditions": [{"type": "Ready", "status": "True"}]}})
+            pods.append({"kind": "Pod", "metadata": {"name": f"pod-{name}", "namespace": "default"},
+                         "spec": {"nodeName": name, "containers": [{"resources": {"requests": {"cpu": "250m", "memory": "256Mi"}}}]},
+                         "status": {"phase": "Running"}})
+            usage.append({"metadata": {"name": name}, "usage": {"cpu": "500000000n", "memory": "2097152Ki"}})
+        return json.dumps({"kind": "List", "items": nodes + pods}) + "\n---node-metrics---\n" + json.dumps({"items": usage}) + "\n"
+
+    def connect(self, host, password=None):
+        time.sleep(self.handshake_latency)
+        if host in self.unreachable:
+            raise ConnectionRefusedError(f"[Errno 111] Connection refused: {host}:22")
+        expected = self.password.get(host) if isinstance(self.password, dict) else self.password
+        if expected is not None and password != expected:
+            raise paramiko.AuthenticationException("Authentication failed.")
+        with self._lock:
+            self.handshakes += 1
+
+    def run(self, host, command):
+        with self._lock:
+            self.commands.append((host, command))
+            failed = self._random.random() < self.failure_rate
+        duration = self.command_latency
+        for needle, seconds in self.slow.items():
+            if needle in command:
+                duration = max(duration, seconds)
+        if failed:
+            return b"", b"injected failure\n", 1, duration
+        if "node-token" in command:
+            return b"K10fake::server:token\n", b"", 0, duration
+        k3s = self._k3s_output(host, command)
+        if k3s is not None:
+            return k3s.encode(), b"", 0, duration
+        return (b"x" * (self.output_bytes - 1)) + b"\n", b"", 0, duration
@@ -0,0 +1,185 @@
+# helm_releases.py
+"""
+Install a set of Helm releases on a k3s server as a DAG.
+
+All chart repos are added first with a single `helm repo update`, then
+every release whose dependencies are done is installed in parallel, each
+on its own pooled SSH connection. Releases run with --wait --atomic, so a
+release only counts as deployed once its pods are up, and a failed one is
+rolled back instead of being left half-installed. Releases that depend on
+a failed one are skipped.
+
+Values go in a values file uploaded over SFTP instead of --set flags, so
+passwords never show up on a command line. Each deployed release's values
+hash is kept in the cluster registry; running the same release again with
+the same chart and values is a no-op unless forced, or `helm status` says
+the release isn't actually deployed.
+
+    releases = [
+        Release("prometheus", "prometheus-community/kube-prometheus-stack", "monitoring",
+                repo=("prometheus-community", "https://prometheus-community.github.io/helm-charts")),
+        Release("grafana", "grafana/grafana", "monitoring", repo=("grafana", "https://grafana.github.io/helm-charts")),
+    ]
+    result = install_releases(vm, releases)
+"""
+import hashlib
+import io
+import json
+import shlex
+import uuid
+
+import yaml
+
+from pipeline import DagScheduler
+from registry import registry
+from remote import run_command
+from ssh_pool import ssh_pool
+
+KUBECONFIG_ENV = "export KUBECONFIG=/etc/rancher/k3s/k3s.yaml"
+# ssh_pool keeps at most 4 connections per host
+MAX_PARALLEL = 4
+RELEASE_TIMEOUT = "10m"
+REPOS_STAGE = "helm-repos"
+REMOTE_VALUES_DIR = "/tmp/helm-values"
+
+
+class Release:
+    def __init__(self, name, chart, namespace="default", repo=None, version=None, args=(), depends_on=(), timeout=RELEASE_TIMEOUT, values=None):
+        self.name = name
+        self.chart = chart
+        self.namespace = namespace
+        # (name, url) of the chart repo, None for a local chart
+        self.repo = repo
+        self.version = version
+        self.args = list(args)
+        self.depends_on = list(depends_on)
+        self.timeout = timeout
+        self.values = values
+
+    @property
+    def stage(self):
+        # "/" can't be in a Kubernetes name, so no two namespace/name pairs share a stage
+        return f"release-{self.namespace}/{self.name}"
+
+    @property
+    def values_hash(self):
+        """Changes whenever a re-run would change what Helm installs."""
+        spec = {"chart": self.chart, "version": self.version, "args": self.args, "values": self.values}
+        return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+
+    def command(self, values_file=None):
+        # upgrade --install so running it again updates the release instead of failing
+        parts = [
+            "upgrade", "--install", self.name, self.chart,
+            "--namespace", self.namespace, "--create-namespace",
+            "--wait", "--atomic", "--timeout", self.timeout,
+        ]
+        if self.version:
+            parts += ["--version", self.version]
+        if values_file:
+            parts += ["--values", values_file]
+        return f"{KUBECONFIG_ENV} && helm {shlex.join(parts + self.args)}"
+
+
+def add_repos(vm, repos):
+    """Add every repo, then fetch all their indexes in one `helm repo update`."""
+    adds = [f"helm repo add --force-update {shlex.quote(name)} {shlex.quote(url)}" for name, url in sorted(repos.items())]
+    with ssh_pool.connection(vm.ip_address, vm.username, vm.password) as client:
+        result = run_command(client, " && ".join([KUBECONFIG_ENV, *adds, "helm repo update"]))
+    if not result.ok:
+        raise Exception(f"helm repo update failed: {result.stderr.strip()}")
+    return sorted(repos)
+
+
+def _run_with_values(client, release):
+    """Upload the values to a private directory, run Helm with them, remove them again."""
+    directory = f"{REMOTE_VALUES_DIR}-{uuid.uuid4().hex[:8]}"
+    values_file = f"{directory}/{release.name}.yaml"
+    run_command(client, f"mkdir -m 700 -p {directory}")
+    sftp = client.open_sftp()
+    try:
+        sftp.putfo(io.BytesIO(yaml.safe_dump(release.values, default_flow_style=False).encode()), values_file)
+    finally:
+        sftp.close()
+    return run_command(client, f"{release.command(values_file)}; status=$?; rm -rf {directory}; exit $status")
+
+
+def helm_deployed(client, release):
+    """Whether Helm on the server has the release deployed. The registry can't know if k3s was reinstalled."""
+    result = run_command(client, f"{KUBECONFIG_ENV} && helm status {shlex.quote(release.name)} --namespace {shlex.quote(release.namespace)} -o json", timeout=60)
+    if not result.ok:
+        return False
+    try:
+        return json.loads(result.stdout)["info"]["status"] == "deployed"
+    except (ValueError, KeyError, TypeError):
+        return False
+
+
+def install_release(vm, release, force=False):
+    with ssh_pool.connection(vm.ip_address, vm.username, vm.password) as client:
+        if not force:
+            current = registry.release(vm.ip_address, release.name, release.namespace)
+            if (current is not None and current["status"] == "deployed" and current["values_hash"] == release.values_hash
+                    and helm_deployed(client, release)):
+                print(f"Release {release.namespace}/{release.name} is up to date, skipping")
+                return {"unchanged": True}
+        if release.values is not None:
+            result = _run_with_values(client, release)
+        else:
+            result = run_command(client, release.command())
+    print(f"Release {release.namespace}/{release.name}: exit {result.exit_status} in {result.duration:.1f}s")
+    if not result.ok:
+        # --atomic already rolled it back, keep the reason
+        raise Exception(f"helm upgrade --install {release.name} failed: {result.stderr.strip()[-2000:]}")
+    return {"unchanged": False, "output": result.stdout[-2000:]}
+
+
+def plan_releases(vm, releases, max_parallel=MAX_PARALLEL, force=False):
+    """DagScheduler with one stage per release, callers can add their own stages after them."""
+    scheduler = DagScheduler()
+    scheduler.limit("helm", max_parallel)
+    repos = dict(release.repo for release in releases if release.repo)
+    if repos:
+        scheduler.add(REPOS_STAGE, lambda inputs: add_repos(vm, repos))
+    # depends_on names releases in the same namespace
+    stages = {(release.namespace, release.name): release.stage for release in releases}
+    for release in releases:
+        missing = [name for name in release.depends_on if (release.namespace, name) not in stages]
+        if missing:
+            raise ValueError(f"Release {release.name} depends on unknown releases {sorted(missing)}")
+        depends_on = ([REPOS_STAGE] if release.repo else []) + [stages[release.namespace, name] for name in release.depends_on]
+        scheduler.add(release.stage, lambda inputs, release=release: install_release(vm, release, force), depends_on=depends_on, group="helm")
+    return scheduler
+
+
+def install_releases(vm, releases, max_parallel=MAX_PARALLEL, scheduler=None, force=False):
+    """
+    Run the releases (and any extra stages on `scheduler` from plan_releases)
+    and record each one in the cluster registry. Returns the scheduler report
+    with a per-release summary under "releases". A release whose chart and
+    values didn't change since its last deploy is "unchanged", unless forced.
+    """
+    if scheduler is None:
+        scheduler = plan_releases(vm, releases, max_parallel, force)
+    report = scheduler.run()
+    summary = []
+    for release in releases:
+        stage = report["stages"][release.stage]
+        status = {"succeeded": "deployed", "failed": "failed"}.get(stage["status"], "skipped")
+        if status == "deployed" and scheduler.stages[release.stage].result["unchanged"]:
+            status = "unchanged"
+        elif status == "deployed":
+            registry.record_release(vm.ip_address, release.name, release.namespace, release.chart, status, release.values_hash)
+        elif status == "failed":
+            # No hash, so the next run tries again
+            registry.record_release(vm.ip_address, release.name, release.namespace, release.chart, status)
+        summary.append({
+            "name": release.name,
+            "namespace": release.namespace,
+            "chart": release.chart,
+            "status": status,
+            "start_offset_seconds": stage["start_offset_seconds"],
+            "duration_seconds": stage["duration_seconds"],
+            "error": stage["error"],
+        })
+    return {**report, "releases": summary}
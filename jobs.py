@@ -0,0 +1,205 @@
+# jobs.py
+"""
+Background jobs for the long-running endpoints.
+
+POST /jobs/<endpoint> hands the work to a bounded thread pool and returns a
+job id straight away; GET /jobs/{job_id} reports status, progress and the
+result. Work functions can call report_progress() and publish_output()
+from anywhere inside the job, both are no-ops when the code runs as a
+plain synchronous request.
+"""
+import contextvars
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import JOB_SECONDS, current_trace_id, observe
+
+# Number of jobs that actually run at once, the rest wait in the queue
+MAX_WORKERS = int(os.environ.get("JOB_WORKERS", "32"))
+# Finished jobs kept around for GET /jobs/{job_id} before the oldest are dropped
+MAX_FINISHED_JOBS = 500
+# Live command output kept per job for GET /jobs/{job_id}/output, oldest chunks dropped first
+MAX_OUTPUT_BYTES = 256 * 1024
+
+# Result fields that stay out of stored jobs: anyone with the job id can read them
+_SECRET_FIELD = re.compile(r"token|password|passwd|secret", re.IGNORECASE)
+REDACTED = "***"
+
+_current_job = contextvars.ContextVar("current_job", default=None)
+_progress_muted = contextvars.ContextVar("progress_muted", default=False)
+
+
+class JobOutput:
+    """Bounded, followable log of the output a job produced so far."""
+
+    def __init__(self, capacity=MAX_OUTPUT_BYTES):
+        self.capacity = capacity
+        self.closed = False
+        self._chunks = deque()
+        self._size = 0
+        self._next_seq = 0
+        self._cond = threading.Condition()
+
+    def write(self, text):
+        if not text:
+            return
+        with self._cond:
+            self._chunks.append((self._next_seq, text))
+            self._next_seq += 1
+            self._size += len(text)
+            while self._size > self.capacity and len(self._chunks) > 1:
+                _, dropped = self._chunks.popleft()
+                self._size -= len(dropped)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def read(self, after_seq=-1, timeout=None):
+        """Chunks newer than after_seq as [(seq, text)], waiting up to timeout for one to arrive."""
+        with self._cond:
+            if not self.closed and (not self._chunks or self._chunks[-1][0] <= after_seq):
+                self._cond.wait(timeout)
+            return [chunk for chunk in self._chunks if chunk[0] > after_seq], self.closed
+
+
+class Job:
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "queued"
+        self.progress = 0
+        self.message = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.output = JobOutput()
+        self.trace_id = current_trace_id()
+
+    @property
+    def finished(self):
+        return self.status in ("succeeded", "failed")
+
+    def report(self, progress, message=None):
+        self.progress = max(0, min(100, int(progress)))
+        if message is not None:
+            self.message = message
+
+    def to_dict(self, include_result=True):
+        job = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "trace_id": self.trace_id,
+            "status": self.status,
+            "progress": self.progress,
+            "message": self.message,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if not include_result:
+            # Listings stay small, the result is on GET /jobs/{job_id}
+            del job["result"]
+        return job
+
+
+def without_secrets(value):
+    """Copy of a job result with the values of secret-looking keys (token, password, ...) replaced."""
+    if isinstance(value, dict):
+        return {key: REDACTED if isinstance(key, str) and _SECRET_FIELD.search(key) and value[key] is not None
+                else without_secrets(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [without_secrets(item) for item in value]
+    return value
+
+
+def current_job():
+    return _current_job.get()
+
+
+def report_progress(progress, message=None):
+    """Update the progress (0-100) of the job running in this context, if any."""
+    job = _current_job.get()
+    if job is not None and not _progress_muted.get():
+        job.report(progress, message)
+
+
+def publish_output(text):
+    """Append command output to the live log of the job running in this context, if any."""
+    job = _current_job.get()
+    if job is not None:
+        job.output.write(text)
+
+
+@contextmanager
+def quiet_progress():
+    """Ignore report_progress() calls inside the block, used when a caller reports progress itself."""
+    token = _progress_muted.set(True)
+    try:
+        yield
+    finally:
+        _progress_muted.reset(token)
+
+
+class JobManager:
+    def __init__(self, max_workers=MAX_WORKERS, max_finished=MAX_FINISHED_JOBS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_finished = max_finished
+
+    def submit(self, kind, fn, *args, **kwargs):
+        job = Job(kind)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._evict()
+        # Run inside a copy of the caller's context so context variables survive the thread hop
+        context = contextvars.copy_context()
+        self._executor.submit(context.run, self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _run(self, job, fn, args, kwargs):
+        _current_job.set(job)
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            job.result = without_secrets(fn(*args, **kwargs))
+            job.progress = 100
+            job.status = "succeeded"
+        except Exception as e:
+            # HTTPException carries the useful message in .detail, some errors keep a partial result
+            job.error = getattr(e, "detail", None) or str(e)
+            job.result = without_secrets(getattr(e, "result", None))
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            job.output.close()
+            observe(JOB_SECONDS, job.finished_at - job.started_at, kind=job.kind, outcome=job.status)
+
+    def _evict(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self._max_finished)]:
+            del self._jobs[job_id]
+
+
+job_manager = JobManager()
@@ -0,0 +1,244 @@
+# journal.py
+"""
+Persistent log of every command run over SSH.
+
+run_command() adds one entry per command: host, command with secrets
+redacted, exit status, duration, output sizes and the last OUTPUT_TAIL
+bytes of output zlib-compressed. Entries go on a queue and a background
+thread appends them in batches to a JSONL file, so a request never waits
+on the disk. The file is rotated at MAX_BYTES and old files are gzipped,
+keeping at most BACKUPS of them.
+
+GET /executions filters the entries, GET /executions/summary gives
+per-command counts, failure rates and latency percentiles.
+"""
+import atexit
+import base64
+import gzip
+import json
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from jobs import current_job
+from metrics import command_label, current_trace_id
+
+JOURNAL_DIR = Path(os.environ.get("EXECUTION_JOURNAL_DIR", Path.home() / ".cache" / "k3s-api" / "executions"))
+MAX_BYTES = int(os.environ.get("EXECUTION_JOURNAL_MAX_BYTES", 10 * 1024 * 1024))
+BACKUPS = int(os.environ.get("EXECUTION_JOURNAL_BACKUPS", 5))
+OUTPUT_TAIL = 4 * 1024
+FLUSH_INTERVAL = 1.0
+BATCH_SIZE = 500
+QUEUE_SIZE = 10000
+REDACTED = "***"
+
+# Values of secret-looking settings: K3S_TOKEN=..., --set postgres.password=..., admin_password: ...
+# and flags: --token ..., --password ...
+_SECRET_VALUE = r"""(?P<value>'[^']*'|"[^"]*"|[^\s'";&|]+)"""
+_SECRET_ASSIGNMENT = re.compile(r"(?P<key>[\w.-]*(?:password|passwd|secret|token|api_?key)[\w.-]*['\"]?(?:=|:\s*))" + _SECRET_VALUE, re.IGNORECASE)
+_SECRET_FLAG = re.compile(r"(?P<key>--[\w-]*(?:password|passwd|secret|token)[\w-]*\s+)" + _SECRET_VALUE, re.IGNORECASE)
+# Commands whose output is itself a secret, only their sizes are kept
+_SECRET_OUTPUT = re.compile(r"node-token|get secret|k3s\.yaml|kubeconfig", re.IGNORECASE)
+
+
+def redact(text):
+    for pattern in (_SECRET_ASSIGNMENT, _SECRET_FLAG):
+        text = pattern.sub(lambda m: m.group("key") + REDACTED, text)
+    return text
+
+
+def secret_output(command):
+    """True for commands whose output is itself a secret (join token, kubeconfig, secrets)."""
+    return bool(_SECRET_OUTPUT.search(command))
+
+
+def compress(text):
+    return base64.b64encode(zlib.compress(text.encode(), 6)).decode()
+
+
+def decompress(data):
+    return zlib.decompress(base64.b64decode(data)).decode(errors="replace")
+
+
+class ExecutionJournal:
+    def __init__(self, directory=JOURNAL_DIR, max_bytes=MAX_BYTES, backups=BACKUPS,
+                 flush_interval=FLUSH_INTERVAL, batch_size=BATCH_SIZE, queue_size=QUEUE_SIZE):
+        self.directory = Path(directory)
+        self.path = self.directory / "executions.jsonl"
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file_lock = threading.Lock()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def record(self, host, command, exit_status, duration, stdout="", stderr="", stdout_bytes=0, stderr_bytes=0, outcome=None):
+        """Queue one execution, never blocks. Dropped (and counted) when the writer can't keep up."""
+        job = current_job()
+        entry = {
+            "ts": time.time(),
+            "host": host,
+            "command": redact(command),
+            "label": command_label(command),
+            "exit_status": exit_status,
+            "outcome": outcome or ("ok" if exit_status == 0 else "error"),
+            "duration_seconds": round(duration, 3),
+            "stdout_bytes": stdout_bytes,
+            "stderr_bytes": stderr_bytes,
+            "trace_id": current_trace_id(),
+            "job_id": job.id if job is not None else None,
+        }
+        if not secret_output(command):
+            tail = (stdout[-OUTPUT_TAIL:] + ("\n--- stderr ---\n" + stderr[-OUTPUT_TAIL:] if stderr else ""))
+            entry["output_tail"] = compress(redact(tail))
+        self._start()
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        if self._writer is not None:
+            return
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name="execution-journal", daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except OSError as e:
+                self.dropped += len(batch)
+                print(f"Execution journal write failed: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        data = "".join(json.dumps(entry, separators=(",", ":")) + "\n" for entry in batch)
+        with self._file_lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # Commands and output tails can still say more than we'd like, keep them private
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            with os.fdopen(fd, "a") as f:
+                f.write(data)
+                size = f.tell()
+            self.written += len(batch)
+            if size >= self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        """executions.jsonl -> executions.1.jsonl.gz, older files shift up, the last one is dropped."""
+        for index in range(self.backups - 1, 0, -1):
+            older = self.directory / f"executions.{index}.jsonl.gz"
+            if older.exists():
+                older.replace(self.directory / f"executions.{index + 1}.jsonl.gz")
+        if self.backups > 0:
+            rotated = self.directory / "executions.1.jsonl.gz"
+            with open(self.path, "rb") as src, gzip.open(rotated, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.chmod(rotated, 0o600)
+        self.path.unlink()
+
+    def flush(self):
+        """Wait until everything queued so far is on disk."""
+        if self._writer is not None:
+            self._queue.join()
+
+    def _files(self):
+        """Newest first."""
+        files = [self.path] + [self.directory / f"executions.{index}.jsonl.gz" for index in range(1, self.backups + 1)]
+        return [path for path in files if path.exists()]
+
+    def entries(self):
+        """Every stored entry, newest first. Files are read one at a time, so a small query stops early."""
+        for path in self._files():
+            opener = gzip.open if path.suffix == ".gz" else open
+            with self._file_lock:
+                try:
+                    with opener(path, "rt") as f:
+                        content = f.read()
+                except FileNotFoundError:
+                    # Rotated away since _files()
+                    continue
+            for line in reversed(content.splitlines()):
+                if line:
+                    yield json.loads(line)
+
+    def query(self, host=None, label=None, outcome=None, job_id=None, since=None, limit=100, include_output=False):
+        results = []
+        for entry in self.entries():
+            if since is not None and entry["ts"] < since:
+                break
+            if host and entry["host"] != host:
+                continue
+            if label and entry["label"] != label:
+                continue
+            if outcome and entry["outcome"] != outcome:
+                continue
+            if job_id and entry["job_id"] != job_id:
+                continue
+            tail = entry.pop("output_tail", None)
+            if include_output:
+                entry["output_tail"] = decompress(tail) if tail else None
+            results.append(entry)
+            if len(results) >= limit:
+                break
+        return results
+
+    def summary(self, since=None):
+        """Per command label: runs, failures, failure rate and duration percentiles."""
+        durations = {}
+        failures = {}
+        for entry in self.entries():
+            if since is not None and entry["ts"] < since:
+                break
+            durations.setdefault(entry["label"], []).append(entry["duration_seconds"])
+            if entry["outcome"] != "ok":
+                failures[entry["label"]] = failures.get(entry["label"], 0) + 1
+        summary = {}
+        for label, values in sorted(durations.items()):
+            values.sort()
+            summary[label] = {
+                "runs": len(values),
+                "failures": failures.get(label, 0),
+                "failure_rate": round(failures.get(label, 0) / len(values), 3),
+                "p50_seconds": values[len(values) // 2],
+                "p95_seconds": values[min(len(values) - 1, int(len(values) * 0.95))],
+                "max_seconds": values[-1],
+            }
+        return summary
+
+    def stats(self):
+        return {
+            "written": self.written,
+            "dropped": self.dropped,
+            "queued": self._queue.qsize(),
+            "files": [path.name for path in self._files()],
+            "bytes": sum(path.stat().st_size for path in self._files()),
+        }
+
+
+journal = ExecutionJournal()
@@ -0,0 +1,255 @@
+# kube_api.py
+"""
+Talk to the k3s API server on port 6443 directly instead of running
+kubectl over SSH.
+
+The kubeconfig is read from the server once and kept in the cluster
+registry. After that, reads, patches and server-side applies are HTTPS
+requests over a pooled requests.Session using the kubeconfig's client
+certificate. Helm still runs over SSH because it has no API.
+
+k3s's serving certificate doesn't list the VM's public IP, so the
+connection is verified against the cluster CA under the name "kubernetes",
+which is always in it.
+
+Where an object lives (plural name, namespaced or not) comes from API
+discovery, asked once per group/version and kept with the client, so
+custom resources and kinds with irregular plurals apply like any other.
+"""
+import base64
+import os
+import shutil
+import tempfile
+import threading
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import requests
+import yaml
+from requests.adapters import HTTPAdapter
+
+from registry import registry
+from ssh_pool import ssh_pool
+
+KUBECONFIG_PATH = "/etc/rancher/k3s/k3s.yaml"
+API_PORT = 6443
+CERT_NAME = "kubernetes"
+FIELD_MANAGER = "k3s-api"
+REQUEST_TIMEOUT = 30
+POOL_SIZE = 16
+
+_PATCH_TYPES = {
+    "strategic": "application/strategic-merge-patch+json",
+    "merge": "application/merge-patch+json",
+    "json": "application/json-patch+json",
+}
+
+
+class KubeApiError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(f"Kubernetes API returned {status_code}: {message}")
+        self.status_code = status_code
+
+
+class _CertNameAdapter(HTTPAdapter):
+    """Checks the server certificate for `server_hostname`, whatever address we connect to."""
+
+    def __init__(self, server_hostname, **kwargs):
+        self.server_hostname = server_hostname
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["server_hostname"] = self.server_hostname
+        super().init_poolmanager(*args, **kwargs)
+
+
+def api_base(api_version):
+    """/api/v1 for the core group, /apis/{group}/{version} for the others."""
+    return f"/apis/{api_version}" if "/" in api_version else f"/api/{api_version}"
+
+
+class KubeClient:
+    def __init__(self, server, ca_data, cert_data, key_data, pool_size=POOL_SIZE):
+        self.server = server.rstrip("/")
+        # requests wants the certificates as files
+        self._dir = tempfile.mkdtemp(prefix="kube-")
+        self._ca = self._write("ca.crt", ca_data)
+        self._cert = (self._write("client.crt", cert_data), self._write("client.key", key_data))
+        self.session = requests.Session()
+        self.session.mount("https://", _CertNameAdapter(CERT_NAME, pool_connections=1, pool_maxsize=pool_size))
+        # {api_version: {kind: (plural, namespaced)}} from discovery
+        self._resources = {}
+        self._resources_lock = threading.Lock()
+
+    @classmethod
+    def from_kubeconfig(cls, kubeconfig, host):
+        """Client for `host` using the first cluster/user of a k3s kubeconfig (which points at 127.0.0.1)."""
+        config = yaml.safe_load(kubeconfig)
+        cluster = config["clusters"][0]["cluster"]
+        user = config["users"][0]["user"]
+        port = urlparse(cluster["server"]).port or API_PORT
+        return cls(
+            f"https://{host}:{port}",
+            base64.b64decode(cluster["certificate-authority-data"]),
+            base64.b64decode(user["client-certificate-data"]),
+            base64.b64decode(user["client-key-data"]),
+        )
+
+    def _write(self, name, data):
+        path = os.path.join(self._dir, name)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return path
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+        # Per request, a session-level verify loses to REQUESTS_CA_BUNDLE from the environment
+        kwargs.setdefault("verify", self._ca)
+        kwargs.setdefault("cert", self._cert)
+        response = self.session.request(method, self.server + path, **kwargs)
+        if response.status_code >= 400:
+            try:
+                message = response.json().get("message", response.text)
+            except ValueError:
+                message = response.text
+            raise KubeApiError(response.status_code, message)
+        return response
+
+    def get(self, path, **params):
+        return self.request("GET", path, params=params or None).json()
+
+    def _discover(self, api_version):
+        listing = self.get(api_base(api_version))
+        # Subresources (pods/log, deployments/scale) repeat their parent's kind
+        resources = {
+            resource["kind"]: (resource["name"], resource["namespaced"])
+            for resource in listing.get("resources", []) if "/" not in resource["name"]
+        }
+        with self._resources_lock:
+            self._resources[api_version] = resources
+        return resources
+
+    def resource(self, api_version, kind):
+        """(plural, namespaced) of a kind, e.g. ("gateways", True) for gateway.networking.k8s.io/v1 Gateway."""
+        with self._resources_lock:
+            resources = self._resources.get(api_version)
+        if resources is None or kind not in resources:
+            # Not asked yet, or a CRD installed since the last time
+            resources = self._discover(api_version)
+        if kind not in resources:
+            raise KubeApiError(404, f"{api_version} has no kind {kind}")
+        return resources[kind]
+
+    def resource_path(self, manifest):
+        """API path of the object a manifest describes, e.g. /api/v1/namespaces/default/secrets/pg."""
+        plural, namespaced = self.resource(manifest["apiVersion"], manifest["kind"])
+        metadata = manifest["metadata"]
+        base = api_base(manifest["apiVersion"])
+        if not namespaced:
+            return f"{base}/{plural}/{metadata['name']}"
+        return f"{base}/namespaces/{metadata.get('namespace', 'default')}/{plural}/{metadata['name']}"
+
+    def readyz(self):
+        try:
+            return self.request("GET", "/readyz").text.strip() == "ok"
+        except (requests.RequestException, KubeApiError):
+            return False
+
+    def list_nodes(self):
+        return self.get("/api/v1/nodes")["items"]
+
+    def node_status(self):
+        """{node name: Ready?}, None while the API isn't answering. Same shape as readiness.node_status."""
+        try:
+            nodes = self.list_nodes()
+        except (requests.RequestException, KubeApiError):
+            return None
+        return {
+            node["metadata"]["name"]: any(
+                condition["type"] == "Ready" and condition["status"] == "True"
+                for condition in node.get("status", {}).get("conditions", [])
+            )
+            for node in nodes
+        }
+
+    def get_secret(self, namespace, name):
+        """The secret's data, base64-decoded."""
+        secret = self.get(f"/api/v1/namespaces/{namespace}/secrets/{name}")
+        return {key: base64.b64decode(value).decode() for key, value in (secret.get("data") or {}).items()}
+
+    def patch(self, path, body, patch_type="strategic"):
+        return self.request("PATCH", path, json=body, headers={"Content-Type": _PATCH_TYPES[patch_type]}).json()
+
+    def apply(self, manifest, field_manager=FIELD_MANAGER, force=True):
+        """Server-side apply: creates or updates the object in one request, no kubectl needed."""
+        return self.request(
+            "PATCH",
+            self.resource_path(manifest),
+            params={"fieldManager": field_manager, "force": str(force).lower()},
+            json=manifest,
+            headers={"Content-Type": "application/apply-patch+yaml"},
+        ).json()
+
+    def close(self):
+        self.session.close()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+def fetch_kubeconfig(vm):
+    # Not run_command: that would copy the client key into the job's live output
+    with ssh_pool.connection(vm.ip_address, vm.username, vm.password) as client:
+        stdin, stdout, stderr = client.exec_command(f"sudo cat {KUBECONFIG_PATH}")
+        kubeconfig = stdout.read().decode()
+        error = stderr.read().decode()
+        exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0 or not kubeconfig.strip():
+        raise Exception(f"Could not read {KUBECONFIG_PATH} on {vm.ip_address}: {error.strip()}")
+    return kubeconfig
+
+
+class KubeClients:
+    """One KubeClient per k3s server, created from its kubeconfig on first use."""
+
+    def __init__(self):
+        self._clients = {}
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def for_node(self, vm):
+        with self._lock:
+            client = self._clients.get(vm.ip_address)
+            host_lock = self._locks[vm.ip_address]
+        if client is not None:
+            return client
+        with host_lock:
+            client = self._clients.get(vm.ip_address)
+            if client is None:
+                kubeconfig = registry.secret(vm.ip_address, "kubeconfig")
+                if kubeconfig is None:
+                    kubeconfig = fetch_kubeconfig(vm)
+                    registry.record_secret(vm.ip_address, "kubeconfig", kubeconfig)
+                client = KubeClient.from_kubeconfig(kubeconfig, vm.ip_address)
+                with self._lock:
+                    self._clients[vm.ip_address] = client
+        return client
+
+    def forget(self, ip):
+        with self._lock:
+            client = self._clients.pop(ip, None)
+        if client is not None:
+            client.close()
+        registry.forget_secret(ip, "kubeconfig")
+
+    def call(self, vm, fn):
+        """fn(client). A 401 means k3s was reinstalled: fetch the kubeconfig again and retry once."""
+        try:
+            return fn(self.for_node(vm))
+        except KubeApiError as e:
+            if e.status_code != 401:
+                raise
+            self.forget(vm.ip_address)
+            return fn(self.for_node(vm))
+
+
+kube_clients = KubeClients()
@@ -1,165 +1,124 @@
 # main.py
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request, Query, Header
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from prometheus_client.openmetrics.exposition import CONTENT_TYPE_LATEST as OPENMETRICS_CONTENT_TYPE
+from prometheus_client.openmetrics.exposition import generate_latest as generate_openmetrics
+import asyncio
 import subprocess
 import paramiko
-from azure_config import compute_client, resource_client, network_client, subscription_id
+import time
+from typing import Optional
+from azure_clients import azure_clients, LazyProxy
 from pathlib import Path 
-from models import ipinput, vmcreation, joinNode, deploypg
+from models import ipinput, vmcreation, joinNode, joinNodes, deploypg, clustercreation, readinesscheck, nodesready, kubeapply, pgfleet, poolscaling
+from provisioning import provision_vms, provision_node_pool, create_network, create_vm, create_node_pool, scale_node_pool, Reconciler, ClusterLayout, cluster_lock, DEFAULT_ADDRESS_SPACE
+from cloud_init import new_k3s_token, K3S_INSTALLER, CHART_DIR
+from artifacts import artifact_cache
+from metrics import InstrumentedClient, REQUEST_SECONDS, trace_id_from, set_trace_id, reset_trace_id, observe
+from retry import RetryingClient, limiter_for, failures
+from jobs import job_manager, report_progress
+from ssh_pool import ssh_pool
+from remote import run_command
+from concurrency import fan_out
+from pipeline import DagScheduler, PipelineFailed
+from helm_releases import Release, install_releases
+from registry import registry
+from journal import journal
+from kube_api import kube_clients
+from cluster_status import cluster_status
+from readiness import prober, wait_for_ssh, wait_for_port, wait_for_ports, wait_for_api_server, wait_for_nodes, NotReady, K3S_API_PORT, SSH_PORT
 
 # everythings working
 
 
 app = FastAPI()
 
+# Every ARM call made through these clients is timed for /metrics, and retried
+# on 429/5xx through one rate limiter for the whole subscription. The SDK clients
+# behind them are only built on the first ARM call (see azure_clients.py), so the
+# app imports without credentials and / answers straight away.
+arm_limiter = LazyProxy(lambda: limiter_for(azure_clients.subscription_id))
+compute_client = RetryingClient(InstrumentedClient(azure_clients.compute_client), arm_limiter)
+resource_client = RetryingClient(InstrumentedClient(azure_clients.resource_client), arm_limiter)
+network_client = RetryingClient(InstrumentedClient(azure_clients.network_client), arm_limiter)
+
+# Endpoints that talk to Azure or SSH are plain `def` so FastAPI runs them in its
+# threadpool instead of blocking the event loop. For builds that take minutes use
+# the /jobs/... variants at the bottom of this file.
+
+# Trace id per request (X-Trace-ID, generated when missing or not a short [A-Za-z0-9-] id) and request latency
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    trace_id = trace_id_from(request.headers.get("x-trace-id"))
+    token = set_trace_id(trace_id)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Trace-ID"] = trace_id
+        return response
+    finally:
+        route = request.scope.get("route")
+        observe(REQUEST_SECONDS, time.perf_counter() - start,
+                method=request.method, route=route.path if route else "unmatched", status=str(status))
+        reset_trace_id(token)
+
 @app.get("/")
 async def root():
     return {"message": "K3s Cluster Setup API"}
 
+# Prometheus scrape endpoint, OpenMetrics (with trace id exemplars) when asked for
+@app.get("/metrics")
+def metrics(request: Request):
+    if "application/openmetrics-text" in request.headers.get("accept", ""):
+        return Response(generate_openmetrics(REGISTRY), media_type=OPENMETRICS_CONTENT_TYPE)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # Creating VM with NSG, IP, DNS
 @app.post("/create-vms")
-async def create_vms(vm = Depends(vmcreation)):
+def create_vms(vm = Depends(vmcreation)):
+    check_node_pool(vm)
     try:
-        # Creating Resource Group
-        resource_client.resource_groups.create_or_update(
-            vm.rg,
-            {"location": vm.location}
-        )
-
-        # Create Network Security Group (NSG) with inbound rules
-        nsg_params = {
-            "location": vm.location,
-            "security_rules": [
-                {
-                    "name": "AllowSSH",
-                    "protocol": "Tcp",
-                    "source_port_range": "*",
-                    "destination_port_range": "22",
-                    "source_address_prefix": "*",
-                    "destination_address_prefix": "*",
-                    "access": "Allow",
-                    "priority": 100,
-                    "direction": "Inbound"
-                },
-                {
-                    "name": "AllowK3s",
-                    "protocol": "Tcp",
-                    "source_port_range": "*",
-                    "destination_port_range": "6443",
-                    "source_address_prefix": "*",
-                    "destination_address_prefix": "*",
-                    "access": "Allow",
-                    "priority": 200,
-                    "direction": "Inbound"
-                },
-                {
-                    "name": "AllowPG",
-                    "protocol": "Tcp",
-                    "source_port_range": "*",
-                    "destination_port_range": "30000",
-                    "source_address_prefix": "*",
-                    "destination_address_prefix": "*",
-                    "access": "Allow",
-                    "priority": 210,
-                    "direction": "Inbound"
-                },
-            ]
-        }
-        nsg = network_client.network_security_groups.begin_create_or_update(
-            vm.rg,
-            "myNSG",
-            nsg_params
-        ).result()
-
-        # Create Virtual Network and Subnet
-        network_params = {
-            "location": vm.location,
-            "address_space": {"address_prefixes": ["10.0.0.0/16"]}
-        }
-        network_client.virtual_networks.begin_create_or_update(
-            vm.rg,
-            "myVnet",
-            network_params
-        ).result()
-
-        subnet_params = {"address_prefix": "10.0.0.0/24"}
-        subnet = network_client.subnets.begin_create_or_update(
-            vm.rg,
-            "myVnet",
-            "mySubnet",
-            subnet_params
-        ).result()
-
-        # Create VMs with unique Network Interfaces, Public IPs, and NSG
-        vm_ips = []
-        for i in range(vm.vm_count):
-            vm_name = f"myVM-{i+1}"
-
-            # Create a unique Public IP with a DNS label for each VM
-            dns_label = f"vm-dns-{i+1}-{vm.rg.lower()}"
-            public_ip_params = {
-                "location": vm.location,
-                "sku": {"name": "Standard"},
-                "public_ip_allocation_method": "Static",
-                "dns_settings": {"domain_name_label": dns_label}  
-            }
-            public_ip = network_client.public_ip_addresses.begin_create_or_update(
-                vm.rg,
-                f"myPublicIP-{i+1}",
-                public_ip_params
-            ).result()
-
-            # Retrieve the domain name after creating
-            fqdn = public_ip.dns_settings.fqdn
-
-            # Network Interface with NSG for each VM
-            nic_name = f"myNic-{i+1}"
-            nic_params = {
-                "location": vm.location,
-                "ip_configurations": [{
-                    "name": f"myIpConfig-{i+1}",
-                    "subnet": {"id": subnet.id},
-                    "public_ip_address": {"id": public_ip.id}
-                }],
-                "network_security_group": {"id": nsg.id}
-            }
-            nic = network_client.network_interfaces.begin_create_or_update(
-                vm.rg,
-                nic_name,
-                nic_params
-            ).result()
-
-            #Create the VM with the unique NIC and Public IP
-            vm_params = {
-                "location": vm.location,
-                "hardware_profile": {"vm_size": vm.vm_size},
-                "storage_profile": {
-                    "image_reference": {
-                        "publisher": "Canonical",
-                        "offer": "UbuntuServer",
-                        "sku": "18.04-LTS",
-                        "version": "latest"
-                    }
-                },
-                "os_profile": {
-                    "computer_name": vm_name,
-                    "admin_username": vm.username,
-                    "admin_password": vm.password
-                },
-                "network_profile": {
-                    "network_interfaces": [{"id": nic.id}]
-                }
-            }
-
-            compute_client.virtual_machines.begin_create_or_update(
-                vm.rg,
-                vm_name,
-                vm_params
-            ).result()
-
-            # Storing and returning the data
-            vm_ips.append({"vm_name": vm_name, "public_ip": public_ip.ip_address, "dns_name": fqdn})
-
-        return {"status": f"{vm.vm_count} VMs created successfully with NSG and open ports", "vm_ips": vm_ips}
+        # With cloud-init the nodes set up k3s themselves at boot using this token
+        k3s_token = cluster_token(vm)
+
+        cluster_id = cluster_key(vm)
+        layout = cluster_layout(vm)
+
+        # Other clusters build in parallel, a second call for this one waits for the first
+        with cluster_lock(cluster_id):
+            # Diff against what already exists instead of re-PUTting everything
+            reconciler = Reconciler(vm, resource_client, network_client, compute_client, layout) if vm.reconcile else None
+            k3s_token = reconciled_token(vm, reconciler, layout, k3s_token)
+
+            node_pool = None
+            if vm.node_pool == "vmss":
+                # Node 1 plus one scale set for all agents, created side by side
+                vm_ips, node_pool = provision_node_pool(vm, resource_client, network_client, compute_client, k3s_token, reconciler, layout)
+            else:
+                # Network first, then every VM's public IP -> NIC -> VM chain in parallel
+                vm_ips = provision_vms(vm, resource_client, network_client, compute_client, max_concurrency=vm.max_concurrency, k3s_token=k3s_token, reconciler=reconciler, layout=layout)
+        registry.record_vms(cluster_id, vm_ips, rg=vm.rg, location=vm.location, token=k3s_token, server_name=layout.vm_name(1))
+
+        response = {"status": f"{vm.vm_count} VMs created successfully with NSG and open ports", "vm_ips": vm_ips}
+        if vm.cluster_name:
+            response["cluster"] = {"id": cluster_id, "address_space": layout.address_space}
+        if node_pool:
+            response["node_pool"] = node_pool
+        if reconciler:
+            response["status"] = f"{vm.vm_count} VMs reconciled"
+            response["reconcile"] = {**reconciler.changes, "extra_vms": reconciler.extra_vms()}
+        if k3s_token:
+            response["bootstrap"] = "cloud-init"
+            response["token"] = k3s_token
+        if vm.wait_for_ssh:
+            # All VMs are probed at once, returns as soon as the last sshd answers
+            response["ssh"] = wait_for_ports([(ip["public_ip"], SSH_PORT) for ip in vm_ips], vm.ready_timeout)
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create VMs: {str(e)}")
 
@@ -168,33 +127,84 @@ async def create_vms(vm = Depends(vmcreation)):
 
 
     
-def install_k3s_on_primary_node(vm):
-    # SSH into the node
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(vm.ip_address, username= vm.username, password= vm.password)
-
-    # install k3s
-    install_command = "curl -sfL https://get.k3s.io | sh -s - server --cluster-init --write-kubeconfig-mode 644"
-    stdin, stdout, stderr = client.exec_command(install_command)
-    print(stdout.read().decode())
-    print(stderr.read().decode())
+def cluster_token(vm):
+    if vm.bootstrap != "cloud-init":
+        return None
+    return vm.k3s_token or new_k3s_token()
+
+# ARM can't change the custom_data of an existing VM, so a cluster whose VMs already exist keeps
+# the token they booted with instead of getting a new one in the registry that no node knows
+def reconciled_token(vm, reconciler, layout, k3s_token):
+    if reconciler is None or k3s_token is None:
+        return k3s_token
+    reconciler.load()
+    if not any(("vm", layout.vm_name(i)) in reconciler.existing for i in range(1, vm.vm_count + 1)):
+        return k3s_token
+    current = registry.cluster_token(cluster_key(vm))
+    if current is None and vm.k3s_token is None:
+        raise HTTPException(status_code=409, detail='The VMs already exist and weren\'t booted with cloud-init, bootstrap "cloud-init" can\'t be applied to them (pass the cluster\'s k3s_token if it has one)')
+    if current is not None and vm.k3s_token not in (None, current):
+        raise HTTPException(status_code=409, detail="k3s_token differs from the token the existing VMs booted with")
+    return current or vm.k3s_token
+
+# Scale set instances have no public IP, so they can only join through cloud-init
+def check_node_pool(vm):
+    if vm.node_pool == "vmss" and vm.bootstrap != "cloud-init":
+        raise HTTPException(status_code=400, detail='node_pool "vmss" needs bootstrap "cloud-init"')
+
+# Registry id of the cluster a /create-vms or /clusters request builds
+def cluster_key(vm):
+    return f"{vm.rg}:{vm.cluster_name}" if vm.cluster_name else vm.rg
+
+# Resource names and VNet address space, allocated once per named cluster
+def cluster_layout(vm):
+    if not vm.cluster_name:
+        return ClusterLayout()
+    address_space = registry.allocate_address_space(cluster_key(vm), reserved=[DEFAULT_ADDRESS_SPACE])
+    return ClusterLayout(vm.cluster_name, address_space)
+
+# Block until cloud-init (and with it the boot-time k3s setup) has finished on the node
+def wait_for_cloud_init(vm):
+    with ssh_pool.connection(vm.ip_address, vm.username, vm.password) as client:
+        result = run_command(client, "cloud-init status --wait")
+    if not result.ok:
+        raise Exception(f"cloud-init failed on {vm.ip_address}: {result.stdout.strip()} {result.stderr.strip()}")
 
-    # Retrieve the K3s token
-    token_command = "sudo cat /var/lib/rancher/k3s/server/node-token"
-    stdin, stdout, stderr = client.exec_command(token_command)
-    token = stdout.read().decode().strip()
-    error = stderr.read().decode().strip()
 
-    client.close()
+def install_k3s_on_primary_node(vm):
+    # SSH into the node (pooled, reused by the next step on this host)
+    with ssh_pool.connection(vm.ip_address, vm.username, vm.password) as client:
+        # install k3s
+        report_progress(10, "installing k3s server")
+        install_command = "curl -sfL https://get.k3s.io | sh -s - server --cluster-init --write-kubeconfig-mode 644"
+        if vm.use_artifact_cache:
+            artifact_cache.push(client, ["k3s", "k3s-install"])
+            install_command = f"INSTALL_K3S_SKIP_DOWNLOAD=true sh {K3S_INSTALLER} server --cluster-init --write-kubeconfig-mode 644"
+        result = run_command(client, install_command)
+        print(result.stdout)
+        print(result.stderr)
+
+        # The installer returns once the service is started, not when the API answers
+        if vm.ready_timeout:
+            report_progress(70, "waiting for the k3s API server")
+            wait_for_api_server(client, vm.ready_timeout)
+
+        # Retrieve the K3s token
+        report_progress(90, "reading node token")
+        token_command = "sudo cat /var/lib/rancher/k3s/server/node-token"
+        result = run_command(client, token_command)
+        token = result.stdout.strip()
+        error = result.stderr.strip()
 
     if error:
         raise Exception(f"Error retrieving K3s token: {error}")
 
+    # Joins can leave out the token from now on
+    registry.record_server(vm.ip_address, token)
     return token
 
 @app.post("/setup-k3s-primary")
-async def setup_k3s_primary(vm = Depends(ipinput)):
+def setup_k3s_primary(vm = Depends(ipinput)):
     try:
         token = install_k3s_on_primary_node(vm)
         return {"status": "K3s installed on primary node", "token": token}
@@ -206,50 +216,108 @@ async def setup_k3s_primary(vm = Depends(ipinput)):
 
 
 
-def join_k3s_secondary_node(vm):
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(vm.ip_address, username = vm.username, password = vm.password)
-
-    # K3s agent join command
-    join_command = f"curl -sfL https://get.k3s.io | K3S_URL=https://{vm.server_ip}:6443 K3S_TOKEN={vm.token} sh -s -"
+# Token recorded by /setup-k3s-primary (or /create-vms with cloud-init), read from the server once otherwise.
+# Only for callers who can log in to the server, the token is what lets any VM join its cluster.
+def lookup_join_token(vm):
+    ssh_pool.authenticate(vm.server_ip, vm.username, vm.password)
+    token = registry.join_token(vm.server_ip)
+    if token:
+        return token
+    with ssh_pool.connection(vm.server_ip, vm.username, vm.password) as server:
+        result = run_command(server, "sudo cat /var/lib/rancher/k3s/server/node-token")
+    if not result.ok or not result.stdout.strip():
+        raise Exception(f"No join token known for {vm.server_ip} and none could be read from it: {result.stderr.strip()}")
+    registry.record_server(vm.server_ip, result.stdout.strip())
+    return result.stdout.strip()
 
-    stdin, stdout, stderr = client.exec_command(join_command)
-    print(stdout.read().decode())
-    print(stderr.read().decode())
-    client.close()
+def join_k3s_secondary_node(vm):
+    token = vm.token or lookup_join_token(vm)
+
+    # No point starting the agent before the server's API port is reachable
+    if vm.ready_timeout:
+        wait_for_port(vm.server_ip, K3S_API_PORT, vm.ready_timeout)
+
+    with ssh_pool.connection(vm.ip_address, vm.username, vm.password) as client:
+        # K3s agent join command
+        join_command = f"curl -sfL https://get.k3s.io | K3S_URL=https://{vm.server_ip}:6443 K3S_TOKEN={token} sh -s -"
+        if vm.use_artifact_cache:
+            artifact_cache.push(client, ["k3s", "k3s-install"])
+            join_command = f"INSTALL_K3S_SKIP_DOWNLOAD=true K3S_URL=https://{vm.server_ip}:6443 K3S_TOKEN={token} sh {K3S_INSTALLER}"
+
+        result = run_command(client, join_command)
+        print(result.stdout)
+        print(result.stderr)
+        if not result.ok:
+            raise Exception(f"k3s agent install exited with {result.exit_status}: {result.stderr.strip()}")
+        node_name = run_command(client, "hostname").stdout.strip()
+    registry.record_node(vm.server_ip, vm.ip_address, node_name)
+
+    if not vm.ready_timeout:
+        return {"node": node_name}
+
+    # The installer exits before the node is Ready, ask the server
+    with ssh_pool.connection(vm.server_ip, vm.username, vm.password) as server:
+        nodes, seconds = wait_for_nodes(server, names=[node_name], timeout=vm.ready_timeout)
+    return {"node": node_name, "ready_seconds": round(seconds, 3)}
 
 @app.post("/join-k3s-node")
-async def join_k3s_node(vm = Depends(joinNode)):
+def join_k3s_node(vm = Depends(joinNode)):
     try:
-        join_k3s_secondary_node(vm)
-        return {"status": "Node joined to K3s cluster"}
+        node = join_k3s_secondary_node(vm)
+        return {"status": "Node joined to K3s cluster", **node}
+    except paramiko.AuthenticationException as e:
+        raise HTTPException(status_code=401, detail=f"SSH login failed: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to join node to K3s cluster: {str(e)}")
 
+# Join many worker nodes in parallel, one failed node doesn't stop the rest
+def join_k3s_secondary_nodes(batch):
+    start = time.perf_counter()
+    outcomes = fan_out(join_k3s_secondary_node, batch.nodes, batch.max_concurrency, label="nodes joined")
+    results = [
+        {
+            "ip_address": node.ip_address,
+            "status": "joined" if outcome["ok"] else "failed",
+            "node": outcome["result"]["node"] if outcome["ok"] else None,
+            "error": outcome["error"],
+            "duration_seconds": outcome["duration_seconds"],
+        }
+        for node, outcome in zip(batch.nodes, outcomes)
+    ]
+    joined = sum(1 for outcome in outcomes if outcome["ok"])
+    return {
+        "status": f"{joined}/{len(batch.nodes)} nodes joined to K3s cluster",
+        "results": results,
+        "total_seconds": round(time.perf_counter() - start, 3),
+    }
 
+@app.post("/join-k3s-nodes")
+def join_k3s_nodes(batch: joinNodes):
+    return join_k3s_secondary_nodes(batch)
 
 
 
 
-# Add an endpoint to install Helm on the primary node.
-def install_helm_on_node(vm):
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(vm.ip_address, username = vm.username, password = vm.password)
 
-    # Command to install Helm
-    helm_install_command = """
-    curl https://raw.githubusercontent.com/helm/helm/main/scripts/get-helm-3 | bash
-    """
 
-    stdin, stdout, stderr = client.exec_command(helm_install_command)
-    print(stdout.read().decode())
-    print(stderr.read().decode())
-    client.close()
+# Add an endpoint to install Helm on the primary node.
+def install_helm_on_node(vm):
+    with ssh_pool.connection(vm.ip_address, vm.username, vm.password) as client:
+        # Command to install Helm
+        helm_install_command = """
+        curl https://raw.githubusercontent.com/helm/helm/main/scripts/get-helm-3 | bash
+        """
+        if vm.use_artifact_cache:
+            # The pinned tarball is unpacked into /usr/local/bin by the push itself
+            print(artifact_cache.push(client, ["helm"]))
+            return
+
+        result = run_command(client, helm_install_command)
+        print(result.stdout)
+        print(result.stderr)
 
 @app.post("/install-helm")
-async def install_helm(vm = Depends(ipinput)):
+def install_helm(vm = Depends(ipinput)):
     try:
         install_helm_on_node(vm)
         return {"status": "Helm installed on node"}
@@ -316,86 +384,104 @@ async def install_helm(vm = Depends(ipinput)):
 @app.post("/Clone-helm-chart/")
 def clone_helm_chart(vm = Depends(ipinput)):
     try:
-        # Establish SSH connection
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(vm.ip_address, username = vm.username, password = vm.password)
-
         # Cloning repo
         command = ("git clone https://github.com/vamsimalle1790/outpostplsql")    
-        
 
-        # Execute each command and capture the output
-        
-        stdin, stdout, stderr = client.exec_command(command)
-        stdout_output = stdout.read().decode()
-        stderr_output = stderr.read().decode()
+        # Execute the command over a pooled SSH connection and capture the output
+        with ssh_pool.connection(vm.ip_address, vm.username, vm.password) as client:
+            if vm.use_artifact_cache:
+                # Only the chart tarball is needed, push it and link it where deploy-postgres looks
+                artifact_cache.push(client, ["postgres-chart"])
+                command = f"[ -e outpostplsql ] || ln -s {CHART_DIR} outpostplsql"
+            result = run_command(client, command)
+            stdout_output = result.stdout
+            stderr_output = result.stderr
 
         # Print outputs in the console
         print(f"Command: {command}")
         print(f"STDOUT:\n{stdout_output}")
         print(f"STDERR:\n{stderr_output}")
 
-        # Close the connection
-        client.close()  
-
         return {"status": "success", "message": "Commands executed successfully."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+POSTGRES_CHART = "./outpostplsql/postgres-chart-0.1.0.tgz"
+
+# The chart's values go to a values file on the node instead of --set flags
+def postgres_release(pg, name="postgres-chart", namespace="default"):
+    values = {
+        "replicaCount": pg.replica_count,
+        "postgres": {
+            "user": pg.user_name,
+            "password": pg.db_password,
+            "db": pg.db_name,
+            "storage": {"size": pg.storage_size},
+            "nodePort": pg.nodeport,
+        },
+        "service": {"type": "NodePort"},
+        "autoscaling": {
+            "enabled": pg.autoscaling_enabled,
+            "minReplicas": pg.min_replicas,
+            "maxReplicas": pg.max_replicas,
+            "targetCPUUtilizationPercentage": pg.cpu_utilization,
+        },
+    }
+    return Release(name, POSTGRES_CHART, namespace, values=values)
+
+def wait_for_k3s_api(vm):
+    if vm.use_kube_api:
+        ssh_pool.authenticate(vm.ip_address, vm.username, vm.password)
+        wait_for_api_server(kube_clients.for_node(vm), vm.ready_timeout)
+        return
+    with ssh_pool.connection(vm.ip_address, vm.username, vm.password) as client:
+        wait_for_api_server(client, vm.ready_timeout)
+
 @app.post("/deploy-postgres/")
-async def deploy_postgres(vm = Depends(deploypg)):
+def deploy_postgres(vm = Depends(deploypg)):
     try:
-        
-
-        # Establish SSH connection
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(vm.ip_address, username = vm.username, password = vm.password)
-
-        release_name = "postgres-chart"
-        helm_chart_path = "./outpostplsql/postgres-chart-0.1.0.tgz"
-
-        # Build Helm command with --set for dynamic values
-        helm_command = (
-            f"helm install {release_name} {helm_chart_path} "
-            f"--set replicaCount={vm.replica_count} "
-            f"--set postgres.user={vm.user_name} "
-            f"--set postgres.password={vm.db_password} "
-            f"--set postgres.db={vm.db_name} "
-            f"--set postgres.storage.size={vm.storage_size} "
-            f"--set postgres.nodePort={vm.nodeport} "
-            f"--set service.type=NodePort "
-            f"--set autoscaling.enabled={str(vm.autoscaling_enabled).lower()} "
-            f"--set autoscaling.minReplicas={vm.min_replicas} "
-            f"--set autoscaling.maxReplicas={vm.max_replicas} "
-            f"--set autoscaling.targetCPUUtilizationPercentage={vm.cpu_utilization}"
-        )
-
-        # Single command to set KUBECONFIG and execute Helm
-        command = (
-            "export KUBECONFIG=/etc/rancher/k3s/k3s.yaml && " + helm_command
-        )
-
-        stdin, stdout, stderr = client.exec_command(command)
-        stdout_output = stdout.read().decode()
-        stderr_output = stderr.read().decode()
-
-        # Log outputs
-        print(f"Command: {command}")
-        print(f"STDOUT:\n{stdout_output}")
-        print(f"STDERR:\n{stderr_output}")
-
-        # if stderr_output:
-        #     raise Exception(f"Error executing {command}: {stderr_output}")
-
-        # Close the connection
-        client.close()
-
-        return {"status": "success", "message": "PostgreSQL deployed successfully."}
+        if vm.ready_timeout:
+            wait_for_k3s_api(vm)
+        # upgrade --install: a second call with new values upgrades the release, the same values are a no-op
+        result = install_releases(vm, [postgres_release(vm)], force=vm.force)
+        release = result["releases"][0]
+        if release["status"] == "failed":
+            raise Exception(release["error"])
+        message = "PostgreSQL is already up to date." if release["status"] == "unchanged" else "PostgreSQL deployed successfully."
+        return {"status": "success", "message": message, "release": release}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Install or upgrade many Postgres releases in one call, in parallel across namespaces.
+# Releases whose values didn't change since the last deploy are left alone.
+def deploy_postgres_fleet_on_node(fleet):
+    if fleet.ready_timeout:
+        wait_for_k3s_api(fleet)
+    releases = [postgres_release(pg, pg.name, pg.namespace) for pg in fleet.releases]
+    result = install_releases(fleet, releases, max_parallel=fleet.max_concurrency, force=fleet.force)
+    counts = {}
+    for release in result["releases"]:
+        counts[release["status"]] = counts.get(release["status"], 0) + 1
+    return {"summary": counts, **result}
+
+def check_fleet(fleet):
+    seen, ports = set(), set()
+    for pg in fleet.releases:
+        if (pg.namespace, pg.name) in seen:
+            raise HTTPException(status_code=400, detail=f"Release {pg.namespace}/{pg.name} is listed twice")
+        if pg.nodeport in ports:
+            raise HTTPException(status_code=400, detail=f"NodePort {pg.nodeport} is used by more than one release")
+        seen.add((pg.namespace, pg.name))
+        ports.add(pg.nodeport)
+
+@app.post("/postgres-fleet")
+def deploy_postgres_fleet(fleet: pgfleet):
+    check_fleet(fleet)
+    try:
+        return deploy_postgres_fleet_on_node(fleet)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to deploy Postgres fleet: {str(e)}")
+
 
 # @app.post("/deploy_postgres/")
 # async def deploy_postgres(ip_address: str, username: str, password: str, user_name : str, db_name : str, db_password :str, storage_size :str, nodeport :str):
@@ -454,73 +540,441 @@ async def deploy_postgres(vm = Depends(deploypg)):
 #     except Exception as e:
 #         raise HTTPException(status_code=500, detail=str(e))
     
-def deploy_promethous_grafana(vm, commands: list):
-    """Execute commands on a remote server via SSH."""
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostname=vm.ip_address, username=vm.username, password=vm.password)
-        for command in commands:
-            stdin, stdout, stderr = ssh.exec_command("export KUBECONFIG=/etc/rancher/k3s/k3s.yaml && "+ command)
-            stdout.channel.recv_exit_status()  # Wait for command to finish
-            output = stdout.read().decode()
-            error = stderr.read().decode()
-            print("stdout\n", output)
-            print("error\n",error)
-            # if error:
-            #     raise Exception(f"Error executing command: {error}")
-        ssh.close()
-        return output
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+# kube-prometheus-stack and Grafana don't depend on each other, so they install side by side
+MONITORING_RELEASES = [
+    Release("prometheus", "prometheus-community/kube-prometheus-stack", "monitoring",
+            repo=("prometheus-community", "https://prometheus-community.github.io/helm-charts")),
+    # NodePort from the chart instead of patching the service afterwards
+    Release("grafana", "grafana/grafana", "monitoring",
+            repo=("grafana", "https://grafana.github.io/helm-charts"), args=["--set", "service.type=NodePort"]),
+]
 
 @app.post("/deploy_promethous_grafana/")
 def install_monitoring(vm = Depends(ipinput)):
     """Install Prometheus and Grafana on the remote VM."""
-    commands = [
-        "helm repo add prometheus-community https://prometheus-community.github.io/helm-charts && helm repo update",
-        "helm repo add grafana https://grafana.github.io/helm-charts && helm repo update",
-        # Install Prometheus
-        "helm install prometheus prometheus-community/kube-prometheus-stack --namespace monitoring --create-namespace",
-        # Install Grafana
-        "helm install grafana grafana/grafana --namespace monitoring",
-        # Change Grafana to NodePort
-        "kubectl -n monitoring patch svc grafana --type='json' -p '[{\"op\":\"replace\",\"path\":\"/spec/type\",\"value\":\"NodePort\"}]'"
-    ]
-    
-    # Execute the commands on the remote VM
     try:
-        result = deploy_promethous_grafana(vm, commands)
-        return {"message": "Prometheus and Grafana installed successfully.", "details": result}
-    except HTTPException as e:
-        return {"error": e.detail}
+        result = install_releases(vm, MONITORING_RELEASES)
+    except Exception as e:
+        return {"error": str(e)}
+    if not result["succeeded"]:
+        failed = [release["name"] for release in result["releases"] if release["status"] != "deployed"]
+        return {"error": f"Monitoring install failed: {', '.join(failed)}", **result}
+    # A fresh Grafana install comes with a new admin password
+    if any(release["name"] == "grafana" and release["status"] == "deployed" for release in result["releases"]):
+        registry.forget_secret(vm.ip_address, "grafana-admin-password")
+    return {"message": "Prometheus and Grafana installed successfully.", **result}
 
 @app.post("/get-grafana-password/")
-def get_grafana_password(vm = Depends(ipinput)):
+def get_grafana_password(vm = Depends(ipinput), refresh: bool = False):
     try:
-        # Establish SSH connection
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(vm.ip_address, username = vm.username, password = vm.password)
-
-        # Cloning repo
-        command = ("kubectl get secret --namespace monitoring grafana -o jsonpath="{.data.admin-password}" | base64 --decode ; echo")    
-        
-
-        # Execute each command and capture the output
-        
-        stdin, stdout, stderr = client.exec_command(command)
-        stdout_output = stdout.read().decode()
-        stderr_output = stderr.read().decode()
-
-        # Print outputs in the console
+        # The registry and the kubeconfig don't check who's asking, SSH does. Only callers
+        # who can log in to the server get the password, as before it was cached.
+        ssh_pool.authenticate(vm.ip_address, vm.username, vm.password)
+        # Served from the cluster registry after the first lookup, refresh=true reads it again
+        if not refresh:
+            password = registry.secret(vm.ip_address, "grafana-admin-password")
+            if password is not None:
+                return {"status": "success", "password": password, "cached": True}
+
+        if vm.use_kube_api:
+            password = kube_clients.call(vm, lambda kube: kube.get_secret("monitoring", "grafana")["admin-password"])
+            registry.record_secret(vm.ip_address, "grafana-admin-password", password)
+            return {"status": "success", "password": password}
+
+        # Read the Grafana admin secret
+        command = ("kubectl get secret --namespace monitoring grafana -o jsonpath='{.data.admin-password}' | base64 --decode ; echo")    
+
+        # Execute the command over a pooled SSH connection and capture the output
+        with ssh_pool.connection(vm.ip_address, vm.username, vm.password) as client:
+            result = run_command(client, command)
+            stdout_output = result.stdout
+            stderr_output = result.stderr
+
+        # Print outputs in the console, except the password itself
         print(f"Command: {command}")
-        print(f"STDOUT:\n{stdout_output}")
         print(f"STDERR:\n{stderr_output}")
 
-        # Close the connection
-        client.close()  
-
+        if result.ok and stdout_output.strip():
+            registry.record_secret(vm.ip_address, "grafana-admin-password", stdout_output)
         return {"status": "success", "password": stdout_output}
+    except paramiko.AuthenticationException:
+        raise HTTPException(status_code=401, detail=f"SSH login to {vm.ip_address} failed")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+# One-shot cluster build. Every step is a stage in a DAG and starts as soon as its
+# inputs are ready: workers join the moment their VM exists, Helm and the chart
+# clone run on the primary while k3s installs and the workers are still joining.
+def build_cluster(spec):
+    # No worker cap: long ssh/join stages must not hold back vm-N, "arm" alone limits ARM calls
+    scheduler = DagScheduler()
+    scheduler.limit("arm", spec.max_concurrency)
+
+    def node(inputs, index):
+        return ipinput(ip_address=inputs[f"vm-{index}"]["public_ip"], username=spec.username, password=spec.password, ready_timeout=spec.ready_timeout)
+
+    # SSH steps on a VM start the moment its sshd answers instead of racing the boot
+    def ssh_ready(inputs, index):
+        if spec.ready_timeout:
+            return wait_for_ssh(inputs[f"vm-{index}"]["public_ip"], spec.ready_timeout)
+
+    k3s_token = cluster_token(spec)
+    cluster_id = cluster_key(spec)
+    layout = cluster_layout(spec)
+    reconciler = Reconciler(spec, resource_client, network_client, compute_client, layout) if spec.reconcile else None
+
+    # Under the cluster lock, so a build running alongside can't create the VMs between the check and ours
+    def check_bootstrap():
+        nonlocal k3s_token
+        k3s_token = reconciled_token(spec, reconciler, layout, k3s_token)
+
+    # Each VM goes into the registry as soon as it exists, so later stages can look it up
+    def vm_stage(inputs, index):
+        vm_ip = create_vm(spec, index, *inputs["network"], network_client, compute_client, k3s_token, reconciler, layout)
+        registry.record_vms(cluster_id, [vm_ip], rg=spec.rg, location=spec.location, token=k3s_token, server_name=layout.vm_name(1))
+        return vm_ip
+
+    # With a scale set node pool only node 1 is a VM, the agents come up together in "node-pool"
+    pool_mode = spec.node_pool == "vmss"
+    vm_count = 1 if pool_mode else spec.vm_count
+
+    scheduler.add("network", lambda inputs: create_network(spec, resource_client, network_client, reconciler, layout))
+    if pool_mode and spec.vm_count > 1:
+        scheduler.add("node-pool", lambda inputs: create_node_pool(spec, *inputs["network"], compute_client, k3s_token, reconciler, layout), depends_on=["network"], group="arm")
+    for i in range(1, vm_count + 1):
+        scheduler.add(
+            f"vm-{i}",
+            lambda inputs, i=i: vm_stage(inputs, i),
+            depends_on=["network"],
+            group="arm",
+        )
+        scheduler.add(f"ssh-vm-{i}", lambda inputs, i=i: ssh_ready(inputs, i), depends_on=[f"vm-{i}"])
+
+    if k3s_token:
+        # Nodes install k3s, Helm and the chart at boot, just wait for cloud-init to finish
+        def boot(inputs, index):
+            wait_for_cloud_init(node(inputs, index))
+            return k3s_token
+
+        # Scale set instances can't be reached over SSH, count them as joined once the server sees them Ready
+        def pool_joined(inputs):
+            if spec.ready_timeout:
+                with ssh_pool.connection(inputs["vm-1"]["public_ip"], spec.username, spec.password) as client:
+                    nodes, seconds = wait_for_nodes(client, count=spec.vm_count, timeout=spec.ready_timeout)
+                return {"nodes": nodes, "ready_seconds": round(seconds, 3)}
+
+        scheduler.add("k3s-primary", lambda inputs: boot(inputs, 1), depends_on=["vm-1", "ssh-vm-1"])
+        for i in range(2, vm_count + 1):
+            scheduler.add(f"join-vm-{i}", lambda inputs, i=i: boot(inputs, i), depends_on=[f"vm-{i}", f"ssh-vm-{i}", "vm-1"])
+        if "node-pool" in scheduler.stages:
+            scheduler.add("join-pool", pool_joined, depends_on=["vm-1", "k3s-primary", "node-pool"])
+        if spec.deploy_postgres:
+            scheduler.add("deploy-postgres", lambda inputs: deploy_postgres(deploypg(
+                ip_address=inputs["vm-1"]["public_ip"],
+                username=spec.username,
+                password=spec.password,
+                ready_timeout=spec.ready_timeout,
+                **spec.postgres.model_dump(),
+            )), depends_on=["vm-1", "k3s-primary"])
+        return run_cluster_build(spec, scheduler, check_bootstrap)
+
+    scheduler.add("k3s-primary", lambda inputs: install_k3s_on_primary_node(node(inputs, 1)), depends_on=["vm-1", "ssh-vm-1"])
+    for i in range(2, spec.vm_count + 1):
+        scheduler.add(
+            f"join-vm-{i}",
+            lambda inputs, i=i: join_k3s_secondary_node(joinNode(
+                ip_address=inputs[f"vm-{i}"]["public_ip"],
+                username=spec.username,
+                password=spec.password,
+                token=inputs["k3s-primary"],
+                server_ip=inputs["vm-1"]["public_ip"],
+                ready_timeout=spec.ready_timeout,
+            )),
+            depends_on=[f"vm-{i}", f"ssh-vm-{i}", "k3s-primary", "vm-1"],
+        )
+
+    if spec.install_helm or spec.deploy_postgres:
+        scheduler.add("install-helm", lambda inputs: install_helm_on_node(node(inputs, 1)), depends_on=["vm-1", "ssh-vm-1"])
+    if spec.deploy_postgres:
+        scheduler.add("clone-chart", lambda inputs: clone_helm_chart(node(inputs, 1)), depends_on=["vm-1", "ssh-vm-1"])
+        scheduler.add(
+            "deploy-postgres",
+            lambda inputs: deploy_postgres(deploypg(
+                ip_address=inputs["vm-1"]["public_ip"],
+                username=spec.username,
+                password=spec.password,
+                ready_timeout=spec.ready_timeout,
+                **spec.postgres.model_dump(),
+            )),
+            depends_on=["vm-1", "k3s-primary", "install-helm", "clone-chart"],
+        )
+    return run_cluster_build(spec, scheduler, check_bootstrap)
+
+def run_cluster_build(spec, scheduler, prepare=None):
+    with cluster_lock(cluster_key(spec)):
+        if prepare is not None:
+            prepare()
+        report = scheduler.run()
+    vm_ips = [
+        scheduler.stages[f"vm-{i}"].result
+        for i in range(1, spec.vm_count + 1)
+        if f"vm-{i}" in scheduler.stages and scheduler.stages[f"vm-{i}"].status == "succeeded"
+    ]
+    if not report["succeeded"]:
+        failed = [name for name, stage in report["stages"].items() if stage["status"] == "failed"]
+        raise PipelineFailed(f"Cluster build failed at {', '.join(failed)}", {**report, "vm_ips": vm_ips})
+    response = {
+        "status": f"Cluster with {spec.vm_count} nodes is ready",
+        "vm_ips": vm_ips,
+        "token": scheduler.stages["k3s-primary"].result,
+        **report,
+    }
+    if "node-pool" in scheduler.stages:
+        response["node_pool"] = scheduler.stages["node-pool"].result
+    return response
+
+@app.post("/clusters")
+def create_cluster(spec: clustercreation):
+    check_node_pool(spec)
+    return submit_job("clusters", build_cluster, spec)
+
+# Change the agent count of a cluster created with node_pool "vmss", one ARM call for any number of nodes
+@app.post("/node-pools/scale")
+def scale_pool(body: poolscaling):
+    try:
+        with cluster_lock(cluster_key(body)):
+            return scale_node_pool(body.rg, ClusterLayout(body.cluster_name).node_pool, body.capacity, compute_client)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to scale node pool: {str(e)}")
+
+# Cluster registry: what was built, served from SQLite through a TTL cache
+@app.get("/clusters")
+def list_clusters():
+    return {"clusters": registry.list_clusters(), "cache": registry.cache.stats()}
+
+@app.get("/clusters/{cluster_id}")
+def get_cluster(cluster_id: str):
+    cluster = registry.get_cluster(cluster_id)
+    if cluster is None:
+        raise HTTPException(status_code=404, detail=f"Cluster {cluster_id} not found")
+    return cluster
+
+# Node readiness, CPU/memory allocatable vs requested vs used, pod counts and Postgres replicas/HPA
+# in one pass over the cluster's k3s server, cached for CLUSTER_STATUS_TTL seconds (default 15).
+# Reads through the kubeconfig stored in the registry. SSH credentials only come in headers, never
+# the query string, and are only needed to fetch the kubeconfig once or for use_kube_api=false.
+@app.get("/clusters/{cluster_id}/status")
+def get_cluster_status(cluster_id: str, use_kube_api: bool = True, refresh: bool = False,
+                       x_ssh_username: Optional[str] = Header(default=None), x_ssh_password: Optional[str] = Header(default=None)):
+    cluster = registry.get_cluster(cluster_id)
+    if cluster is None:
+        raise HTTPException(status_code=404, detail=f"Cluster {cluster_id} not found")
+    if not cluster["server_ip"]:
+        raise HTTPException(status_code=400, detail=f"Cluster {cluster_id} has no k3s server yet")
+    if x_ssh_password is None and (not use_kube_api or "kubeconfig" not in cluster["secrets"]):
+        raise HTTPException(status_code=400, detail=f"No kubeconfig stored for {cluster_id}, send X-SSH-Username and X-SSH-Password to fetch it")
+    vm = ipinput(ip_address=cluster["server_ip"], username=x_ssh_username or "azureuser", password=x_ssh_password or "", use_kube_api=use_kube_api)
+    postgres = [(release["namespace"], release["name"]) for release in cluster["releases"] if release["chart"] == POSTGRES_CHART]
+    try:
+        return cluster_status.get(cluster_id, vm, postgres, use_kube_api, refresh)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to collect cluster status: {str(e)}")
+
+# Drop cached entries after changing a cluster behind the API's back
+@app.post("/clusters/{cluster_id}/invalidate")
+def invalidate_cluster(cluster_id: str):
+    cluster_status.cache.invalidate(cluster_id)
+    return {"cluster_id": cluster_id, "invalidated": registry.invalidate(cluster_id)}
+
+
+
+# Readiness checks. Ports are probed concurrently on the event loop, no threads involved
+@app.post("/readiness")
+async def readiness(check: readinesscheck):
+    targets = [(host, port) for host in check.hosts for port in check.ports]
+    results = await prober.wait_all(targets, check.timeout)
+    return {"ready": all(result["ready"] for result in results), "targets": results}
+
+# Wait until the given nodes (or at least expected_nodes) are Ready, asking the k3s server at ip_address
+@app.post("/k3s-nodes/ready")
+def k3s_nodes_ready(vm: nodesready):
+    try:
+        if vm.use_kube_api:
+            # The cached kubeconfig doesn't know who's asking, the SSH login does
+            ssh_pool.authenticate(vm.ip_address, vm.username, vm.password)
+            nodes, seconds = wait_for_nodes(kube_clients.for_node(vm), vm.node_names, vm.expected_nodes, vm.ready_timeout)
+        else:
+            with ssh_pool.connection(vm.ip_address, vm.username, vm.password) as client:
+                nodes, seconds = wait_for_nodes(client, vm.node_names, vm.expected_nodes, vm.ready_timeout)
+        return {"status": "Nodes ready", "nodes": nodes, "seconds": round(seconds, 3)}
+    except NotReady as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except paramiko.AuthenticationException:
+        raise HTTPException(status_code=401, detail=f"SSH login to {vm.ip_address} failed")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to check k3s nodes: {str(e)}")
+
+
+
+# Server-side apply of raw manifests through the k3s API, no kubectl or SSH session per object.
+# The kubeconfig is cluster-admin, so callers must be able to log in to the server over SSH.
+@app.post("/kube/apply")
+def kube_apply(body: kubeapply):
+    try:
+        ssh_pool.authenticate(body.ip_address, body.username, body.password)
+        applied = []
+        for manifest in body.manifests:
+            obj = kube_clients.call(body, lambda kube: kube.apply(manifest))
+            metadata = obj.get("metadata", {})
+            applied.append({
+                "kind": obj.get("kind", manifest.get("kind")),
+                "namespace": metadata.get("namespace"),
+                "name": metadata.get("name"),
+                "resource_version": metadata.get("resourceVersion"),
+            })
+        return {"status": "success", "applied": applied}
+    except paramiko.AuthenticationException:
+        raise HTTPException(status_code=401, detail=f"SSH login to {body.ip_address} failed")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to apply manifests: {str(e)}")
+
+
+
+# Local artifact cache: what is pinned and what is already downloaded
+@app.get("/artifacts")
+def list_artifacts():
+    return {"artifacts": artifact_cache.status()}
+
+@app.post("/artifacts/fetch")
+def fetch_artifacts():
+    try:
+        for name in artifact_cache.artifacts:
+            artifact_cache.fetch(name)
+        return {"artifacts": artifact_cache.status()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch artifacts: {str(e)}")
+
+@app.post("/artifacts/push")
+def push_artifacts(vm = Depends(ipinput)):
+    try:
+        with ssh_pool.connection(vm.ip_address, vm.username, vm.password) as client:
+            pushed = artifact_cache.push(client, list(artifact_cache.artifacts))
+        return {"status": "success", "artifacts": pushed}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to push artifacts: {str(e)}")
+
+
+
+# Retries and give-ups per ARM/SSH operation, and the current ARM request rate
+@app.get("/retries")
+def retry_stats():
+    # No ARM call yet means no limiter yet, don't build the clients just to say so
+    return {"operations": failures.stats(), "arm_rate_limiter": arm_limiter.stats() if azure_clients.ready else None}
+
+# Connection reuse counters of the shared SSH pool
+@app.get("/ssh-pool/stats")
+def ssh_pool_stats():
+    return ssh_pool.stats()
+
+# Every remote command from the execution journal, newest first. `since` is a unix timestamp
+@app.get("/executions")
+def list_executions(host: Optional[str] = None, label: Optional[str] = None, outcome: Optional[str] = None,
+                    job_id: Optional[str] = None, since: Optional[float] = None,
+                    limit: int = Query(default=100, ge=1, le=1000), include_output: bool = False):
+    return {"executions": journal.query(host, label, outcome, job_id, since, limit, include_output)}
+
+# Which commands are slow or flaky: runs, failure rate and latency per command ("helm upgrade", "kubectl get", ...)
+@app.get("/executions/summary")
+def execution_summary(since: Optional[float] = None):
+    return {"commands": journal.summary(since), "journal": journal.stats()}
+
+
+
+# Background job variants of the long-running endpoints. Each returns a job id
+# right away, poll GET /jobs/{job_id} for progress and the endpoint's response.
+def submit_job(kind, fn, vm):
+    job = job_manager.submit(kind, fn, vm)
+    return JSONResponse(status_code=202, content={"job_id": job.id, "status": job.status})
+
+@app.post("/jobs/create-vms")
+def create_vms_job(vm = Depends(vmcreation)):
+    return submit_job("create-vms", create_vms, vm)
+
+@app.post("/jobs/setup-k3s-primary")
+def setup_k3s_primary_job(vm = Depends(ipinput)):
+    return submit_job("setup-k3s-primary", setup_k3s_primary, vm)
+
+@app.post("/jobs/join-k3s-node")
+def join_k3s_node_job(vm = Depends(joinNode)):
+    return submit_job("join-k3s-node", join_k3s_node, vm)
+
+@app.post("/jobs/join-k3s-nodes")
+def join_k3s_nodes_job(batch: joinNodes):
+    return submit_job("join-k3s-nodes", join_k3s_nodes, batch)
+
+@app.post("/jobs/install-helm")
+def install_helm_job(vm = Depends(ipinput)):
+    return submit_job("install-helm", install_helm, vm)
+
+@app.post("/jobs/clone-helm-chart")
+def clone_helm_chart_job(vm = Depends(ipinput)):
+    return submit_job("clone-helm-chart", clone_helm_chart, vm)
+
+@app.post("/jobs/deploy-postgres")
+def deploy_postgres_job(vm = Depends(deploypg)):
+    return submit_job("deploy-postgres", deploy_postgres, vm)
+
+@app.post("/jobs/postgres-fleet")
+def deploy_postgres_fleet_job(fleet: pgfleet):
+    check_fleet(fleet)
+    return submit_job("postgres-fleet", deploy_postgres_fleet_on_node, fleet)
+
+@app.post("/jobs/deploy-promethous-grafana")
+def install_monitoring_job(vm = Depends(ipinput)):
+    return submit_job("deploy-promethous-grafana", install_monitoring, vm)
+
+@app.get("/jobs")
+def list_jobs():
+    return {"jobs": [job.to_dict(include_result=False) for job in job_manager.list()]}
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job.to_dict()
+
+
+# How often followers look for new output, and the longest gap between two events
+OUTPUT_POLL_INTERVAL = 0.2
+OUTPUT_KEEPALIVE = 15
+
+
+# Live output of the job's remote commands as Server-Sent Events, ends when the job finishes
+@app.get("/jobs/{job_id}/output")
+def stream_job_output(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+    # Polls on the event loop instead of parking a threadpool thread per follower
+    async def events():
+        seq = -1
+        last_sent = time.monotonic()
+        while True:
+            chunks, closed = job.output.read(seq, timeout=0)
+            for seq, text in chunks:
+                lines = text[:-1].split("\n") if text.endswith("\n") else text.split("\n")
+                yield "".join(f"data: {line}\n" for line in lines) + "\n"
+                last_sent = time.monotonic()
+            if not chunks:
+                if closed:
+                    yield f"event: end\ndata: {job.status}\n\n"
+                    return
+                if time.monotonic() - last_sent >= OUTPUT_KEEPALIVE:
+                    yield ": keepalive\n\n"
+                    last_sent = time.monotonic()
+                await asyncio.sleep(OUTPUT_POLL_INTERVAL)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
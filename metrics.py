@@ -0,0 +1,179 @@
+# metrics.py
+"""
+Latency histograms for the API itself, exported on GET /metrics.
+
+Every request gets a trace id (X-Trace-ID header, generated when missing)
+that follows the work into jobs and pipeline stages through contextvars.
+Observations carry it as an exemplar, visible when Prometheus scrapes in
+OpenMetrics format.
+"""
+import contextvars
+import re
+import time
+import uuid
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Histogram
+
+# SSH installs and ARM operations run for minutes, the default buckets stop at 10s
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+
+REQUEST_SECONDS = Histogram(
+    "k3s_api_request_seconds", "HTTP request latency", ["method", "route", "status"], buckets=SLOW_BUCKETS)
+ARM_SECONDS = Histogram(
+    "k3s_api_arm_operation_seconds", "Azure Resource Manager call latency, begin to result",
+    ["resource_type", "operation", "outcome"], buckets=SLOW_BUCKETS)
+SSH_CONNECT_SECONDS = Histogram(
+    "k3s_api_ssh_connect_seconds", "SSH connect + key exchange + auth", ["outcome"], buckets=SLOW_BUCKETS)
+SSH_COMMAND_SECONDS = Histogram(
+    "k3s_api_ssh_command_seconds", "Remote command latency", ["command", "outcome"], buckets=SLOW_BUCKETS)
+STAGE_SECONDS = Histogram(
+    "k3s_api_pipeline_stage_seconds", "Cluster pipeline stage latency", ["stage", "outcome"], buckets=SLOW_BUCKETS)
+JOB_SECONDS = Histogram(
+    "k3s_api_job_seconds", "Background job run time", ["kind", "outcome"], buckets=SLOW_BUCKETS)
+SSH_CONNECTIONS_REUSED = Counter(
+    "k3s_api_ssh_connections_reused", "Pooled SSH connections handed out without a new handshake")
+RETRIES = Counter(
+    "k3s_api_retries", "Retried or abandoned Azure/SSH operations", ["operation", "outcome"])
+
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+# prometheus_client refuses exemplars over 128 characters, and the id also lands in logs
+_TRACE_ID = re.compile(r"[A-Za-z0-9-]{1,64}")
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def trace_id_from(header):
+    """The caller's X-Trace-ID when it's a short plain id, a new one otherwise."""
+    if header and _TRACE_ID.fullmatch(header):
+        return header
+    return new_trace_id()
+
+
+def current_trace_id():
+    return _trace_id.get()
+
+
+def set_trace_id(trace_id):
+    return _trace_id.set(trace_id)
+
+
+def reset_trace_id(token):
+    _trace_id.reset(token)
+
+
+def observe(histogram, seconds, **labels):
+    trace_id = _trace_id.get()
+    exemplar = {"trace_id": trace_id} if trace_id else None
+    histogram.labels(**labels).observe(seconds, exemplar=exemplar)
+
+
+@contextmanager
+def timed(histogram, **labels):
+    """Observe the block's duration with outcome="ok" or "error"."""
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        observe(histogram, time.perf_counter() - start, outcome=outcome, **labels)
+
+
+_ENV_PREFIX = re.compile(r"^(export\s+\S+\s*&&\s*|[A-Z_][A-Z0-9_]*=\S*\s+)+")
+_SUBCOMMANDS = {"helm", "kubectl", "git", "cloud-init", "k3s", "systemctl"}
+
+
+def command_label(command):
+    """
+    Low-cardinality label for a shell command: the program, plus the
+    subcommand for tools like helm/kubectl ("helm install", "kubectl get").
+    """
+    command = _ENV_PREFIX.sub("", command.strip())
+    words = command.split()
+    if words and words[0] == "sudo":
+        words = words[1:]
+    if not words:
+        return "unknown"
+    program = words[0].rsplit("/", 1)[-1]
+    if program in _SUBCOMMANDS and len(words) > 1 and not words[1].startswith("-"):
+        return f"{program} {words[1]}"
+    return program
+
+
+def stage_label(stage):
+    """vm-3 / join-vm-3 -> vm / join-vm so per-node stages share one series, every Helm release is "release"."""
+    if stage.startswith("release-") and "/" in stage:
+        return "release"
+    return re.sub(r"-\d+$", "", stage)
+
+
+class _TimedPoller:
+    def __init__(self, poller, labels, start):
+        self._poller = poller
+        self._labels = labels
+        self._start = start
+        self._observed = False
+
+    def result(self, *args, **kwargs):
+        outcome = "error"
+        try:
+            value = self._poller.result(*args, **kwargs)
+            outcome = "ok"
+            return value
+        finally:
+            if not self._observed:
+                self._observed = True
+                observe(ARM_SECONDS, time.perf_counter() - self._start, outcome=outcome, **self._labels)
+
+    def __getattr__(self, name):
+        return getattr(self._poller, name)
+
+
+class _TimedOperations:
+    def __init__(self, operations, resource_type):
+        self._operations = operations
+        self._resource_type = resource_type
+
+    def __getattr__(self, name):
+        method = getattr(self._operations, name)
+        if not callable(method):
+            return method
+        labels = {"resource_type": self._resource_type, "operation": name}
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                value = method(*args, **kwargs)
+                if name.startswith("list"):
+                    # A lazy pager, the HTTP calls happen while iterating: time those too
+                    value = list(value)
+            except Exception:
+                observe(ARM_SECONDS, time.perf_counter() - start, outcome="error", **labels)
+                raise
+            if name.startswith("begin_"):
+                # Long-running operation: the clock stops when its result() returns
+                return _TimedPoller(value, labels, start)
+            observe(ARM_SECONDS, time.perf_counter() - start, outcome="ok", **labels)
+            return value
+
+        return call
+
+
+class InstrumentedClient:
+    """
+    Wraps an Azure management client so every operation is timed, e.g.
+    network_client.public_ip_addresses.begin_create_or_update(...) is observed
+    as resource_type="public_ip_addresses", operation="begin_create_or_update".
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._groups = {}
+
+    def __getattr__(self, name):
+        if name not in self._groups:
+            self._groups[name] = _TimedOperations(getattr(self._client, name), name)
+        return self._groups[name]
@@ -1,29 +1,105 @@
+from typing import Literal, Optional
+
 from pydantic import BaseModel, Field
 
 class ipinput(BaseModel):
     ip_address : str
     username : str = Field(default="azureuser")
     password : str = Field(default="MyPassword123")
+    # Push k3s/Helm/chart from the API's local artifact cache instead of downloading on the VM
+    use_artifact_cache : bool = Field(default=False)
+    # Seconds to wait for the k3s API server / nodes to become ready, 0 skips the checks
+    ready_timeout : int = Field(default=300, ge=0)
+    # Talk to the k3s API on port 6443 with the node's kubeconfig instead of running kubectl over SSH
+    use_kube_api : bool = Field(default=False)
 
 class vmcreation(BaseModel):
     vm_count : int
     rg : str
+    # Prefix for every Azure resource of the cluster and its own VNet, so several clusters can be
+    # built in one resource group at once. Empty keeps the single-cluster names (myVM-1, myVnet, ...)
+    cluster_name: Optional[str] = Field(default=None, pattern=r"^[a-z][a-z0-9-]{0,19}$")
     username : str = Field(default="azureuser")
     password : str = Field(default="MyPassword123")
     location: str = Field(default="centralindia")
     vm_size: str = Field(default="Standard_B2s_v2")
+    max_concurrency: int = Field(default=5, ge=1)
+    # "cloud-init" installs k3s (and Helm + chart on node 1) at boot instead of over SSH
+    bootstrap: Literal["none", "cloud-init"] = Field(default="none")
+    # Custom image resource id with k3s/Helm/chart pre-installed, stock Ubuntu when empty
+    image_id: Optional[str] = Field(default=None)
+    # Token for cloud-init clusters, generated when empty
+    k3s_token: Optional[str] = Field(default=None)
+    # Only create what is missing or changed, e.g. scaling 3 -> 5 creates just VMs 4 and 5
+    reconcile: bool = Field(default=False)
+    # Wait until sshd answers on every new VM before returning
+    wait_for_ssh: bool = Field(default=False)
+    ready_timeout: int = Field(default=300, ge=0)
+    # "vmss": node 1 is a VM, every other node goes into one scale set with private IPs only and
+    # joins through cloud-init (needs bootstrap="cloud-init"), scaled with /node-pools/scale
+    node_pool: Literal["vm", "vmss"] = Field(default="vm")
+    # Spot capacity for the scale set, evicted instances are deleted
+    spot: bool = Field(default=False)
+    # USD per hour, -1 pays up to the on-demand price and is never evicted for price
+    spot_max_price: float = Field(default=-1)
 
 class joinNode(BaseModel):
     ip_address : str
     username : str = Field(default="azureuser")
     password : str = Field(default="MyPassword123")
-    token : str
+    # Looked up from the cluster registry (or read from the server once) when empty
+    token : Optional[str] = Field(default=None)
     server_ip : str
+    use_artifact_cache : bool = Field(default=False)
+    # Wait until the node shows up Ready on the server (same username/password), 0 skips it
+    ready_timeout : int = Field(default=300, ge=0)
+
+class joinNodes(BaseModel):
+    nodes : list[joinNode]
+    max_concurrency : int = Field(default=5, ge=1)
+
+class poolscaling(BaseModel):
+    rg: str
+    cluster_name: Optional[str] = Field(default=None, pattern=r"^[a-z][a-z0-9-]{0,19}$")
+    # Number of agent nodes in the scale set
+    capacity: int = Field(ge=0, le=1000)
+
+class pgvalues(BaseModel):
+    user_name: str = Field(default="user")
+    db_name: str = Field(default="db")
+    db_password: str = Field(default="password")
+    storage_size: str = Field(default="1Gi")
+    nodeport: int = Field(default=30000)
+    replica_count: int = Field(default=1)
+    autoscaling_enabled: bool = Field(default=False)
+    min_replicas: int = Field(default=1)
+    max_replicas: int = Field(default=3)
+    cpu_utilization: int = Field(default=80)
+
+class pgrelease(pgvalues):
+    # Helm release name and namespace, both must be valid Kubernetes names
+    name: str = Field(pattern=r"^[a-z0-9]([-a-z0-9]*[a-z0-9])?$", max_length=53)
+    namespace: str = Field(default="default", pattern=r"^[a-z0-9]([-a-z0-9]*[a-z0-9])?$", max_length=63)
+
+class pgfleet(ipinput):
+    releases: list[pgrelease] = Field(min_length=1)
+    # Helm installs running at once on the server
+    max_concurrency: int = Field(default=4, ge=1)
+    # Run Helm even for releases whose values didn't change since the last deploy
+    force: bool = Field(default=False)
+
+class clustercreation(vmcreation):
+    install_helm: bool = Field(default=True)
+    deploy_postgres: bool = Field(default=True)
+    postgres: pgvalues = Field(default_factory=pgvalues)
 
 class deploypg(BaseModel):
     ip_address: str
     username: str = Field(default="azureuser")
     password: str = Field(default="MyPassword123")
+    # Wait for the k3s API server before running Helm, 0 skips it
+    ready_timeout: int = Field(default=300, ge=0)
+    use_kube_api: bool = Field(default=False)
     user_name: str = Field(default="user")
     db_name: str = Field(default="db")
     db_password: str = Field(default="password")
@@ -34,4 +110,20 @@ class deploypg(BaseModel):
     min_replicas: int = Field(default=1)
     max_replicas: int = Field(default=3)
     cpu_utilization: int = Field(default=80)
+    # Run Helm even when the values didn't change since the last deploy
+    force: bool = Field(default=False)
+
+
+class readinesscheck(BaseModel):
+    hosts: list[str]
+    ports: list[int] = Field(default=[22, 6443])
+    # 0 probes once, otherwise keep probing for up to this many seconds
+    timeout: int = Field(default=0, ge=0)
+
+class nodesready(ipinput):
+    node_names: list[str] = Field(default=[])
+    expected_nodes: Optional[int] = Field(default=None, ge=1)
 
+class kubeapply(ipinput):
+    # Kubernetes objects as JSON, applied server-side in order
+    manifests: list[dict]
@@ -0,0 +1,188 @@
+# pipeline.py
+"""
+Small DAG scheduler used by the /clusters build.
+
+Each stage is a function that receives a dict with the results of the
+stages it depends on. A stage starts as soon as all of its dependencies
+have finished, so independent work (Helm install vs. worker joins, one VM
+vs. another) overlaps. Stages can be put in a group with a concurrency
+limit, e.g. to keep ARM calls under the throttling limits. By default
+there is a thread for every stage that is ready, so group limits are the
+only thing that holds a stage back; a fixed max_workers can leave a ready
+stage queued behind unrelated long-running ones.
+"""
+import contextvars
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from jobs import quiet_progress, report_progress
+from metrics import STAGE_SECONDS, stage_label, timed
+
+
+class Stage:
+    def __init__(self, name, fn, depends_on=(), group=None):
+        self.name = name
+        self.fn = fn
+        self.depends_on = list(depends_on)
+        self.group = group
+        self.status = "pending"
+        self.result = None
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def duration(self):
+        if self.started_at is None or self.finished_at is None:
+            return 0.0
+        return self.finished_at - self.started_at
+
+    def to_dict(self, origin):
+        return {
+            "status": self.status,
+            "depends_on": self.depends_on,
+            "start_offset_seconds": round(self.started_at - origin, 3) if self.started_at else None,
+            "duration_seconds": round(self.duration, 3),
+            "error": self.error,
+        }
+
+
+class PipelineError(Exception):
+    pass
+
+
+class PipelineFailed(PipelineError):
+    """Raised after a run with failed stages; `result` keeps the timing report."""
+
+    def __init__(self, message, result):
+        super().__init__(message)
+        self.result = result
+
+
+class DagScheduler:
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.stages = {}
+        self.limits = {}
+
+    def add(self, name, fn, depends_on=(), group=None):
+        if name in self.stages:
+            raise PipelineError(f"Duplicate stage {name}")
+        self.stages[name] = Stage(name, fn, depends_on, group)
+        return self.stages[name]
+
+    def limit(self, group, max_running):
+        self.limits[group] = max_running
+
+    def _check(self):
+        for stage in self.stages.values():
+            for dep in stage.depends_on:
+                if dep not in self.stages:
+                    raise PipelineError(f"Stage {stage.name} depends on unknown stage {dep}")
+        # Kahn's algorithm, anything left over is part of a cycle
+        remaining = {name: set(stage.depends_on) for name, stage in self.stages.items()}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise PipelineError(f"Dependency cycle between stages {sorted(remaining)}")
+            for name in ready:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+    def _run_stage(self, stage, inputs):
+        # Stage code may call report_progress(); the scheduler owns the job's progress bar
+        with quiet_progress(), timed(STAGE_SECONDS, stage=stage_label(stage.name)):
+            stage.started_at = time.time()
+            try:
+                return stage.fn(inputs)
+            finally:
+                stage.finished_at = time.time()
+
+    def run(self):
+        """Run every stage; stages downstream of a failure are skipped, the rest keep going."""
+        self._check()
+        origin = time.time()
+        running = {}
+        running_per_group = {}
+        done = 0
+
+        def ready_stages():
+            for stage in self.stages.values():
+                if stage.status != "pending":
+                    continue
+                deps = [self.stages[dep] for dep in stage.depends_on]
+                if any(dep.status in ("failed", "skipped") for dep in deps):
+                    stage.status = "skipped"
+                    stage.error = "dependency failed"
+                    continue
+                if all(dep.status == "succeeded" for dep in deps):
+                    yield stage
+
+        # Threads are only started when a stage is submitted, so this is the peak of ready stages
+        max_workers = self.max_workers or max(1, len(self.stages))
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage") as executor:
+            while True:
+                for stage in list(ready_stages()):
+                    limit = self.limits.get(stage.group)
+                    if limit is not None and running_per_group.get(stage.group, 0) >= limit:
+                        continue
+                    inputs = {dep: self.stages[dep].result for dep in stage.depends_on}
+                    stage.status = "running"
+                    running_per_group[stage.group] = running_per_group.get(stage.group, 0) + 1
+                    future = executor.submit(contextvars.copy_context().run, self._run_stage, stage, inputs)
+                    running[future] = stage
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    running_per_group[stage.group] -= 1
+                    try:
+                        stage.result = future.result()
+                        stage.status = "succeeded"
+                    except Exception as e:
+                        stage.error = getattr(e, "detail", None) or str(e)
+                        stage.status = "failed"
+                    done += 1
+                    # Muted when this scheduler runs inside another one's stage
+                    report_progress(100 * done // len(self.stages), f"{stage.name} {stage.status}")
+
+        # Anything still pending was skipped by an upstream failure
+        for stage in self.stages.values():
+            if stage.status == "pending":
+                stage.status = "skipped"
+                stage.error = "dependency failed"
+
+        return self.report(origin)
+
+    def critical_path(self):
+        """Chain of stages that ended last, following the dependency that finished latest."""
+        finished = [stage for stage in self.stages.values() if stage.finished_at]
+        if not finished:
+            return []
+        stage = max(finished, key=lambda s: s.finished_at)
+        path = []
+        while stage is not None:
+            deps = [self.stages[dep] for dep in stage.depends_on if self.stages[dep].finished_at]
+            previous = max(deps, key=lambda s: s.finished_at) if deps else None
+            # Time between the last dependency finishing and this stage starting (worker or group limit queueing)
+            ready_at = previous.finished_at if previous else stage.started_at
+            path.append({
+                "stage": stage.name,
+                "duration_seconds": round(stage.duration, 3),
+                "queued_seconds": round(max(0.0, stage.started_at - ready_at), 3),
+            })
+            stage = previous
+        path.reverse()
+        return path
+
+    def report(self, origin):
+        ends = [stage.finished_at for stage in self.stages.values() if stage.finished_at]
+        return {
+            "succeeded": all(stage.status == "succeeded" for stage in self.stages.values()),
+            "total_seconds": round(max(ends) - origin, 3) if ends else 0.0,
+            "stages": {name: stage.to_dict(origin) for name, stage in self.stages.items()},
+            "critical_path": self.critical_path(),
+        }
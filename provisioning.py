@@ -0,0 +1,441 @@
+# provisioning.py
+import contextvars
+import ipaddress
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import cloud_init
+from jobs import report_progress
+
+# Upper bound on VM chains (public IP -> NIC -> VM) running at the same time.
+# Keeps a big /create-vms call under the ARM write throttling limits.
+DEFAULT_MAX_CONCURRENCY = 5
+
+# Address space of the original single-cluster layout (myVnet)
+DEFAULT_ADDRESS_SPACE = "10.0.0.0/16"
+
+
+class ClusterLayout:
+    """
+    Azure resource names and address space of one cluster.
+
+    Without a cluster name this is the original layout (myNSG, myVnet,
+    myVM-1, ... on 10.0.0.0/16), so existing resource groups keep working.
+    With one, every resource is prefixed with it and the cluster gets its own
+    VNet on the address space allocated to it, so several clusters can be
+    built in one resource group at the same time without touching each
+    other's resources.
+    """
+
+    def __init__(self, cluster_name=None, address_space=DEFAULT_ADDRESS_SPACE):
+        self.cluster_name = cluster_name
+        self.address_space = address_space
+        self.subnet_prefix = str(next(ipaddress.ip_network(address_space).subnets(new_prefix=24)))
+        if cluster_name:
+            self.nsg = f"{cluster_name}-nsg"
+            self.vnet = f"{cluster_name}-vnet"
+            self.subnet = f"{cluster_name}-subnet"
+            self.vm_prefix = f"{cluster_name}-vm-"
+            self.node_pool = f"{cluster_name}-pool"
+        else:
+            self.nsg = "myNSG"
+            self.vnet = "myVnet"
+            self.subnet = "mySubnet"
+            self.vm_prefix = "myVM-"
+            self.node_pool = "myNodePool"
+
+    def vm_name(self, index):
+        return f"{self.vm_prefix}{index}"
+
+    def public_ip(self, index):
+        return f"{self.cluster_name}-ip-{index}" if self.cluster_name else f"myPublicIP-{index}"
+
+    def nic(self, index):
+        return f"{self.cluster_name}-nic-{index}" if self.cluster_name else f"myNic-{index}"
+
+    def ip_config(self, index):
+        return f"{self.cluster_name}-ipconfig-{index}" if self.cluster_name else f"myIpConfig-{index}"
+
+    def dns_label(self, index, rg):
+        # Has to be unique in the region
+        if self.cluster_name:
+            return f"{self.cluster_name}-{index}-{rg.lower()}"
+        return f"vm-dns-{index}-{rg.lower()}"
+
+
+_cluster_locks = defaultdict(threading.Lock)
+_cluster_locks_guard = threading.Lock()
+
+
+def cluster_lock(cluster_id):
+    """Process-wide lock for one cluster: two builds of the same cluster run one after the other."""
+    with _cluster_locks_guard:
+        return _cluster_locks[cluster_id]
+
+
+def nsg_parameters(location):
+    """Inbound rules for SSH, the k3s API server and the Postgres NodePort."""
+    rules = [
+        ("AllowSSH", "22", 100),
+        ("AllowK3s", "6443", 200),
+        ("AllowPG", "30000", 210),
+    ]
+    return {
+        "location": location,
+        "security_rules": [
+            {
+                "name": name,
+                "protocol": "Tcp",
+                "source_port_range": "*",
+                "destination_port_range": port,
+                "source_address_prefix": "*",
+                "destination_address_prefix": "*",
+                "access": "Allow",
+                "priority": priority,
+                "direction": "Inbound"
+            }
+            for name, port, priority in rules
+        ]
+    }
+
+
+def _same_id(a, b):
+    # ARM doesn't guarantee the casing of resource ids
+    return (a or "").lower() == (b or "").lower()
+
+
+class Reconciler:
+    """
+    Desired-state diff for /create-vms?reconcile=true.
+
+    Lists what already exists in the resource group once (one call per
+    resource type), then ensure() only sends a PUT for resources that are
+    missing or differ from what we would create. Every decision is kept in
+    `changes` for the response.
+    """
+
+    def __init__(self, vm, resource_client, network_client, compute_client, layout=None):
+        self.vm = vm
+        self.layout = layout or ClusterLayout()
+        self.resource_client = resource_client
+        self.network_client = network_client
+        self.compute_client = compute_client
+        self.existing = None
+        self.changes = {"created": [], "updated": [], "unchanged": []}
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self.existing is not None:
+                return
+            rg = self.vm.rg
+            existing = {}
+            if self.resource_client.resource_groups.check_existence(rg):
+                existing["resource_group", rg] = rg
+                for nsg in self.network_client.network_security_groups.list(rg):
+                    existing["nsg", nsg.name] = nsg
+                for vnet in self.network_client.virtual_networks.list(rg):
+                    existing["vnet", vnet.name] = vnet
+                    for subnet in vnet.subnets or []:
+                        existing["subnet", f"{vnet.name}/{subnet.name}"] = subnet
+                for public_ip in self.network_client.public_ip_addresses.list(rg):
+                    existing["public_ip", public_ip.name] = public_ip
+                for nic in self.network_client.network_interfaces.list(rg):
+                    existing["nic", nic.name] = nic
+                for machine in self.compute_client.virtual_machines.list(rg):
+                    existing["vm", machine.name] = machine
+                if self.vm.node_pool == "vmss":
+                    for scale_set in self.compute_client.virtual_machine_scale_sets.list(rg):
+                        existing["vmss", scale_set.name] = scale_set
+            self.existing = existing
+
+    def ensure(self, kind, name, matches, create, update=None):
+        self.load()
+        current = self.existing.get((kind, name))
+        if current is not None and matches(current):
+            action = "unchanged"
+            result = current
+        elif current is not None:
+            action = "updated"
+            result = update(current) if update is not None else create()
+        else:
+            action = "created"
+            result = create()
+        with self._lock:
+            self.changes[action].append(f"{kind}/{name}")
+        return result
+
+    def extra_vms(self):
+        """This cluster's VMs beyond vm_count. Scale-down is not automatic, they are only reported."""
+        self.load()
+        prefix = self.layout.vm_prefix
+        wanted = {self.layout.vm_name(i) for i in range(1, self.vm.vm_count + 1)}
+        return sorted(
+            name for kind, name in self.existing
+            if kind == "vm" and name.startswith(prefix) and name[len(prefix):].isdigit() and name not in wanted
+        )
+
+
+def ensure(reconciler, kind, name, matches, create, update=None):
+    """create() unless the reconciler knows an existing resource that already matches."""
+    if reconciler is None:
+        return create()
+    return reconciler.ensure(kind, name, matches, create, update)
+
+
+def _nsg_matches(nsg, desired):
+    have = {(rule.name, rule.destination_port_range, rule.priority) for rule in nsg.security_rules or []}
+    want = {(rule["name"], rule["destination_port_range"], rule["priority"]) for rule in desired["security_rules"]}
+    return want <= have
+
+
+def create_network(vm, resource_client, network_client, reconciler=None, layout=None):
+    """Create the resource group, and the cluster's NSG, VNet and subnet shared by its VMs."""
+    layout = layout or ClusterLayout()
+    ensure(reconciler, "resource_group", vm.rg, lambda current: True, lambda: resource_client.resource_groups.create_or_update(
+        vm.rg,
+        {"location": vm.location}
+    ))
+
+    # The NSG and the VNet don't depend on each other, so start both before waiting
+    nsg_params = nsg_parameters(vm.location)
+    nsg_poller = ensure(reconciler, "nsg", layout.nsg, lambda current: _nsg_matches(current, nsg_params), lambda: network_client.network_security_groups.begin_create_or_update(
+        vm.rg,
+        layout.nsg,
+        nsg_params
+    ))
+    vnet_poller = ensure(reconciler, "vnet", layout.vnet, lambda current: layout.address_space in current.address_space.address_prefixes, lambda: network_client.virtual_networks.begin_create_or_update(
+        vm.rg,
+        layout.vnet,
+        {
+            "location": vm.location,
+            "address_space": {"address_prefixes": [layout.address_space]}
+        }
+    ))
+    _wait(vnet_poller)
+
+    subnet = _wait(ensure(reconciler, "subnet", f"{layout.vnet}/{layout.subnet}", lambda current: current.address_prefix == layout.subnet_prefix, lambda: network_client.subnets.begin_create_or_update(
+        vm.rg,
+        layout.vnet,
+        layout.subnet,
+        {"address_prefix": layout.subnet_prefix}
+    )))
+
+    return _wait(nsg_poller), subnet
+
+
+def _wait(value):
+    """Result of a poller, or the value itself when ensure() returned an existing resource."""
+    return value.result() if hasattr(value, "result") else value
+
+
+def create_vm(vm, index, nsg, subnet, network_client, compute_client, k3s_token=None, reconciler=None, layout=None):
+    """
+    Create the public IP, NIC and VM for node `index` (1-based) and return its vm_ips entry.
+
+    With a k3s_token the VM gets cloud-init custom_data: node 1 boots as the
+    k3s server on a static private IP, the others as agents joining it.
+    """
+    layout = layout or ClusterLayout()
+    vm_name = layout.vm_name(index)
+
+    # Create a unique Public IP with a DNS label for the VM
+    dns_label = layout.dns_label(index, vm.rg)
+    public_ip = _wait(ensure(
+        reconciler,
+        "public_ip",
+        layout.public_ip(index),
+        lambda current: current.dns_settings is not None and current.dns_settings.domain_name_label == dns_label,
+        lambda: network_client.public_ip_addresses.begin_create_or_update(
+            vm.rg,
+            layout.public_ip(index),
+            {
+                "location": vm.location,
+                "sku": {"name": "Standard"},
+                "public_ip_allocation_method": "Static",
+                "dns_settings": {"domain_name_label": dns_label}
+            }
+        )
+    ))
+
+    ip_configuration = {
+        "name": layout.ip_config(index),
+        "subnet": {"id": subnet.id},
+        "public_ip_address": {"id": public_ip.id}
+    }
+    os_profile = {
+        "computer_name": vm_name,
+        "admin_username": vm.username,
+        "admin_password": vm.password
+    }
+    if k3s_token:
+        server_ip = cloud_init.primary_private_ip(subnet.address_prefix)
+        if index == 1:
+            ip_configuration["private_ip_allocation_method"] = "Static"
+            ip_configuration["private_ip_address"] = server_ip
+            script = cloud_init.server_script(k3s_token, server_ip, vm.username, public_ip.ip_address)
+        else:
+            script = cloud_init.agent_script(k3s_token, server_ip)
+        os_profile["custom_data"] = cloud_init.encode(script)
+
+    def nic_matches(current):
+        config = current.ip_configurations[0] if current.ip_configurations else None
+        return (
+            config is not None
+            and config.public_ip_address is not None
+            and _same_id(config.public_ip_address.id, public_ip.id)
+            and current.network_security_group is not None
+            and _same_id(current.network_security_group.id, nsg.id)
+            and ip_configuration.get("private_ip_address") in (None, config.private_ip_address)
+        )
+
+    # Network Interface with NSG, needs the public IP id
+    nic = _wait(ensure(reconciler, "nic", layout.nic(index), nic_matches, lambda: network_client.network_interfaces.begin_create_or_update(
+        vm.rg,
+        layout.nic(index),
+        {
+            "location": vm.location,
+            "ip_configurations": [ip_configuration],
+            "network_security_group": {"id": nsg.id}
+        }
+    )))
+
+    # Create the VM on top of the NIC. An existing VM is only resized, ARM
+    # doesn't allow changing its os_profile or image in place.
+    def resize(current):
+        return compute_client.virtual_machines.begin_update(
+            vm.rg,
+            vm_name,
+            {"hardware_profile": {"vm_size": vm.vm_size}}
+        )
+
+    _wait(ensure(reconciler, "vm", vm_name, lambda current: current.hardware_profile.vm_size == vm.vm_size, lambda: compute_client.virtual_machines.begin_create_or_update(
+        vm.rg,
+        vm_name,
+        {
+            "location": vm.location,
+            "hardware_profile": {"vm_size": vm.vm_size},
+            "storage_profile": {
+                "image_reference": cloud_init.image_reference(vm)
+            },
+            "os_profile": os_profile,
+            "network_profile": {
+                "network_interfaces": [{"id": nic.id}]
+            }
+        }
+    ), resize))
+
+    return {"vm_name": vm_name, "public_ip": public_ip.ip_address, "dns_name": public_ip.dns_settings.fqdn}
+
+
+def node_pool_parameters(vm, layout, nsg, subnet, capacity, k3s_token):
+    """
+    Scale set for the agent nodes: private IPs only, each instance joins
+    the k3s server at node 1's static private IP through cloud-init.
+    """
+    server_ip = cloud_init.primary_private_ip(subnet.address_prefix)
+    profile = {
+        "os_profile": {
+            "computer_name_prefix": layout.node_pool.lower(),
+            "admin_username": vm.username,
+            "admin_password": vm.password,
+            "custom_data": cloud_init.encode(cloud_init.agent_script(k3s_token, server_ip)),
+        },
+        "storage_profile": {"image_reference": cloud_init.image_reference(vm)},
+        "network_profile": {
+            "network_interface_configurations": [{
+                "name": f"{layout.node_pool}-nic",
+                "primary": True,
+                "network_security_group": {"id": nsg.id},
+                "ip_configurations": [{"name": f"{layout.node_pool}-ipconfig", "subnet": {"id": subnet.id}}],
+            }]
+        },
+    }
+    if vm.spot:
+        # Evicted instances are deleted, the scale set keeps trying to get back to capacity
+        profile["priority"] = "Spot"
+        profile["eviction_policy"] = "Delete"
+        profile["billing_profile"] = {"max_price": vm.spot_max_price}
+    return {
+        "location": vm.location,
+        "sku": {"name": vm.vm_size, "tier": "Standard", "capacity": capacity},
+        "upgrade_policy": {"mode": "Manual"},
+        "overprovision": False,
+        "virtual_machine_profile": profile,
+    }
+
+
+def create_node_pool(vm, nsg, subnet, compute_client, k3s_token, reconciler=None, layout=None):
+    """All agent nodes (vm_count - 1) in one ARM operation. Returns the node pool entry for the response."""
+    layout = layout or ClusterLayout()
+    capacity = vm.vm_count - 1
+
+    def matches(current):
+        return current.sku.capacity == capacity and current.sku.name == vm.vm_size
+
+    def resize(current):
+        # The instance model (image, cloud-init) stays, only size and capacity change
+        return compute_client.virtual_machine_scale_sets.begin_update(
+            vm.rg,
+            layout.node_pool,
+            {"sku": {"name": vm.vm_size, "tier": "Standard", "capacity": capacity}}
+        )
+
+    _wait(ensure(reconciler, "vmss", layout.node_pool, matches, lambda: compute_client.virtual_machine_scale_sets.begin_create_or_update(
+        vm.rg,
+        layout.node_pool,
+        node_pool_parameters(vm, layout, nsg, subnet, capacity, k3s_token)
+    ), resize))
+    return {"name": layout.node_pool, "capacity": capacity, "priority": "Spot" if vm.spot else "Regular"}
+
+
+def scale_node_pool(rg, name, capacity, compute_client):
+    """Set the scale set's capacity. New instances join k3s at boot; removed ones stay NotReady in k3s until deleted there."""
+    compute_client.virtual_machine_scale_sets.begin_update(rg, name, {"sku": {"capacity": capacity}}).result()
+    return {"name": name, "capacity": capacity}
+
+
+def provision_node_pool(vm, resource_client, network_client, compute_client, k3s_token, reconciler=None, layout=None):
+    """
+    node_pool="vmss": node 1 is a VM with a public IP (the k3s server) and
+    every agent is in one scale set, both created at the same time.
+    Returns (vm_ips, node pool entry or None).
+    """
+    report_progress(5, "creating network")
+    nsg, subnet = create_network(vm, resource_client, network_client, reconciler, layout)
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="provision") as executor:
+        server = executor.submit(contextvars.copy_context().run, create_vm, vm, 1, nsg, subnet, network_client, compute_client, k3s_token, reconciler, layout)
+        pool = None
+        if vm.vm_count > 1:
+            pool = executor.submit(contextvars.copy_context().run, create_node_pool, vm, nsg, subnet, compute_client, k3s_token, reconciler, layout)
+        vm_ips = [server.result()]
+        report_progress(60, f"{vm_ips[0]['vm_name']} created")
+        return vm_ips, pool.result() if pool is not None else None
+
+
+def provision_vms(vm, resource_client, network_client, compute_client, max_concurrency=None, k3s_token=None, reconciler=None, layout=None):
+    """
+    Create the shared network and then every VM chain in parallel.
+
+    Each VM still waits on its own public IP and NIC, but the chains of
+    different VMs overlap. At most `max_concurrency` chains are in flight.
+    Results come back ordered by VM index, same as the old sequential loop.
+    """
+    report_progress(5, "creating network")
+    nsg, subnet = create_network(vm, resource_client, network_client, reconciler, layout)
+
+    if vm.vm_count < 1:
+        return []
+
+    workers = min(max_concurrency or DEFAULT_MAX_CONCURRENCY, vm.vm_count)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="provision") as executor:
+        # Each chain runs in a copy of the caller's context, so its ARM calls keep the trace id
+        futures = [
+            executor.submit(contextvars.copy_context().run, create_vm, vm, i, nsg, subnet, network_client, compute_client, k3s_token, reconciler, layout)
+            for i in range(1, vm.vm_count + 1)
+        ]
+        for done, future in enumerate(as_completed(futures), start=1):
+            if future.exception() is None:
+                report_progress(10 + 90 * done // len(futures), f"{future.result()['vm_name']} created")
+        return [future.result() for future in futures]
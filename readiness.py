@@ -0,0 +1,180 @@
+# readiness.py
+"""
+Wait for a node to be ready for the next step instead of sleeping or
+failing and retrying.
+
+Port probes use asyncio, so checking SSH on 50 VMs at once costs one
+thread. Port 22 counts as ready once sshd sends its banner, because a port
+that only accepts the connection isn't enough. k3s readiness comes from
+kubectl on the server: /readyz for the API server and the Ready condition
+of each node.
+
+    wait_for_ssh(vm_ip["public_ip"], timeout=300)
+    with ssh_pool.connection(server_ip, username, password) as client:
+        wait_for_nodes(client, names=["myvm-2"])
+"""
+import asyncio
+import os
+import time
+
+from remote import run_command
+
+SSH_PORT = 22
+K3S_API_PORT = 6443
+SSH_READY_TIMEOUT = int(os.environ.get("SSH_READY_TIMEOUT", 300))
+NODE_READY_TIMEOUT = int(os.environ.get("NODE_READY_TIMEOUT", 300))
+PROBE_TIMEOUT = 3
+POLL_INTERVAL = 2
+KUBECTL_POLL_INTERVAL = 5
+
+KUBECTL = "export KUBECONFIG=/etc/rancher/k3s/k3s.yaml && kubectl"
+# name<TAB>True|False|Unknown per line, keeps the output small for big clusters
+_NODES_JSONPATH = '{range .items[*]}{.metadata.name}{"\\t"}{.status.conditions[?(@.type=="Ready")].status}{"\\n"}{end}'
+
+
+class NotReady(TimeoutError):
+    pass
+
+
+class Prober:
+    def __init__(self, open_connection=asyncio.open_connection, probe_timeout=PROBE_TIMEOUT, interval=POLL_INTERVAL):
+        self.open_connection = open_connection
+        self.probe_timeout = probe_timeout
+        self.interval = interval
+
+    async def probe(self, host, port):
+        """One connection attempt, True if the port (and for 22, sshd) answered."""
+        try:
+            reader, writer = await asyncio.wait_for(self.open_connection(host, port), self.probe_timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        try:
+            if port == SSH_PORT:
+                banner = await asyncio.wait_for(reader.readline(), self.probe_timeout)
+                return banner.startswith(b"SSH-")
+            return True
+        except (OSError, asyncio.TimeoutError):
+            return False
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def wait(self, host, port, timeout):
+        """Probe until ready, returns the seconds it took. Raises NotReady after `timeout`."""
+        start = time.monotonic()
+        deadline = start + timeout
+        while True:
+            if await self.probe(host, port):
+                return time.monotonic() - start
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise NotReady(f"{host}:{port} not ready after {timeout}s")
+            await asyncio.sleep(min(self.interval, remaining))
+
+    async def wait_all(self, targets, timeout):
+        """Wait for every (host, port) concurrently, one result dict per target."""
+        outcomes = await asyncio.gather(*(self.wait(host, port, timeout) for host, port in targets), return_exceptions=True)
+        results = []
+        for (host, port), outcome in zip(targets, outcomes):
+            failed = isinstance(outcome, Exception)
+            results.append({
+                "host": host,
+                "port": port,
+                "ready": not failed,
+                "seconds": None if failed else round(outcome, 3),
+                "error": str(outcome) if failed else None,
+            })
+        return results
+
+
+prober = Prober()
+
+
+# Blocking wrappers for code running in worker threads (endpoints, pipeline stages)
+def wait_for_ssh(host, timeout=SSH_READY_TIMEOUT):
+    return asyncio.run(prober.wait(host, SSH_PORT, timeout))
+
+
+def wait_for_port(host, port, timeout=SSH_READY_TIMEOUT):
+    return asyncio.run(prober.wait(host, port, timeout))
+
+
+def wait_for_ports(targets, timeout=SSH_READY_TIMEOUT):
+    return asyncio.run(prober.wait_all(targets, timeout))
+
+
+def _poll(check, timeout, interval, what):
+    start = time.monotonic()
+    deadline = start + timeout
+    last = None
+    while True:
+        done, last = check()
+        if done:
+            return last, time.monotonic() - start
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise NotReady(f"{what} not ready after {timeout}s, last seen: {last}")
+        time.sleep(min(interval, remaining))
+
+
+# Every check takes either an SSH client (runs kubectl on the server) or a kube_api.KubeClient
+
+def api_server_ready(client):
+    if hasattr(client, "readyz"):
+        return client.readyz()
+    try:
+        result = run_command(client, f"{KUBECTL} get --raw=/readyz", timeout=30)
+    except TimeoutError:
+        return False
+    return result.ok and result.stdout.strip() == "ok"
+
+
+def wait_for_api_server(client, timeout=NODE_READY_TIMEOUT, interval=KUBECTL_POLL_INTERVAL):
+    """Poll the API server's /readyz on the connected k3s server until it says ok."""
+    def check():
+        ok = api_server_ready(client)
+        return ok, ok
+
+    _, seconds = _poll(check, timeout, interval, "k3s API server")
+    return seconds
+
+
+def node_status(client):
+    """{node name: Ready?} from kubectl on the connected server, None while the API isn't answering."""
+    if hasattr(client, "node_status"):
+        return client.node_status()
+    try:
+        result = run_command(client, f"{KUBECTL} get nodes -o jsonpath='{_NODES_JSONPATH}'", timeout=30)
+    except TimeoutError:
+        return None
+    if not result.ok:
+        return None
+    nodes = {}
+    for line in result.stdout.splitlines():
+        parts = line.split("\t")
+        if len(parts) == 2 and parts[0]:
+            nodes[parts[0]] = parts[1].strip() == "True"
+    return nodes
+
+
+def wait_for_nodes(client, names=(), count=None, timeout=NODE_READY_TIMEOUT, interval=KUBECTL_POLL_INTERVAL):
+    """
+    Poll until the named nodes (or at least `count` nodes) are Ready. Node
+    names are compared case-insensitively, Kubernetes lowercases hostnames.
+    Returns ({node: ready}, seconds waited).
+    """
+    wanted = {name.lower() for name in names}
+
+    def check():
+        nodes = node_status(client)
+        if nodes is None:
+            return False, None
+        ready = {name.lower() for name, ok in nodes.items() if ok}
+        if wanted:
+            return wanted <= ready, nodes
+        return len(ready) >= (count or 1), nodes
+
+    return _poll(check, timeout, interval, f"k3s nodes {sorted(wanted) or count or 1}")
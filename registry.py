@@ -0,0 +1,331 @@
+# registry.py
+"""
+Server-side record of every cluster this API has touched: VMs and IPs, the
+k3s join token, Helm releases and secrets read from the cluster.
+
+Stored in SQLite (CLUSTER_REGISTRY_DB) so it survives restarts. Reads go
+through a TTL cache, so a repeat lookup is a dict hit instead of an SSH
+round trip. Every write drops the cluster's cached entries, and
+POST /clusters/{id}/invalidate does it by hand.
+
+A cluster created through /create-vms or /clusters is keyed by its resource
+group, or "<resource group>:<cluster_name>" when it has a name. VMs we
+didn't create are keyed by their k3s server's IP. Named clusters also get
+their VNet address space allocated here, so no two of them overlap.
+"""
+import ipaddress
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+DB_PATH = Path(os.environ.get("CLUSTER_REGISTRY_DB", Path.home() / ".cache" / "k3s-api" / "registry.db"))
+CACHE_TTL = float(os.environ.get("CLUSTER_CACHE_TTL", 300))
+# Named clusters get one block of this size each out of the pool
+ADDRESS_POOL = os.environ.get("CLUSTER_ADDRESS_POOL", "10.0.0.0/8")
+ADDRESS_PREFIX_LENGTH = int(os.environ.get("CLUSTER_ADDRESS_PREFIX_LENGTH", 16))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clusters (
+    id TEXT PRIMARY KEY, rg TEXT, location TEXT, server_ip TEXT, token TEXT, created_at REAL, updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS vms (
+    cluster_id TEXT, name TEXT, public_ip TEXT, dns_name TEXT, role TEXT, node_name TEXT, updated_at REAL,
+    PRIMARY KEY (cluster_id, name)
+);
+CREATE INDEX IF NOT EXISTS vms_public_ip ON vms (public_ip);
+CREATE TABLE IF NOT EXISTS releases (
+    cluster_id TEXT, namespace TEXT, name TEXT, chart TEXT, status TEXT, values_hash TEXT, updated_at REAL,
+    PRIMARY KEY (cluster_id, namespace, name)
+);
+CREATE TABLE IF NOT EXISTS secrets (
+    cluster_id TEXT, name TEXT, value TEXT, updated_at REAL, PRIMARY KEY (cluster_id, name)
+);
+CREATE TABLE IF NOT EXISTS address_spaces (
+    prefix TEXT PRIMARY KEY, cluster_id TEXT UNIQUE, allocated_at REAL
+);
+"""
+
+
+class TTLCache:
+    """Tuple keys, so a whole cluster's entries can be dropped by prefix."""
+
+    def __init__(self, ttl=CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """Cached value for `key`, or load() it. None is never cached."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = load()
+        if value is not None:
+            with self._lock:
+                self._entries[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self, *prefix):
+        with self._lock:
+            keys = [key for key in self._entries if key[:len(prefix)] == prefix]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "ttl_seconds": self.ttl}
+
+
+class ClusterRegistry:
+    def __init__(self, path=DB_PATH, ttl=CACHE_TTL):
+        self.path = Path(path)
+        self.cache = TTLCache(ttl)
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _conn(self):
+        # Opened on first use so importing main doesn't touch the disk
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            # Holds join tokens and passwords
+            os.chmod(self.path, 0o600)
+            self._db = db
+        return self._db
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return [dict(row) for row in self._conn().execute(sql, params).fetchall()]
+
+    def _write(self, cluster_id, statements):
+        now = time.time()
+        with self._lock:
+            db = self._conn()
+            with db:
+                db.execute(
+                    "INSERT INTO clusters (id, created_at, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET updated_at = excluded.updated_at",
+                    (cluster_id, now, now),
+                )
+                for sql, params in statements:
+                    db.execute(sql, params)
+        self.invalidate(cluster_id)
+
+    def invalidate(self, cluster_id):
+        # IP -> cluster lookups are cheap to rebuild, drop them all
+        self.cache.invalidate("ip")
+        return self.cache.invalidate("cluster", cluster_id)
+
+    def cluster_for_ip(self, ip):
+        """Id of the cluster a VM or k3s server IP belongs to, or None."""
+        def load():
+            # Clusters first seen through a secret or release are keyed by the IP itself
+            rows = self._query(
+                "SELECT id FROM clusters WHERE server_ip = ? OR id = ? "
+                "UNION SELECT cluster_id FROM vms WHERE public_ip = ? LIMIT 1",
+                (ip, ip, ip),
+            )
+            return rows[0]["id"] if rows else None
+
+        return self.cache.get(("ip", ip), load)
+
+    def _cluster_or_new(self, ip):
+        return self.cluster_for_ip(ip) or ip
+
+    def _upsert_vm(self, cluster_id, ip, role, node_name=None):
+        """Update the VM row with this IP, or add one named after the IP."""
+        existing = self._query("SELECT name FROM vms WHERE cluster_id = ? AND public_ip = ?", (cluster_id, ip))
+        name = existing[0]["name"] if existing else ip
+        return (
+            "INSERT INTO vms (cluster_id, name, public_ip, role, node_name, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(cluster_id, name) DO UPDATE SET role = excluded.role, "
+            "node_name = coalesce(excluded.node_name, node_name), updated_at = excluded.updated_at",
+            (cluster_id, name, ip, role, node_name, time.time()),
+        )
+
+    def _server_replaced(self, cluster_id, server_ip):
+        """
+        Statements dropping what the registry knows about the old k3s server when
+        the cluster's server IP changes: a rebuilt cluster has none of its releases
+        or secrets (kubeconfig, Grafana password). Must run before server_ip is set.
+        """
+        changed = "EXISTS (SELECT 1 FROM clusters WHERE id = ? AND server_ip IS NOT NULL AND server_ip != ?)"
+        return [
+            (f"DELETE FROM releases WHERE cluster_id = ? AND {changed}", (cluster_id, cluster_id, server_ip)),
+            (f"DELETE FROM secrets WHERE cluster_id = ? AND {changed}", (cluster_id, cluster_id, server_ip)),
+        ]
+
+    # Writes
+
+    def record_vms(self, cluster_id, vm_ips, rg=None, location=None, token=None, server_name="myVM-1"):
+        """vm_ips entries as returned by /create-vms. `server_name` is the k3s server."""
+        now = time.time()
+        statements = [(
+            "UPDATE clusters SET rg = coalesce(?, rg), location = coalesce(?, location), token = coalesce(?, token) WHERE id = ?",
+            (rg, location, token, cluster_id),
+        )]
+        for vm_ip in vm_ips:
+            role = "server" if vm_ip["vm_name"] == server_name else "agent"
+            statements.append((
+                "INSERT INTO vms (cluster_id, name, public_ip, dns_name, role, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(cluster_id, name) DO UPDATE SET public_ip = excluded.public_ip, "
+                "dns_name = excluded.dns_name, updated_at = excluded.updated_at",
+                (cluster_id, vm_ip["vm_name"], vm_ip["public_ip"], vm_ip["dns_name"], role, now),
+            ))
+            if role == "server":
+                statements += self._server_replaced(cluster_id, vm_ip["public_ip"])
+                statements.append(("UPDATE clusters SET server_ip = ? WHERE id = ?", (vm_ip["public_ip"], cluster_id)))
+        self._write(cluster_id, statements)
+
+    def record_server(self, server_ip, token):
+        cluster_id = self._cluster_or_new(server_ip)
+        self._write(cluster_id, self._server_replaced(cluster_id, server_ip) + [
+            ("UPDATE clusters SET server_ip = ?, token = ? WHERE id = ?", (server_ip, token, cluster_id)),
+            self._upsert_vm(cluster_id, server_ip, "server"),
+        ])
+        return cluster_id
+
+    def record_node(self, server_ip, ip, node_name=None):
+        cluster_id = self._cluster_or_new(server_ip)
+        self._write(cluster_id, [
+            ("UPDATE clusters SET server_ip = coalesce(server_ip, ?) WHERE id = ?", (server_ip, cluster_id)),
+            self._upsert_vm(cluster_id, ip, "agent", node_name),
+        ])
+        return cluster_id
+
+    def record_release(self, ip, name, namespace, chart, status, values_hash=None):
+        cluster_id = self._cluster_or_new(ip)
+        self._write(cluster_id, [(
+            "INSERT INTO releases (cluster_id, namespace, name, chart, status, values_hash, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(cluster_id, namespace, name) DO UPDATE SET "
+            "chart = excluded.chart, status = excluded.status, values_hash = excluded.values_hash, "
+            "updated_at = excluded.updated_at",
+            (cluster_id, namespace, name, chart, status, values_hash, time.time()),
+        )])
+        return cluster_id
+
+    def record_secret(self, ip, name, value):
+        cluster_id = self._cluster_or_new(ip)
+        self._write(cluster_id, [(
+            "INSERT INTO secrets (cluster_id, name, value, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(cluster_id, name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+            (cluster_id, name, value, time.time()),
+        )])
+        return cluster_id
+
+    def allocate_address_space(self, cluster_id, reserved=()):
+        """
+        The cluster's VNet address space: the block it was given before, or
+        the first free one in ADDRESS_POOL that isn't in `reserved`.
+        """
+        with self._lock:
+            db = self._conn()
+            row = db.execute("SELECT prefix FROM address_spaces WHERE cluster_id = ?", (cluster_id,)).fetchone()
+            if row is not None:
+                return row["prefix"]
+            taken = {row["prefix"] for row in db.execute("SELECT prefix FROM address_spaces")} | set(reserved)
+            prefix = next(
+                (str(block) for block in ipaddress.ip_network(ADDRESS_POOL).subnets(new_prefix=ADDRESS_PREFIX_LENGTH) if str(block) not in taken),
+                None,
+            )
+            if prefix is None:
+                raise Exception(f"No free /{ADDRESS_PREFIX_LENGTH} left in {ADDRESS_POOL}")
+            now = time.time()
+            with db:
+                db.execute(
+                    "INSERT INTO clusters (id, created_at, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET updated_at = excluded.updated_at",
+                    (cluster_id, now, now),
+                )
+                db.execute("INSERT INTO address_spaces (prefix, cluster_id, allocated_at) VALUES (?, ?, ?)", (prefix, cluster_id, now))
+        self.invalidate(cluster_id)
+        return prefix
+
+    def forget_secret(self, ip, name):
+        cluster_id = self.cluster_for_ip(ip)
+        if cluster_id is not None:
+            self._write(cluster_id, [("DELETE FROM secrets WHERE cluster_id = ? AND name = ?", (cluster_id, name))])
+
+    # Reads, all cached
+
+    def join_token(self, server_ip):
+        cluster_id = self.cluster_for_ip(server_ip)
+        if cluster_id is None:
+            return None
+        return self.cluster_token(cluster_id)
+
+    def cluster_token(self, cluster_id):
+        def load():
+            rows = self._query("SELECT token FROM clusters WHERE id = ?", (cluster_id,))
+            return rows[0]["token"] if rows else None
+
+        return self.cache.get(("cluster", cluster_id, "token"), load)
+
+    def secret(self, ip, name):
+        cluster_id = self.cluster_for_ip(ip)
+        if cluster_id is None:
+            return None
+
+        def load():
+            rows = self._query("SELECT value FROM secrets WHERE cluster_id = ? AND name = ?", (cluster_id, name))
+            return rows[0]["value"] if rows else None
+
+        return self.cache.get(("cluster", cluster_id, "secret", name), load)
+
+    def release(self, ip, name, namespace="default"):
+        cluster_id = self.cluster_for_ip(ip)
+        if cluster_id is None:
+            return None
+
+        def load():
+            rows = self._query(
+                "SELECT name, namespace, chart, status, values_hash, updated_at FROM releases "
+                "WHERE cluster_id = ? AND namespace = ? AND name = ?",
+                (cluster_id, namespace, name),
+            )
+            return rows[0] if rows else None
+
+        return self.cache.get(("cluster", cluster_id, "release", namespace, name), load)
+
+    def get_cluster(self, cluster_id):
+        """The cluster with its VMs, releases and secret names (not values), or None."""
+        def load():
+            rows = self._query("SELECT * FROM clusters WHERE id = ?", (cluster_id,))
+            if not rows:
+                return None
+            cluster = rows[0]
+            cluster["has_token"] = cluster.pop("token") is not None
+            cluster["vms"] = self._query(
+                "SELECT name, public_ip, dns_name, role, node_name FROM vms WHERE cluster_id = ? ORDER BY name",
+                (cluster_id,),
+            )
+            cluster["releases"] = self._query(
+                "SELECT name, namespace, chart, status, values_hash, updated_at FROM releases "
+                "WHERE cluster_id = ? ORDER BY namespace, name",
+                (cluster_id,),
+            )
+            cluster["secrets"] = [row["name"] for row in self._query(
+                "SELECT name FROM secrets WHERE cluster_id = ? ORDER BY name", (cluster_id,))]
+            spaces = self._query("SELECT prefix FROM address_spaces WHERE cluster_id = ?", (cluster_id,))
+            cluster["address_space"] = spaces[0]["prefix"] if spaces else None
+            return cluster
+
+        return self.cache.get(("cluster", cluster_id), load)
+
+    def list_clusters(self):
+        return self._query("SELECT id, rg, location, server_ip, created_at, updated_at FROM clusters ORDER BY created_at")
+
+
+registry = ClusterRegistry()
@@ -0,0 +1,158 @@
+# remote.py
+"""
+Run a command over SSH and read its output incrementally.
+
+Output is read from the channel in CHUNK_SIZE pieces as it arrives. Each
+chunk is forwarded to the running job's live output (GET /jobs/{id}/output),
+redacted like the journal and left out entirely for commands that print
+secrets, and only the last TAIL_BYTES of stdout/stderr are kept for the response,
+so a chatty installer never sits in memory as one big string.
+
+Every command also goes into the execution journal (GET /executions).
+"""
+import codecs
+import time
+
+from jobs import publish_output
+from journal import journal, redact, secret_output
+from metrics import SSH_COMMAND_SECONDS, command_label, observe
+
+CHUNK_SIZE = 32 * 1024
+TAIL_BYTES = 64 * 1024
+POLL_INTERVAL = 0.05
+
+
+class RingBuffer:
+    """Keeps the last `capacity` bytes written to it."""
+
+    def __init__(self, capacity=TAIL_BYTES):
+        self.capacity = capacity
+        self.total = 0
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self.total += len(data)
+        self._buffer.extend(data)
+        overflow = len(self._buffer) - self.capacity
+        if overflow > 0:
+            del self._buffer[:overflow]
+
+    @property
+    def truncated(self):
+        return self.total > len(self._buffer)
+
+    def text(self):
+        return self._buffer.decode(errors="replace")
+
+
+class CommandResult:
+    def __init__(self, command, exit_status, stdout, stderr, duration):
+        self.command = command
+        self.exit_status = exit_status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.exit_status == 0
+
+    def to_dict(self):
+        return {
+            # Responses and job results end up in logs, same redaction as the journal
+            "command": redact(self.command),
+            "exit_status": self.exit_status,
+            "stdout": self.stdout,
+            "stderr": self.stderr,
+            "duration_seconds": round(self.duration, 3),
+        }
+
+
+def peer_host(client):
+    """Address of the host a paramiko client is connected to, None if it can't tell."""
+    try:
+        return client.get_transport().getpeername()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+def run_command(client, command, on_output=None, tail_bytes=TAIL_BYTES, timeout=None):
+    """
+    Execute `command` on a connected paramiko client and stream its output.
+
+    on_output(stream, text) is called for every chunk ("stdout"/"stderr") in
+    addition to the job's live output. Returns a CommandResult whose stdout
+    and stderr hold at most `tail_bytes` each.
+    """
+    start = time.perf_counter()
+    stdin, stdout, stderr = client.exec_command(command)
+    channel = stdout.channel
+    tails = {"stdout": RingBuffer(tail_bytes), "stderr": RingBuffer(tail_bytes)}
+    publish_output(f"$ {redact(command)}\n")
+    hidden = secret_output(command)
+    # A multi-byte character can be split across two chunks, each stream keeps its own decoder
+    decoders = {stream: codecs.getincrementaldecoder("utf-8")(errors="replace") for stream in tails}
+    # Partial last line of each stream, held back so redact() sees whole lines
+    pending = {stream: "" for stream in tails}
+
+    def publish(stream, text, final=False):
+        text = pending[stream] + text
+        cut = max(text.rfind("\n"), text.rfind("\r")) + 1
+        if final or len(text) - cut > CHUNK_SIZE:
+            cut = len(text)
+        pending[stream] = text[cut:]
+        if cut and not hidden:
+            publish_output(redact(text[:cut]))
+
+    def forward(stream, data, final=False):
+        tails[stream].write(data)
+        text = decoders[stream].decode(data, final=final)
+        publish(stream, text, final)
+        if on_output is not None and text:
+            on_output(stream, text)
+
+    while True:
+        progressed = False
+        if channel.recv_ready():
+            data = channel.recv(CHUNK_SIZE)
+            if data:
+                forward("stdout", data)
+                progressed = True
+        if channel.recv_stderr_ready():
+            data = channel.recv_stderr(CHUNK_SIZE)
+            if data:
+                forward("stderr", data)
+                progressed = True
+        if not progressed:
+            if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                break
+            if timeout is not None and time.perf_counter() - start > timeout:
+                channel.close()
+                for stream in tails:
+                    forward(stream, b"", final=True)
+                duration = time.perf_counter() - start
+                observe(SSH_COMMAND_SECONDS, duration, command=command_label(command), outcome="timeout")
+                journal.record(peer_host(client), command, None, duration, tails["stdout"].text(), tails["stderr"].text(),
+                               tails["stdout"].total, tails["stderr"].total, outcome="timeout")
+                raise TimeoutError(f"Command timed out after {timeout}s: {redact(command)}")
+            time.sleep(POLL_INTERVAL)
+
+    for stream in tails:
+        forward(stream, b"", final=True)
+    if hidden:
+        publish_output(f"[output not shown: {tails['stdout'].total} bytes stdout, {tails['stderr'].total} bytes stderr]\n")
+    for stream, tail in tails.items():
+        if tail.truncated:
+            publish_output(f"[{stream}: {tail.total} bytes, response keeps the last {tail.capacity}]\n")
+
+    result = CommandResult(
+        command,
+        channel.recv_exit_status(),
+        tails["stdout"].text(),
+        tails["stderr"].text(),
+        time.perf_counter() - start,
+    )
+    observe(SSH_COMMAND_SECONDS, result.duration, command=command_label(command), outcome="ok" if result.ok else "error")
+    journal.record(peer_host(client), command, result.exit_status, result.duration, result.stdout, result.stderr,
+                   tails["stdout"].total, tails["stderr"].total)
+    return result
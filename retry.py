@@ -0,0 +1,284 @@
+# retry.py
+"""
+Shared retry layer for Azure SDK calls and SSH connects.
+
+Transient failures (429, 5xx, connection errors) are retried with
+exponential backoff and full jitter. A Retry-After header always wins over
+the computed delay. ARM calls also go through a token bucket per
+subscription: a 429 halves its rate and pauses every caller until
+Retry-After has passed, successes bring the rate back up slowly. Parallel
+builds therefore slow down under throttling instead of failing.
+
+    network_client = RetryingClient(network_client, limiter_for(subscription_id))
+
+Every retry and give-up is counted per operation in `failures` (GET /retries).
+"""
+import email.utils
+import random
+import threading
+import time
+
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+
+from metrics import RETRIES
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class RetryPolicy:
+    def __init__(self, attempts=6, base_delay=1.0, max_delay=60.0, max_retry_after=300.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before retry number `attempt` (1-based)."""
+        if retry_after is not None:
+            # A little jitter on top so throttled callers don't all wake at once
+            return min(retry_after, self.max_retry_after) + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+ARM_POLICY = RetryPolicy(attempts=6, base_delay=1.0, max_delay=60.0)
+# Covers a VM that is still booting: sshd refuses or resets for a minute or two
+SSH_CONNECT_POLICY = RetryPolicy(attempts=8, base_delay=2.0, max_delay=20.0)
+
+
+def status_code(error):
+    code = getattr(error, "status_code", None)
+    if code is None and getattr(error, "response", None) is not None:
+        code = getattr(error.response, "status_code", None)
+    return code
+
+
+def retry_after(error):
+    """Seconds from the error's Retry-After header (delta-seconds or HTTP date), or None."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_transient_azure_error(error):
+    if isinstance(error, (ServiceRequestError, ServiceResponseError, ConnectionError, TimeoutError)):
+        return True
+    return status_code(error) in RETRYABLE_STATUS
+
+
+class RateLimiter:
+    """
+    Token bucket that adapts to throttling. Starts at `rate` calls/second,
+    halves on a 429 (not below `min_rate`) and grows back by `recovery`
+    calls/second per successful call. 429s arriving within `cooldown`
+    seconds of the last decrease are the same burst and only extend the pause.
+    """
+
+    def __init__(self, rate=10.0, burst=20, min_rate=1.0, recovery=0.5, cooldown=2.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.cooldown = cooldown
+        self._last_decrease = 0.0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self, pause=None):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown:
+                self._last_decrease = now
+                self.rate = max(self.min_rate, self.rate / 2)
+                self._tokens = min(self._tokens, 0.0)
+            if pause:
+                self._paused_until = max(self._paused_until, now + pause)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.recovery)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rate_per_second": round(self.rate, 2),
+                "max_rate_per_second": self.max_rate,
+                "paused_seconds": round(max(0.0, self._paused_until - time.monotonic()), 2),
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter_for(subscription_id):
+    with _limiters_lock:
+        if subscription_id not in _limiters:
+            _limiters[subscription_id] = RateLimiter()
+        return _limiters[subscription_id]
+
+
+class FailureTracker:
+    """Per-operation counters: calls, retries, throttled, gave_up, last_error."""
+
+    def __init__(self):
+        self._ops = {}
+        self._lock = threading.Lock()
+
+    def _op(self, operation):
+        if operation not in self._ops:
+            self._ops[operation] = {"calls": 0, "retries": 0, "throttled": 0, "gave_up": 0, "last_error": None}
+        return self._ops[operation]
+
+    def record(self, operation, event, error=None):
+        with self._lock:
+            op = self._op(operation)
+            op[event] += 1
+            if error is not None:
+                op["last_error"] = str(error)[:300]
+
+    def stats(self):
+        with self._lock:
+            return {operation: dict(op) for operation, op in sorted(self._ops.items())}
+
+
+failures = FailureTracker()
+
+
+def call_with_retry(fn, *args, operation, policy=ARM_POLICY, retryable=is_transient_azure_error, limiter=None, **kwargs):
+    """fn(*args, **kwargs), retried on errors `retryable` accepts."""
+    failures.record(operation, "calls")
+    attempt = 0
+    while True:
+        attempt += 1
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if not retryable(e) or attempt >= policy.attempts:
+                failures.record(operation, "gave_up", e)
+                RETRIES.labels(operation=operation, outcome="gave_up").inc()
+                raise
+            wait_hint = retry_after(e)
+            if status_code(e) == 429:
+                failures.record(operation, "throttled", e)
+                if limiter is not None:
+                    limiter.throttled(wait_hint)
+            failures.record(operation, "retries", e)
+            RETRIES.labels(operation=operation, outcome="retried").inc()
+            delay = policy.delay(attempt, wait_hint)
+            print(f"{operation} failed ({e}), retry {attempt}/{policy.attempts - 1} in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        if limiter is not None:
+            limiter.succeeded()
+        return result
+
+
+class _RetryingPoller:
+    """
+    A long-running operation that failed transiently while we waited on it is
+    started again. Only used for begin_* calls, which are idempotent PUT/PATCH.
+    """
+
+    def __init__(self, start, poller, operation, policy):
+        self._start = start
+        self._poller = poller
+        self._operation = operation
+        self._policy = policy
+
+    def result(self, *args, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return self._poller.result(*args, **kwargs)
+            except Exception as e:
+                if not is_transient_azure_error(e) or attempt >= self._policy.attempts:
+                    raise
+                failures.record(self._operation, "retries", e)
+                RETRIES.labels(operation=self._operation, outcome="restarted").inc()
+                time.sleep(self._policy.delay(attempt, retry_after(e)))
+                self._poller = self._start()
+
+    def __getattr__(self, name):
+        return getattr(self._poller, name)
+
+
+def _materialized(method):
+    def call(*args, **kwargs):
+        return list(method(*args, **kwargs))
+    return call
+
+
+class _RetryingOperations:
+    def __init__(self, operations, group, limiter, policy):
+        self._operations = operations
+        self._group = group
+        self._limiter = limiter
+        self._policy = policy
+
+    def __getattr__(self, name):
+        method = getattr(self._operations, name)
+        if not callable(method):
+            return method
+        operation = f"{self._group}.{name}"
+        if name.startswith("list"):
+            # list* returns a lazy pager whose pages are fetched while iterating. Read them all
+            # inside call_with_retry, so a throttled page backs off and slows the limiter too.
+            method = _materialized(method)
+
+        def call(*args, **kwargs):
+            # Everything we call on ARM is an idempotent GET/PUT/PATCH, safe to repeat
+            def start():
+                return call_with_retry(method, *args, operation=operation, policy=self._policy, limiter=self._limiter, **kwargs)
+
+            value = start()
+            if name.startswith("begin_"):
+                return _RetryingPoller(start, value, operation, self._policy)
+            return value
+
+        return call
+
+
+class RetryingClient:
+    """Wraps an Azure management client so every operation goes through call_with_retry."""
+
+    def __init__(self, client, limiter=None, policy=ARM_POLICY):
+        self._client = client
+        self._limiter = limiter
+        self._policy = policy
+        self._groups = {}
+
+    def __getattr__(self, name):
+        if name not in self._groups:
+            self._groups[name] = _RetryingOperations(getattr(self._client, name), name, self._limiter, self._policy)
+        return self._groups[name]
@@ -0,0 +1,259 @@
+# ssh_pool.py
+"""
+Shared pool of authenticated paramiko connections, keyed by host, username
+and a digest of the password.
+
+    with ssh_pool.connection(vm.ip_address, vm.username, vm.password) as client:
+        stdin, stdout, stderr = client.exec_command("uptime")
+
+A connection is handed to one caller at a time and goes back to the pool
+when the with-block exits, so the next step of a cluster build skips the
+TCP connect, key exchange and authentication. Connections that raised an
+SSH/socket error are closed instead of being returned. Connects that fail
+transiently (refused, reset, timed out, e.g. a VM that is still booting)
+are retried with backoff, see retry.py.
+
+Only a caller with the same password gets a pooled connection back, so
+reusing one never skips the authentication SSH would have done.
+"""
+import hashlib
+import hmac
+import secrets
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import paramiko
+
+from metrics import SSH_CONNECT_SECONDS, SSH_CONNECTIONS_REUSED, timed
+from retry import SSH_CONNECT_POLICY, call_with_retry
+
+MAX_PER_HOST = 4        # concurrent connections to one host/user/password
+IDLE_TIMEOUT = 300      # seconds an unused connection stays open
+KEEPALIVE_INTERVAL = 30 # seconds between SSH keepalive packets
+CONNECT_TIMEOUT = 15
+
+
+class PooledConnection:
+    def __init__(self, key, client, handshake_seconds):
+        self.key = key
+        self.client = client
+        self.handshake_seconds = handshake_seconds
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.uses = 0
+
+    def is_healthy(self):
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            # Cheap round trip that fails fast on a half-closed socket
+            transport.send_ignore()
+        except (paramiko.SSHException, OSError, EOFError):
+            return False
+        return True
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+
+def _transient_connect_error(error):
+    # Wrong credentials won't fix themselves
+    if isinstance(error, paramiko.AuthenticationException):
+        return False
+    return isinstance(error, (paramiko.SSHException, paramiko.ssh_exception.NoValidConnectionsError,
+                              ConnectionError, TimeoutError, EOFError))
+
+
+# Per process, so the digests kept in memory can't be checked against guessed passwords elsewhere
+_DIGEST_KEY = secrets.token_bytes(32)
+
+
+def credential_digest(username, password):
+    return hmac.new(_DIGEST_KEY, f"{username}\0{password}".encode(), hashlib.sha256).hexdigest()
+
+
+def _paramiko_client():
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    return client
+
+
+class SSHPool:
+    def __init__(self, max_per_host=MAX_PER_HOST, idle_timeout=IDLE_TIMEOUT,
+                 keepalive=KEEPALIVE_INTERVAL, connect_timeout=CONNECT_TIMEOUT, client_factory=_paramiko_client,
+                 connect_retry=SSH_CONNECT_POLICY):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.client_factory = client_factory
+        self.connect_retry = connect_retry
+
+        self._idle = defaultdict(list)   # key -> [PooledConnection]
+        self._in_use = defaultdict(int)  # key -> connections handed out or being opened
+        self._cond = threading.Condition()
+        self._reaper = None
+        self._stats = {
+            "connections_opened": 0,
+            "connections_reused": 0,
+            "evicted_idle": 0,
+            "evicted_unhealthy": 0,
+            "connect_failures": 0,
+            "handshake_seconds_total": 0.0,
+        }
+
+    @contextmanager
+    def connection(self, host, username, password):
+        conn = self._acquire(host, username, password)
+        broken = False
+        try:
+            yield conn.client
+        except (paramiko.SSHException, socket.error, EOFError):
+            broken = True
+            raise
+        finally:
+            self._release(conn, broken)
+
+    def authenticate(self, host, username, password):
+        """
+        Raises unless these credentials log in to `host`. A pooled connection
+        opened with the same password counts, so this is usually free.
+        """
+        with self.connection(host, username, password):
+            pass
+
+    def _acquire(self, host, username, password):
+        key = (host, username, credential_digest(username, password))
+        self._start_reaper()
+        with self._cond:
+            while True:
+                idle = self._idle[key]
+                while idle:
+                    conn = idle.pop()
+                    if conn.is_healthy():
+                        conn.uses += 1
+                        self._in_use[key] += 1
+                        self._stats["connections_reused"] += 1
+                        SSH_CONNECTIONS_REUSED.inc()
+                        return conn
+                    conn.close()
+                    self._stats["evicted_unhealthy"] += 1
+                if self._in_use[key] < self.max_per_host:
+                    # Reserve the slot now, the handshake itself runs outside the lock
+                    self._in_use[key] += 1
+                    break
+                self._cond.wait()
+
+        try:
+            conn = self._open(key, password)
+        except Exception:
+            with self._cond:
+                self._in_use[key] -= 1
+                self._stats["connect_failures"] += 1
+                self._cond.notify()
+            raise
+        conn.uses += 1
+        return conn
+
+    def _open(self, key, password):
+        host, username, _ = key
+        start = time.perf_counter()
+
+        def connect():
+            client = self.client_factory()
+            try:
+                with timed(SSH_CONNECT_SECONDS):
+                    client.connect(
+                        host,
+                        username=username,
+                        password=password,
+                        timeout=self.connect_timeout,
+                        banner_timeout=self.connect_timeout,
+                        auth_timeout=self.connect_timeout,
+                    )
+            except Exception:
+                client.close()
+                raise
+            return client
+
+        client = call_with_retry(connect, operation="ssh.connect", policy=self.connect_retry, retryable=_transient_connect_error)
+        transport = client.get_transport()
+        if transport is not None and self.keepalive:
+            transport.set_keepalive(self.keepalive)
+        handshake = time.perf_counter() - start
+        with self._cond:
+            self._stats["connections_opened"] += 1
+            self._stats["handshake_seconds_total"] += handshake
+        return PooledConnection(key, client, handshake)
+
+    def _release(self, conn, broken):
+        with self._cond:
+            self._in_use[conn.key] -= 1
+            if broken:
+                conn.close()
+                self._stats["evicted_unhealthy"] += 1
+            else:
+                conn.last_used = time.monotonic()
+                self._idle[conn.key].append(conn)
+            self._cond.notify()
+
+    def evict_idle(self):
+        """Close connections that have not been used for idle_timeout seconds."""
+        cutoff = time.monotonic() - self.idle_timeout
+        expired = []
+        with self._cond:
+            for key, idle in self._idle.items():
+                keep = [conn for conn in idle if conn.last_used >= cutoff]
+                expired.extend(conn for conn in idle if conn.last_used < cutoff)
+                self._idle[key] = keep
+            self._stats["evicted_idle"] += len(expired)
+        for conn in expired:
+            conn.close()
+        return len(expired)
+
+    def _start_reaper(self):
+        if self._reaper is not None:
+            return
+        with self._cond:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap, name="ssh-pool-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout / 4))
+            self.evict_idle()
+
+    def close_all(self):
+        with self._cond:
+            conns = [conn for idle in self._idle.values() for conn in idle]
+            self._idle.clear()
+        for conn in conns:
+            conn.close()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            idle = sum(len(conns) for conns in self._idle.values())
+            in_use = sum(self._in_use.values())
+        opened = stats["connections_opened"]
+        avg_handshake = stats["handshake_seconds_total"] / opened if opened else 0.0
+        stats.update({
+            "idle_connections": idle,
+            "in_use_connections": in_use,
+            "avg_handshake_seconds": avg_handshake,
+            # Every reuse is one handshake we didn't pay for
+            "handshake_seconds_saved": avg_handshake * stats["connections_reused"],
+        })
+        return stats
+
+
+ssh_pool = SSHPool()
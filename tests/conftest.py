@@ -0,0 +1,42 @@
+# conftest.py
+"""
+The app wired to the fakes from fakes.py: in-memory Azure clients and a
+FakeSSHServer, with the registry and execution journal in a temp directory.
+Nothing talks to Azure or a real VM.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_state = tempfile.mkdtemp(prefix="k3s-api-tests-")
+os.environ.setdefault("CLUSTER_REGISTRY_DB", os.path.join(_state, "registry.db"))
+os.environ.setdefault("EXECUTION_JOURNAL_DIR", os.path.join(_state, "executions"))
+
+
+@pytest.fixture(scope="session")
+def fake_backends():
+    from azure_clients import azure_clients
+    from fakes import FakeSSHServer, fake_clients
+    from readiness import prober
+    from ssh_pool import ssh_pool
+
+    resource_client, network_client, compute_client = fake_clients(latency=0.01)
+    azure = resource_client.resource_groups._azure
+    azure_clients.use(lambda: (resource_client, network_client, compute_client, azure.subscription_id))
+    server = FakeSSHServer()
+    ssh_pool.client_factory = server.client_factory
+    prober.open_connection = server.open_connection
+    return azure, server
+
+
+@pytest.fixture(scope="session")
+def client(fake_backends):
+    from fastapi.testclient import TestClient
+
+    import main
+
+    return TestClient(main.app)
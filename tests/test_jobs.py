@@ -0,0 +1,39 @@
+# test_jobs.py
+import threading
+import time
+
+from jobs import job_manager, publish_output
+
+
+def test_output_stream_follows_the_job(client):
+    release = threading.Event()
+
+    def work():
+        publish_output("first line\nsecond line\n")
+        release.wait(5)
+        publish_output("done\n")
+        return {"ok": True}
+
+    job = job_manager.submit("test-output", work)
+    threading.Timer(0.5, release.set).start()
+    response = client.get(f"/jobs/{job.id}/output")
+    assert response.status_code == 200
+    # One data line per output line, no empty one for the trailing newline
+    assert response.text == (
+        "data: first line\ndata: second line\n\n"
+        "data: done\n\n"
+        "event: end\ndata: succeeded\n\n"
+    )
+
+
+def test_job_results_keep_secrets_out(client):
+    job = job_manager.submit("test-secret", lambda: {"status": "ok", "token": "K10abc::server:secret",
+                                                     "nodes": [{"admin_password": "hunter2", "ip": "10.0.0.4"}]})
+    while not job.finished:
+        time.sleep(0.01)
+
+    result = client.get(f"/jobs/{job.id}").json()["result"]
+    assert result == {"status": "ok", "token": "***", "nodes": [{"admin_password": "***", "ip": "10.0.0.4"}]}
+
+    listed = [entry for entry in client.get("/jobs").json()["jobs"] if entry["job_id"] == job.id]
+    assert listed and "result" not in listed[0]
@@ -0,0 +1,15 @@
+# test_join.py
+
+
+def test_registry_join_token_needs_the_server_login(client, fake_backends, monkeypatch):
+    from registry import registry
+
+    _, server = fake_backends
+    registry.record_server("10.9.9.9", "SECRET-TOKEN")
+    # The caller owns the VM to join, not the k3s server
+    monkeypatch.setattr(server, "password", {"10.9.9.9": "server-password", "10.9.9.10": "mine"})
+
+    response = client.post("/join-k3s-node", params={
+        "ip_address": "10.9.9.10", "server_ip": "10.9.9.9", "password": "mine", "ready_timeout": 0})
+    assert response.status_code == 401
+    assert not any("SECRET-TOKEN" in command for _, command in server.commands)
@@ -0,0 +1,86 @@
+# test_kube_api.py
+import pytest
+
+from kube_api import KubeClient
+
+MANIFEST = {"apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": "app", "namespace": "default"}, "data": {"key": "value"}}
+
+
+class StubKube:
+    """Stands in for a KubeClient built from a kubeconfig already in the registry."""
+
+    def __init__(self):
+        self.applied = []
+
+    def apply(self, manifest):
+        self.applied.append(manifest)
+        return {**manifest, "metadata": {**manifest["metadata"], "resourceVersion": "1"}}
+
+    def node_status(self):
+        return {"vm-1": True}
+
+
+@pytest.fixture
+def kube(fake_backends, monkeypatch):
+    """A cached cluster-admin client, and fake VMs that only accept one password."""
+    from kube_api import kube_clients
+
+    _, server = fake_backends
+    stub = StubKube()
+    monkeypatch.setattr(kube_clients, "for_node", lambda vm: stub)
+    monkeypatch.setattr(server, "password", "right-password")
+    return stub
+
+
+def test_kube_apply_needs_the_ssh_login(client, kube):
+    body = {"ip_address": "10.9.9.9", "password": "wrong", "manifests": [MANIFEST]}
+    assert client.post("/kube/apply", json=body).status_code == 401
+    assert kube.applied == []
+
+    response = client.post("/kube/apply", json={**body, "password": "right-password"})
+    assert response.status_code == 200, response.text
+    assert kube.applied == [MANIFEST]
+
+
+def test_nodes_ready_over_kube_api_needs_the_ssh_login(client, kube):
+    body = {"ip_address": "10.9.9.9", "password": "wrong", "use_kube_api": True, "ready_timeout": 0}
+    assert client.post("/k3s-nodes/ready", json=body).status_code == 401
+
+    response = client.post("/k3s-nodes/ready", json={**body, "password": "right-password"})
+    assert response.status_code == 200, response.text
+    assert response.json()["nodes"] == {"vm-1": True}
+
+
+class DiscoveryKube(KubeClient):
+    """KubeClient whose GETs answer from a canned discovery document per group/version."""
+
+    def __init__(self, discovery):
+        super().__init__("https://10.9.9.9:6443", b"ca", b"cert", b"key")
+        self.discovery = discovery
+        self.asked = []
+
+    def get(self, path, **params):
+        self.asked.append(path)
+        return self.discovery[path]
+
+
+def test_resource_paths_come_from_discovery():
+    kube = DiscoveryKube({
+        "/apis/gateway.networking.k8s.io/v1": {"resources": [
+            {"name": "gateways", "kind": "Gateway", "namespaced": True},
+            {"name": "gateways/status", "kind": "Gateway", "namespaced": True},
+            {"name": "gatewayclasses", "kind": "GatewayClass", "namespaced": False},
+        ]},
+        "/api/v1": {"resources": [{"name": "endpoints", "kind": "Endpoints", "namespaced": True}]},
+    })
+    try:
+        gateway = {"apiVersion": "gateway.networking.k8s.io/v1", "kind": "Gateway", "metadata": {"name": "web", "namespace": "edge"}}
+        gateway_class = {"apiVersion": "gateway.networking.k8s.io/v1", "kind": "GatewayClass", "metadata": {"name": "envoy"}}
+        endpoints = {"apiVersion": "v1", "kind": "Endpoints", "metadata": {"name": "pg"}}
+        assert kube.resource_path(gateway) == "/apis/gateway.networking.k8s.io/v1/namespaces/edge/gateways/web"
+        assert kube.resource_path(gateway_class) == "/apis/gateway.networking.k8s.io/v1/gatewayclasses/envoy"
+        assert kube.resource_path(endpoints) == "/api/v1/namespaces/default/endpoints/pg"
+        # One discovery request per group/version
+        assert kube.asked == ["/apis/gateway.networking.k8s.io/v1", "/api/v1"]
+    finally:
+        kube.close()
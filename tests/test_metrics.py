@@ -0,0 +1,56 @@
+# test_metrics.py
+import re
+
+OPENMETRICS = "application/openmetrics-text; version=1.0.0"
+
+
+def _samples(text, name, **labels):
+    """Lines of metric `name` that carry all `labels`."""
+    lines = [line for line in text.splitlines() if line.startswith(name + "{")]
+    return [line for line in lines if all(f'{key}="{value}"' in line for key, value in labels.items())]
+
+
+def test_create_vms_shows_up_in_metrics(client, fake_backends):
+    azure, server = fake_backends
+    response = client.post("/create-vms", params={"vm_count": 2, "rg": "metrics-rg", "ready_timeout": 0},
+                           headers={"X-Trace-ID": "trace-create-vms"})
+    assert response.status_code == 200, response.text
+    assert response.headers["X-Trace-ID"] == "trace-create-vms"
+    assert ("vm", "metrics-rg", "myVM-2") in azure.resources
+
+    server_ip = response.json()["vm_ips"][0]["public_ip"]
+    response = client.post("/setup-k3s-primary", params={"ip_address": server_ip, "ready_timeout": 0},
+                           headers={"X-Trace-ID": "trace-setup"})
+    assert response.status_code == 200, response.text
+
+    text = client.get("/metrics").text
+    assert _samples(text, "k3s_api_arm_operation_seconds_count",
+                    resource_type="virtual_machines", operation="begin_create_or_update", outcome="ok")
+    assert _samples(text, "k3s_api_ssh_connect_seconds_count", outcome="ok")
+    assert _samples(text, "k3s_api_ssh_command_seconds_count", outcome="ok")
+    assert _samples(text, "k3s_api_request_seconds_count", route="/create-vms", status="200")
+
+
+def test_openmetrics_exemplars_carry_the_trace_id(client):
+    response = client.post("/create-vms", params={"vm_count": 1, "rg": "exemplar-rg", "ready_timeout": 0},
+                           headers={"X-Trace-ID": "trace-exemplar"})
+    assert response.status_code == 200, response.text
+
+    response = client.get("/metrics", headers={"Accept": OPENMETRICS})
+    assert response.headers["content-type"].startswith("application/openmetrics-text")
+    buckets = _samples(response.text, "k3s_api_arm_operation_seconds_bucket", resource_type="virtual_machines")
+    assert any(re.search(r'# \{trace_id="trace-exemplar"\}', line) for line in buckets)
+
+
+def test_unusable_trace_ids_are_replaced(client):
+    # Over prometheus_client's 128 character exemplar limit
+    response = client.get("/", headers={"X-Trace-ID": "a" * 200})
+    assert response.status_code == 200
+    assert response.headers["X-Trace-ID"] != "a" * 200
+
+    response = client.get("/", headers={"X-Trace-ID": "not an id; x=1"})
+    assert response.status_code == 200
+    assert re.fullmatch(r"[0-9a-f]{32}", response.headers["X-Trace-ID"])
+
+    response = client.get("/", headers={"X-Trace-ID": "caller-trace-42"})
+    assert response.headers["X-Trace-ID"] == "caller-trace-42"
@@ -0,0 +1,18 @@
+# test_pipeline.py
+import time
+
+from pipeline import DagScheduler
+
+
+def test_ready_stages_never_wait_for_a_worker():
+    scheduler = DagScheduler()
+    scheduler.limit("arm", 1)
+    # Long ssh/join-like stages, more of them than the ARM limit plus a few spare threads
+    for i in range(12):
+        scheduler.add(f"slow-{i}", lambda inputs: time.sleep(0.5))
+    scheduler.add("vm-1", lambda inputs: None, group="arm")
+    scheduler.add("vm-2", lambda inputs: None, depends_on=["vm-1"], group="arm")
+
+    report = scheduler.run()
+    assert report["succeeded"]
+    assert report["stages"]["vm-2"]["start_offset_seconds"] < 0.25
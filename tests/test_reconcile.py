@@ -0,0 +1,28 @@
+# test_reconcile.py
+from registry import registry
+
+
+def test_cloud_init_is_refused_for_existing_vms(client):
+    response = client.post("/create-vms", params={"vm_count": 2, "rg": "plain-rg", "ready_timeout": 0})
+    assert response.status_code == 200, response.text
+
+    response = client.post("/create-vms", params={
+        "vm_count": 2, "rg": "plain-rg", "ready_timeout": 0, "reconcile": True, "bootstrap": "cloud-init"})
+    assert response.status_code == 409, response.text
+    assert registry.cluster_token("plain-rg") is None
+
+
+def test_reconcile_keeps_the_token_the_vms_booted_with(client):
+    params = {"vm_count": 2, "rg": "booted-rg", "ready_timeout": 0, "bootstrap": "cloud-init"}
+    response = client.post("/create-vms", params=params)
+    assert response.status_code == 200, response.text
+    token = response.json()["token"]
+
+    response = client.post("/create-vms", params={**params, "reconcile": True})
+    assert response.status_code == 200, response.text
+    assert response.json()["token"] == token
+    assert registry.cluster_token("booted-rg") == token
+
+    response = client.post("/create-vms", params={**params, "reconcile": True, "k3s_token": "another-token"})
+    assert response.status_code == 409
+    assert registry.cluster_token("booted-rg") == token
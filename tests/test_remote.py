@@ -0,0 +1,61 @@
+# test_remote.py
+import time
+
+from jobs import job_manager
+from remote import run_command
+
+
+class ChunkedChannel:
+    """Hands out stdout in the given pieces, one per recv()."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_ready(self):
+        return bool(self.chunks)
+
+    def recv(self, size):
+        return self.chunks.pop(0)
+
+    def recv_stderr_ready(self):
+        return False
+
+    def exit_status_ready(self):
+        return not self.chunks
+
+    def recv_exit_status(self):
+        return 0
+
+
+class ChunkedClient:
+    def __init__(self, chunks):
+        self.channel = ChunkedChannel(chunks)
+
+    def exec_command(self, command):
+        stdout = type("Stdout", (), {"channel": self.channel})()
+        return None, stdout, None
+
+    def get_transport(self):
+        return None
+
+
+def _job_output(command, chunks):
+    job = job_manager.submit("test-remote", lambda: run_command(ChunkedClient(chunks), command).to_dict())
+    while not job.finished:
+        time.sleep(0.01)
+    output, _ = job.output.read()
+    return job.result, "".join(text for _, text in output)
+
+
+def test_live_output_is_decoded_and_redacted():
+    snowman = "☃".encode()
+    result, output = _job_output("echo", [b"a " + snowman[:1], snowman[1:] + b" b\nK3S_TO", b"KEN=hunter2\n"])
+    assert result["stdout"] == "a ☃ b\nK3S_TOKEN=hunter2\n"
+    assert "a ☃ b\n" in output
+    assert "hunter2" not in output and "K3S_TOKEN=***" in output
+
+
+def test_secret_output_is_not_published():
+    _, output = _job_output("sudo cat /var/lib/rancher/k3s/server/node-token", [b"K10abc::server:secret\n"])
+    assert "K10abc" not in output
+    assert "[output not shown: 22 bytes stdout, 0 bytes stderr]" in output